@@ -2,12 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import os
 import sys
 import contextlib
-import random
-from pathlib import Path
+from audioalbum import cli
+
+if __name__ == '__main__' and cli.is_command(sys.argv[1:]):
+    sys.exit(cli.main(sys.argv[1:]))
+
 from PyQt5 import QtWidgets, QtCore, QtGui
-from audioalbum import files, playback, fsystem, albumsys, clustering
+from audioalbum import files, playback, fsystem, albumsys, clustering, \
+    playlist, cache, loudness, journal, metrics, tasks
 
 
 class PlayerWindow(QtWidgets.QMainWindow):
@@ -15,20 +20,63 @@ class PlayerWindow(QtWidgets.QMainWindow):
     AUDIO_FEATURES = {}
     SAVING_FILE = 'saved_albums.txt'
 
-    def __init__(self, audio_files):
+    track_ended = QtCore.pyqtSignal(int)
+    position_changed = QtCore.pyqtSignal(float)
+    batch_progress = QtCore.pyqtSignal(int, int)
+    copy_progress = QtCore.pyqtSignal(str, object, object)
+    batch_finished = QtCore.pyqtSignal(object)
+    files_changed = QtCore.pyqtSignal(object)
+    files_evicted = QtCore.pyqtSignal(object)
+
+    def __init__(self, audio_files, cluster_backend='kmeans',
+                 fast_analysis=False, gapless=False, cache_size=0,
+                 audio_backend='pygame', normalize=False, database=None):
         super().__init__()
         self.AUDIO_FILES = audio_files
-        self.playing_files = list(self.AUDIO_FILES)
+        self.database = database
+        self.fast_analysis = fast_analysis
+        self.cluster_models = clustering.ModelCache(cluster_backend)
+        self.similarity_index = None
         self.current_playlist = list(self.AUDIO_FILES)
-        self.player = playback.MusicPlayer(self.playing_files)
+        self.playing_files = playlist.Playlist(self.current_playlist)
+        self.track_model = TrackListModel(self.playing_files)
+        if self.database:
+            self.metadata_cache = self.database.metadata()
+        else:
+            self.metadata_cache = cache.MetadataCache(
+                cache.default_filename())
+        self.player = playback.MusicPlayer(
+            self.playing_files, gapless, cache_size,
+            playback.BACKENDS[audio_backend](), self.metadata_cache,
+            normalize)
+        self.loudness_analyzer = None
+        if normalize:
+            self.loudness_analyzer = loudness.LoudnessAnalyzer(
+                self.metadata_cache, fast=fast_analysis)
+            self.loudness_analyzer.analyze(
+                [audio.path() for audio in self.AUDIO_FILES])
+        self.player_monitor = playback.PlaybackMonitor(
+            self.player, self.track_ended.emit, self.position_changed.emit)
         self.fs_editor = fsystem.FileSystemEdit(self.playing_files)
-        self.album_editor = albumsys.AlbumEditor()
+        self.journal = journal.Journal(self.fs_editor)
+        self.journal.subscribe(self.metadata_cache.apply_changes)
+        if self.database:
+            self.journal.subscribe(self.database.apply_changes)
+            self.journal.subscribe_evicted(self.database.forget_removed)
+        self.journal.subscribe(self.files_changed.emit)
+        self.journal.subscribe_evicted(self.files_evicted.emit)
+        self.album_editor = albumsys.AlbumEditor(self.database)
         self.play_row = True
         self.is_pause = False
         self.repeat_track = False
-        self.timer_change = False
+        self.slider_change = False
         self.shuffle = False
         self.file_sys_work = False
+        self.showing_library = True
+        self.batch = None
+        self.batch_status = ''
+        self.batch_resume = None
+        self.batch_resume_row = -1
         self.icons = {
             'play': QtGui.QIcon('images/play.png'),
             'pause': QtGui.QIcon('images/pause.png'),
@@ -44,6 +92,19 @@ class PlayerWindow(QtWidgets.QMainWindow):
             'rewind_b': QtGui.QIcon('images/rewind_b.png')
         }
         self._init_ui()
+        self.track_ended.connect(self.process_track_end)
+        self.position_changed.connect(self.show_position)
+        self.batch_progress.connect(
+            self.show_batch_progress, QtCore.Qt.QueuedConnection)
+        self.copy_progress.connect(
+            self.show_copy_progress, QtCore.Qt.QueuedConnection)
+        self.batch_finished.connect(
+            self.finish_batch, QtCore.Qt.QueuedConnection)
+        self.files_changed.connect(
+            self.apply_file_changes, QtCore.Qt.QueuedConnection)
+        self.files_evicted.connect(
+            self.album_editor.forget_removed, QtCore.Qt.QueuedConnection)
+        self.player_monitor.start()
 
     def _init_ui(self):
 
@@ -51,9 +112,6 @@ class PlayerWindow(QtWidgets.QMainWindow):
         self.setFixedSize(450, 800)
         self.setWindowTitle('Player')
 
-        self.timer = QtCore.QBasicTimer()
-        self.step = 0
-
         menubar = self.menuBar()
         file_menu = menubar.addMenu('File')
         search_menu = menubar.addMenu('Search')
@@ -97,6 +155,11 @@ class PlayerWindow(QtWidgets.QMainWindow):
         self.move_file_action.triggered.connect(self.move_file)
         file_menu.addAction(self.move_file_action)
 
+        self.undo_action = QtWidgets.QAction('Undo', self)
+        self.undo_action.setShortcut('Ctrl+Z')
+        self.undo_action.triggered.connect(self.undo_file_operation)
+        file_menu.addAction(self.undo_action)
+
         self.current_song_title = QtWidgets.QLabel('nothing is playing')
         self.current_song_artist = QtWidgets.QLabel('')
 
@@ -140,9 +203,15 @@ class PlayerWindow(QtWidgets.QMainWindow):
 
         self.volume_label = QtWidgets.QLabel('volume')
 
-        self.audio_list_widget = QtWidgets.QListWidget()
-        self.audio_list_widget.itemDoubleClicked.connect(self.play_from_list)
-        self.audio_list_widget.itemClicked.connect(self.show_file_info)
+        self.audio_list_view = QtWidgets.QListView()
+        self.audio_list_view.setUniformItemSizes(True)
+        self.audio_list_view.setEditTriggers(
+            QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.audio_list_view.setSelectionMode(
+            QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.audio_list_view.setModel(self.track_model)
+        self.audio_list_view.doubleClicked.connect(self.play_from_list)
+        self.audio_list_view.clicked.connect(self.show_file_info)
 
         self.file_info_widget = FileInfoWindow()
 
@@ -170,7 +239,7 @@ class PlayerWindow(QtWidgets.QMainWindow):
         vbox.addLayout(buttons_box)
         vbox.addLayout(more_buttons_box)
         vbox.addLayout(volume_box)
-        vbox.addWidget(self.audio_list_widget)
+        vbox.addWidget(self.audio_list_view)
         vbox.addWidget(self.file_info_widget)
 
         window = QtWidgets.QWidget(self)
@@ -180,15 +249,13 @@ class PlayerWindow(QtWidgets.QMainWindow):
         self.add_files_to_list()
 
     def play_again(self):
-        self.step = 0
         self.player.play_again()
 
     def rewind(self, value):
-        if self.timer_change:
+        if self.slider_change:
             return
         step = self.player.get_cur_audio_file().meta.duration / 100
         self.player.play_from_position(step * value)
-        self.step = round(step*value)
 
     def repeat_this_track(self):
         if self.repeat_track:
@@ -197,27 +264,27 @@ class PlayerWindow(QtWidgets.QMainWindow):
         else:
             self.repeat_track = True
             self.repeat.setIcon(self.icons['repeat'])
+        self.player.repeat = self.repeat_track
+        if self.player.gapless:
+            self.player.preload_next()
 
     def shuffle_back_to_normal(self):
-        current_audio = self.player.get_cur_audio_file()
+        current_index = self.playing_files.index(self.player.current_audio)
         self.clear_playing_item()
         if not self.shuffle:
             self.shuffle_normal.setIcon(self.icons['shuffle'])
-            random.shuffle(self.playing_files)
-            self.add_files_to_list()
+            self.track_model.shuffle()
             self.shuffle = True
         else:
             self.shuffle_normal.setIcon(self.icons['normal'])
-            self.playing_files = list(self.current_playlist)
-            self.add_files_to_list()
+            self.track_model.unshuffle()
             self.shuffle = False
-        index = self.playing_files.index(current_audio)
-        self.player.current_audio = index
+        self.player.current_audio = self.playing_files.row(current_index)
         self.move_to_current_track()
 
     def move_to_current_track(self):
         self.clear_playing_item()
-        self.audio_list_widget.setCurrentRow(self.player.current_audio)
+        self.set_current_row(self.player.current_audio)
         self.highlight_item()
 
     def play_from_list(self):
@@ -225,7 +292,7 @@ class PlayerWindow(QtWidgets.QMainWindow):
         self.play_pause()
 
     def play_pause(self):
-        row = self.audio_list_widget.currentRow()
+        row = self.current_row()
         self.clear_playing_item()
         if self.play_row:
             self.play_music_from_row(row)
@@ -246,8 +313,6 @@ class PlayerWindow(QtWidgets.QMainWindow):
             self.player.play(row)
         self.player.play(row)
         self.set_current_audio_text('play')
-        self.timer.start(1000, self)
-        self.step = 0
         self.play_pause_button.setIcon(self.icons['pause'])
         self.play_row = False
         self.is_pause = False
@@ -256,7 +321,6 @@ class PlayerWindow(QtWidgets.QMainWindow):
         self.clear_playing_item()
         self.is_pause = False
         self.player.play_next()
-        self.step = 0
         self.set_current_audio_text('play')
         self.play_pause_button.setIcon(self.icons['pause'])
         self.highlight_item()
@@ -265,7 +329,6 @@ class PlayerWindow(QtWidgets.QMainWindow):
         self.clear_playing_item()
         self.is_pause = False
         self.player.play_previous()
-        self.step = 0
         self.set_current_audio_text('play')
         self.play_pause_button.setIcon(self.icons['pause'])
         self.highlight_item()
@@ -295,7 +358,7 @@ class PlayerWindow(QtWidgets.QMainWindow):
 
     def show_file_info(self):
         self.file_info_widget.show_file_info(
-            self.playing_files[self.audio_list_widget.currentRow()])
+            self.playing_files[self.current_row()])
 
     def set_current_audio_text(self, state):
         if state == 'play':
@@ -321,35 +384,21 @@ class PlayerWindow(QtWidgets.QMainWindow):
         return title, artist
 
     def delete_file(self):
-        row = self.audio_list_widget.currentRow()
-        file = self.playing_files[row]
+        rows = self.selected_rows()
+        names = [self.playing_files[row].name for row in rows]
 
         reply = QtWidgets.QMessageBox.question(
             self, 'Delete file',
-            'Are you sure you want to delete this file?\r\n' + file.name,
+            'Are you sure you want to delete this file?\r\n'
+            + '\r\n'.join(names),
             QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
             QtWidgets.QMessageBox.No)
         if reply == QtWidgets.QMessageBox.No:
             return
 
-        play_this_row = False
-        if self.player.current_audio == row:
-            self.player.stop()
-            play_this_row = True
-
-        exit_code = self.fs_editor.delete_file(row)
-        if not exit_code == fsystem.ERROR_DELETE:
-            self.playing_files.remove(file)
-            self.AUDIO_FILES.remove(file)
-            self.audio_list_widget.takeItem(row)
-            self.player.current_audio -= 1
-
-        if play_this_row:
-            self.player.restart()
-            self.player.play(row)
-            self.set_current_audio_text('play')
-
-        self.file_info_widget.clear_info()
+        self.start_batch([
+            fsystem.FileOperation(fsystem.DELETE, self.playing_files[row])
+            for row in rows])
 
     def rename_file(self):
         text, ok = QtWidgets.QInputDialog.getText(
@@ -358,103 +407,201 @@ class PlayerWindow(QtWidgets.QMainWindow):
         if not ok:
             return
 
-        row = self.audio_list_widget.currentRow()
-        play_this_again = False
-
-        self.file_sys_work = True
-
-        if self.player.current_audio == row:
-            play_this_again = True
-            self.player.stop()
-
-        exit_code = self.fs_editor.rename_file(row, text)
-        if not exit_code == fsystem.ERROR_RENAME:
-            self.playing_files[row].name = text
-            self.playing_files[row].file_name = '{}.{}'.format(
-                text, self.playing_files[row].format)
-            self.audio_list_widget.takeItem(row)
-            self.audio_list_widget.insertItem(row, text)
-
-        self.audio_list_widget.setCurrentRow(row)
-        if play_this_again:
-            self.player.restart()
-            self.step = 0
-            self.player.play(row)
-            self.set_current_audio_text('play')
-
-        self.file_sys_work = False
-        self.file_info_widget.show_file_info(self.playing_files[row])
+        self.start_batch([fsystem.FileOperation(
+            fsystem.RENAME, self.playing_files[self.current_row()], text)])
 
     def move_file(self):
         new_directory = QtWidgets.QFileDialog.getExistingDirectory(
             self, 'Choose directory')
-        row = self.audio_list_widget.currentRow()
+        if not new_directory:
+            return
+
+        self.start_batch([
+            fsystem.FileOperation(
+                fsystem.MOVE, self.playing_files[row], new_directory)
+            for row in self.selected_rows()])
+
+    def selected_rows(self):
+        rows = sorted(index.row() for index in
+                      self.audio_list_view.selectionModel().selectedRows())
+        return rows or [self.current_row()]
+
+    def undo_file_operation(self):
+        transaction = self.journal.last()
+        if transaction is None:
+            return
+        self.start_batch(transaction.operations, undo=True)
+
+    def set_file_actions_enabled(self, enabled):
+        self.delete_file_action.setEnabled(enabled)
+        self.rename_file_action.setEnabled(enabled)
+        self.move_file_action.setEnabled(enabled)
+        self.undo_action.setEnabled(enabled)
+
+    def start_batch(self, operations, undo=False):
+        if self.batch is not None:
+            return
+        self.batch_resume = None
+        if self.player.is_playing:
+            current = self.player.get_cur_audio_file()
+            if any(operation.audio_file is current
+                   for operation in operations):
+                self.batch_resume = current
+                self.batch_resume_row = self.player.current_audio
+                self.player.release()
 
         self.file_sys_work = True
-        play_this_again = False
-        if self.player.current_audio == row:
-            play_this_again = True
-            self.player.stop()
-
-        exit_code = self.fs_editor.move_file(row, new_directory)
-        if not exit_code == fsystem.ERROR_MOVE:
-            self.playing_files[row].directory = new_directory
-
-        self.audio_list_widget.setCurrentRow(row)
-        if play_this_again:
-            self.audio_list_widget.setCurrentRow(row)
-            self.player.restart()
-            self.step = 0
+        self.set_file_actions_enabled(False)
+        self.batch_status = '0/{}'.format(len(operations))
+        self.statusBar().showMessage(self.batch_status)
+
+        def copy_progress(operation, copied, total):
+            self.copy_progress.emit(operation.audio_file.name, copied, total)
+
+        if undo:
+            self.batch = self.journal.undo(self.batch_progress.emit,
+                                           copy_progress)
+        else:
+            self.batch = self.journal.run(
+                operations, self.batch_progress.emit, copy_progress)
+        self.batch.add_done_callback(
+            lambda batch: self.batch_finished.emit(batch.result()))
+
+    def show_batch_progress(self, completed, total):
+        self.batch_status = '{}/{}'.format(completed, total)
+        self.statusBar().showMessage(self.batch_status)
+
+    def show_copy_progress(self, name, copied, total):
+        self.statusBar().showMessage('{}  {}: {}%'.format(
+            self.batch_status, name, copied * 100 // max(total, 1)))
+
+    def apply_file_changes(self, changes):
+        journal.apply_changes(changes)
+        # features are kept by path, renamed and moved files keep theirs
+        for change in changes:
+            if change.old_path is not None and change.new_path is not None \
+                    and change.old_path in self.AUDIO_FEATURES:
+                self.AUDIO_FEATURES[change.new_path] = \
+                    self.AUDIO_FEATURES.pop(change.old_path)
+        current = None
+        if self.player.is_playing:
+            current = self.playing_files.index(self.player.current_audio)
+
+        deleted = {change.audio_file for change in changes if change.deleted}
+        restored = [change.audio_file for change in changes
+                    if change.restored]
+        if deleted:
+            new_indices = self.track_model.remove_files(deleted)
+            if current is not None:
+                current = new_indices.get(current, -1)
+            self.AUDIO_FILES[:] = [audio for audio in self.AUDIO_FILES
+                                   if audio not in deleted]
+            for audio in deleted:
+                self.AUDIO_FEATURES.pop(audio.path(), None)
+        if restored:
+            self.AUDIO_FILES[:] = files.sort(
+                self.AUDIO_FILES + restored, 'name')
+            if self.showing_library:
+                self.track_model.append_files(restored)
+        if deleted or restored:
+            self.similarity_index = None
+
+        for change in changes:
+            if change.old_path is None:
+                continue
+            self.player.forget(change.old_path)
+            if change.new_path is None or \
+                    os.path.basename(change.old_path) == \
+                    os.path.basename(change.new_path):
+                continue
+            for row in self.playing_files.rows_of(change.audio_file):
+                self.track_model.rename_row(row, change.audio_file.name)
+        self.album_editor.apply_changes(changes)
+
+        if current is not None:
+            self.player.current_audio = self.playing_files.row(current)
+            self.highlight_item()
+
+    def finish_batch(self, transaction):
+        if self.batch_resume is not None and len(self.playing_files) \
+                and not self.player.is_playing:
+            row = self.playing_files.row_of(self.batch_resume)
+            if row < 0:
+                row = min(self.batch_resume_row, len(self.playing_files) - 1)
             self.player.play(row)
             self.set_current_audio_text('play')
+            self.highlight_item()
 
+        failed = len(transaction.failed())
+        if transaction.rolled_back:
+            message = 'Failed: {}, rolled back'.format(failed)
+        elif failed:
+            message = 'Failed: {}'.format(failed)
+        else:
+            message = 'Done'
+        self.statusBar().showMessage(message, 5000)
+        self.batch = None
+        self.batch_resume = None
         self.file_sys_work = False
-        self.file_info_widget.show_file_info(self.playing_files[row])
+        self.set_file_actions_enabled(True)
+        self.file_info_widget.clear_info()
+
+    def current_row(self):
+        return self.audio_list_view.currentIndex().row()
+
+    def set_current_row(self, row):
+        index = self.track_model.index(row)
+        self.audio_list_view.setCurrentIndex(index)
+        self.audio_list_view.scrollTo(index)
 
     def add_files_to_list(self):
-        self.audio_list_widget.clear()
-        self.player.audio_files = self.playing_files
-        self.audio_list_widget.addItems(
-            [file.name for file in self.playing_files])
-        self.audio_list_widget.setCurrentRow(0)
+        self.set_current_row(0)
 
     def add_album_to_list(self, album):
-        self.audio_list_widget.clear()
         self.current_playlist = [item.audio_file for item in album.album_items]
-        self.playing_files = [item.audio_file for item in album.album_items]
+        self.showing_library = False
+        self.track_model.set_files(
+            self.current_playlist, [item.name for item in album.album_items])
         self.player.current_audio = 0
-        self.player.audio_files = self.playing_files
-        self.audio_list_widget.addItems(
-            [item.name for item in album.album_items])
-        self.audio_list_widget.setCurrentRow(0)
+        self.set_current_row(0)
         self.play_row = True
         self.play_pause_button.setIcon(self.icons['play'])
 
     def highlight_item(self):
-        self.audio_list_widget.item(self.player.current_audio).setBackground(
-            QtGui.QBrush(QtGui.QColor(161, 248, 96)))
+        self.track_model.set_playing_row(self.player.current_audio)
 
     def clear_playing_item(self):
-        self.audio_list_widget.item(self.player.current_audio).setBackground(
-            QtGui.QBrush(QtGui.QColor(255, 255, 255)))
+        self.track_model.set_playing_row(-1)
 
-    def timerEvent(self, e):
+    def process_track_end(self, state):
+        if self.is_pause or self.file_sys_work:
+            return
+        if state == playback.TRACK_SWITCHED:
+            self.highlight_item()
+            self.set_current_audio_text('play')
+        elif self.repeat_track:
+            self.player.play(self.player.current_audio)
+        else:
+            self.play_next_track()
+
+    def show_position(self, position):
         if self.is_pause or self.file_sys_work:
             return
-        if not self.player.music_is_playing():
-            if self.repeat_track:
-                self.player.play(self.player.current_audio)
-                self.step = 0
-            else:
-                self.play_next_track()
         cur_song_position = \
-            self.step / self.player.get_cur_audio_file().meta.duration * 100
-        self.timer_change = True
+            position / self.player.get_cur_audio_file().meta.duration * 100
+        self.slider_change = True
         self.song_slider.setValue(round(cur_song_position))
-        self.timer_change = False
-        self.step += 1
+        self.slider_change = False
 
     def closeEvent(self, event):
+        self.player_monitor.stop()
+        self.fs_editor.shutdown()
+        self.journal.close()
+        if self.loudness_analyzer is not None:
+            self.loudness_analyzer.shutdown()
+        self.metadata_cache.close()
+        if self.database:
+            self.database.close()
         with contextlib.suppress(Exception):
             self.search.close()
         with contextlib.suppress(Exception):
@@ -467,7 +614,79 @@ class PlayerWindow(QtWidgets.QMainWindow):
             self.all_cluster_window.close()
 
 
+class TrackListModel(QtCore.QAbstractListModel):
+    PLAYING_COLOR = QtGui.QColor(161, 248, 96)
+
+    def __init__(self, playlist):
+        super().__init__()
+        self.playlist = playlist
+        self.playing_row = -1
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.playlist)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == QtCore.Qt.DisplayRole:
+            metrics.count('list_data')
+            return self.playlist.name(row)
+        if role == QtCore.Qt.BackgroundRole and row == self.playing_row:
+            return QtGui.QBrush(self.PLAYING_COLOR)
+        return None
+
+    @metrics.timed('list_reset')
+    def set_files(self, files, names=None):
+        self.beginResetModel()
+        self.playlist.reset(files, names)
+        self.playing_row = -1
+        self.endResetModel()
+
+    def shuffle(self):
+        self.beginResetModel()
+        self.playlist.shuffle()
+        self.endResetModel()
+
+    def unshuffle(self):
+        self.beginResetModel()
+        self.playlist.unshuffle()
+        self.endResetModel()
+
+    def set_playing_row(self, row):
+        old_row = self.playing_row
+        self.playing_row = row
+        for changed_row in (old_row, row):
+            if 0 <= changed_row < len(self.playlist):
+                index = self.index(changed_row)
+                self.dataChanged.emit(
+                    index, index, [QtCore.Qt.BackgroundRole])
+
+    def rename_row(self, row, name):
+        self.playlist.rename(row, name)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [QtCore.Qt.DisplayRole])
+
+    def append_files(self, audio_files):
+        row = len(self.playlist)
+        self.beginInsertRows(
+            QtCore.QModelIndex(), row, row + len(audio_files) - 1)
+        for audio in audio_files:
+            self.playlist.append(audio)
+        self.endInsertRows()
+
+    def remove_files(self, audio_files):
+        self.beginResetModel()
+        new_indices = self.playlist.remove_files(audio_files)
+        self.playing_row = -1
+        self.endResetModel()
+        return new_indices
+
+
 class AlbumWindow(QtWidgets.QTabWidget):
+    @metrics.timed('album_window_open')
     def __init__(self, window):
         super().__init__()
         self.window = window
@@ -493,6 +712,10 @@ class AlbumWindow(QtWidgets.QTabWidget):
 
         self.currentChanged.connect(self.process_tab_change)
 
+    def closeEvent(self, event):
+        self.home_tab.cancel_loading()
+        self.auto_tab.cancel_loading()
+
     def process_tab_change(self):
         index = self.currentIndex()
         if index == 0:
@@ -516,6 +739,7 @@ class AlbumWindowHomeWidget(QtWidgets.QWidget):
         super().__init__()
         self.album_editor = album_editor
         self.window = window
+        self.loading = None
         self._init_ui()
 
     def _init_ui(self):
@@ -560,14 +784,45 @@ class AlbumWindowHomeWidget(QtWidgets.QWidget):
         self.window.setCurrentIndex(1)
 
     def load_albums(self):
+        if self.loading:
+            return
         with open(self.window.window.SAVING_FILE, 'at') as f:
             pass
-        with open(self.window.window.SAVING_FILE, 'rt') as f:
-            albums = f.read()
-        self.album_editor.load_albums(albums)
+        self.load_button.setEnabled(False)
+        if self.album_editor.database:
+            self.loading = BackgroundTask(albumsys.load_albums_database,
+                                          self.album_editor.database)
+        else:
+            self.loading = BackgroundTask(albumsys.load_albums_file,
+                                          self.window.window.SAVING_FILE)
+        self.loading.progress.connect(self.show_loading_progress)
+        self.loading.done.connect(self.finish_loading)
+        self.loading.start()
+
+    def show_loading_progress(self, done, total):
+        self.load_button.setText('Loading {}/{}'.format(done, total))
+
+    def finish_loading(self):
+        loading, self.loading = self.loading, None
+        self.load_button.setText('Load albums')
+        self.load_button.setEnabled(True)
+        if loading.cancelled():
+            return
+        loaded = loading.result()
+        for album in loaded.albums.values():
+            self.album_editor.add_album(album)
+        if loaded.database_loaded:
+            self.album_editor.database_loaded = True
         self.update_albums()
 
+    def cancel_loading(self):
+        if self.loading:
+            self.loading.cancel()
+
     def save_albums(self):
+        if self.album_editor.database:
+            self.album_editor.save_to_database()
+            return
         with open(self.window.window.SAVING_FILE, 'at') as f:
             f.write(self.album_editor.save_albums())
 
@@ -625,13 +880,13 @@ class AlbumAutoCreationWidget(QtWidgets.QWidget):
         super().__init__()
         self.album_editor = album_editor
         self.audio_files = audio_files
-        self.album_maker = albumsys.AutoAlbumsMaker(self.audio_files)
-        self.album_maker.make_albums('artist')
-        self.album_maker.make_albums('album')
-        self.album_maker.make_albums('genre')
-        self.album_maker.make_albums('year')
+        self.album_maker = albumsys.AutoAlbumsMaker([])
         self.albums = {}
         self._init_ui()
+        self.loading = BackgroundTask(make_auto_albums, self.audio_files)
+        self.loading.progress.connect(self.show_loading_progress)
+        self.loading.done.connect(self.finish_loading)
+        self.loading.start()
 
     def _init_ui(self):
         self.artist_box = QtWidgets.QCheckBox('Artist')
@@ -667,12 +922,32 @@ class AlbumAutoCreationWidget(QtWidgets.QWidget):
         hbox2.addWidget(self.albums_widget)
         hbox2.addWidget(self.albums_content_widget)
 
+        self.progressbar = QtWidgets.QProgressBar(self)
+        self.progressbar.setRange(0, 0)
+
         vbox2 = QtWidgets.QVBoxLayout()
+        vbox2.addWidget(self.progressbar)
         vbox2.addLayout(hbox2)
         vbox2.addLayout(hbox1)
 
         self.setLayout(vbox2)
 
+    def show_loading_progress(self, done, total):
+        self.progressbar.setRange(0, total)
+        self.progressbar.setValue(done)
+
+    def finish_loading(self):
+        loading, self.loading = self.loading, None
+        self.progressbar.hide()
+        if loading.cancelled():
+            return
+        self.album_maker = loading.result()
+        self.state_changed()
+
+    def cancel_loading(self):
+        if self.loading:
+            self.loading.cancel()
+
     def save_album(self):
         album_name = self.albums_widget.currentItem().text()
         album = self.albums[album_name]
@@ -867,7 +1142,7 @@ class AlbumEditWidget(QtWidgets.QWidget):
 
     def add_to_album(self):
         file = self.window.playing_files[
-            self.window.audio_list_widget.currentRow()]
+            self.window.current_row()]
         self.album.add_file(file)
         self.album_list_widget.addItem(file.name)
 
@@ -888,6 +1163,7 @@ class DuplicateWindow(QtWidgets.QWidget):
         self.window = main_window
         self.files = files
         self.same_files = []
+        self.search = None
 
         self._init_ui()
 
@@ -900,7 +1176,7 @@ class DuplicateWindow(QtWidgets.QWidget):
         self.window.rename_file_action.setEnabled(False)
         self.window.move_file_action.setEnabled(False)
 
-        self.window.audio_list_widget.itemClicked.connect(
+        self.window.audio_list_view.clicked.connect(
             self.search_duplicates)
 
         self.find_all_button = QtWidgets.QPushButton('find all')
@@ -922,13 +1198,31 @@ class DuplicateWindow(QtWidgets.QWidget):
         self.setLayout(vbox)
 
     def find_all(self):
-        reps = files.find_all_repetitions(self.files)
-        self.duplicates_window = AllDuplicationWindow(reps)
+        if self.search:
+            return
+        self.find_all_button.setEnabled(False)
+        self.search = BackgroundTask(files.find_all_repetitions, self.files)
+        self.search.progress.connect(self.show_search_progress)
+        self.search.done.connect(self.show_all_duplicates)
+        self.search.start()
+
+    def show_search_progress(self, done, total):
+        self.find_all_button.setText('searching {}/{}'.format(done, total))
+
+    def show_all_duplicates(self):
+        search, self.search = self.search, None
+        self.find_all_button.setText('find all')
+        self.find_all_button.setEnabled(True)
+        if search.cancelled():
+            return
+        if self.window.database:
+            self.window.database.store_hashes(self.files)
+        self.duplicates_window = AllDuplicationWindow(search.result())
         self.duplicates_window.show()
 
     def search_duplicates(self):
         self.duplicates_list.clear()
-        audio = self.files[self.window.audio_list_widget.currentRow()]
+        audio = self.files[self.window.current_row()]
         self.current_audio.setText(audio.name)
         self.same_files = files.find_same_files(audio, self.files)
 
@@ -942,6 +1236,8 @@ class DuplicateWindow(QtWidgets.QWidget):
         self.window.delete_file_action.setEnabled(True)
         self.window.rename_file_action.setEnabled(True)
         self.window.move_file_action.setEnabled(True)
+        if self.search:
+            self.search.cancel()
         with contextlib.suppress(Exception):
             self.duplicates_window.close()
 
@@ -1032,21 +1328,34 @@ class SearchWindow(QtWidgets.QWidget):
         self.result_list.clear()
         if text == '':
             return
-        self.founded_files = files.find_name_in_files(text, self.files)
+        self.founded_files = self.find_files(text)
         self.result_list.addItems([file.name for file in self.founded_files])
 
+    def find_files(self, text):
+        paths = None
+        if self.window.database:
+            paths = self.window.database.find_name(text)
+        if paths is None:
+            return files.find_name_in_files(text, self.files)
+        found = [self.paths[path] for path in paths if path in self.paths]
+        return sorted(found, key=lambda file: file.index)
+
     def play(self):
         row = self.result_list.currentRow()
         index = self.founded_files[row].index
-        self.window.audio_list_widget.setCurrentRow(index)
+        self.window.set_current_row(index)
         self.window.play_row = True
         self.window.play_pause()
 
         return index
 
     def index_files(self):
+        # file actions are off while searching, the paths stay valid
+        self.paths = {}
         for (i, file) in enumerate(self.files):
             file.index = i
+            if self.window.database:
+                self.paths[os.path.abspath(file.path())] = file
 
     def closeEvent(self, event):
         self.window.delete_file_action.setEnabled(True)
@@ -1148,7 +1457,8 @@ class ClusteringWindow(QtWidgets.QWidget):
         self.window = window
         self.audio_list = self.window.current_playlist
         self.audio_features_list = []
-        self.number = 2 if len(self.audio_list) < 10 else 10
+        self.features_key = None
+        self.analysis = None
         self._init_ui()
 
     def _init_ui(self):
@@ -1158,60 +1468,86 @@ class ClusteringWindow(QtWidgets.QWidget):
 
         self.find_similar_files_btn = \
             QtWidgets.QPushButton('Find similar files')
-        self.find_similar_files_btn.clicked.connect(self.find_clusters)
+        self.find_similar_files_btn.clicked.connect(self.find_similar)
+
+        self.top_label = QtWidgets.QLabel('Count')
+        self.top_number = QtWidgets.QSpinBox()
+        self.top_number.setRange(1, max(1, len(self.audio_list) - 1))
+        self.top_number.setValue(min(10, self.top_number.maximum()))
 
         self.progressbar = QtWidgets.QProgressBar(self)
         self.progressbar.setMaximum(len(self.audio_list) - 1)
 
         self.similar_files_widget = QtWidgets.QListWidget()
 
+        hbox = QtWidgets.QHBoxLayout()
+        hbox.addWidget(self.find_similar_files_btn)
+        hbox.addWidget(self.top_label)
+        hbox.addWidget(self.top_number)
+
         vbox = QtWidgets.QVBoxLayout()
-        vbox.addWidget(self.find_similar_files_btn)
+        vbox.addLayout(hbox)
         vbox.addWidget(self.progressbar)
         vbox.addWidget(self.similar_files_widget)
         self.setLayout(vbox)
 
-    def find_clusters(self):
-        self.i = 0
-
-        self.thread = AudioAnalysisThread(self)
-        self.thread.start()
+    def find_similar(self):
+        index = self.window.similarity_index
+        if index and index.key == self.features_key:
+            self.show_similar()
+            return
+        if self.analysis:
+            return
 
-        self.thread.finished.connect(self.process_finished)
-        self.thread.audio_processed.connect(self.change_progressbar)
+        self.analysis = start_analysis(self)
 
-    def change_progressbar(self):
-        self.progressbar.setValue(self.i)
-        self.i += 1
+    def change_progressbar(self, done, total):
+        self.progressbar.setValue(done)
 
     def process_finished(self):
-        features_dict = {features.audio_file: features
-                         for features in self.audio_features_list}
-
-        self.clusters = clustering.clusters(
-            self.audio_features_list, self.number)
-
-        audio = self.audio_list[self.window.audio_list_widget.currentRow()]
-        features = features_dict[audio]
-
-        cluster_index = features.cluster_index
-
-        self.similar_audio = self.clusters[cluster_index]
-
+        analysis, self.analysis = self.analysis, None
+        if analysis.cancelled():
+            return
+        self.audio_features_list, self.features_key = analysis.result()
+        self.progressbar.setValue(self.progressbar.maximum())
+        index = self.window.similarity_index
+        if not index or index.key != self.features_key:
+            self.window.similarity_index = clustering.SimilarityIndex(
+                self.audio_features_list, self.features_key)
+        self.show_similar()
+
+    def show_similar(self):
+        audio = self.window.playing_files[
+            self.window.current_row()]
+        features = self.window.AUDIO_FEATURES.get(audio.path())
         self.similar_files_widget.clear()
-
+        if features is None:
+            return
+        self.similar_audio = self.window.similarity_index.similar(
+            features, self.top_number.value())
         self.similar_files_widget.addItems(
-            [item.audio_file.name for item in self.similar_audio
-             if item.audio_file != audio])
+            ['{}  ({:.2f})'.format(item.audio_file.name, distance)
+             for item, distance in self.similar_audio])
+
+    def closeEvent(self, event):
+        if self.analysis:
+            self.analysis.cancel()
 
 
 class AllClustersWindow(QtWidgets.QWidget):
+    MAX_SWEEP_CLUSTERS = 20
+
     def __init__(self, window):
         super().__init__()
         self.window = window
         self.audio_list = self.window.current_playlist
         self.audio_features_list = []
+        self.features_key = None
+        self.features_ready = False
         self.number = 0
+        self.analysis = None
+        self.fitting = None
+        self.sweep = None
         self._init_ui()
 
     def _init_ui(self):
@@ -1225,8 +1561,14 @@ class AllClustersWindow(QtWidgets.QWidget):
         self.progressbar = QtWidgets.QProgressBar(self)
         self.progressbar.setMaximum(len(self.audio_list) - 1)
 
+        self.input_timer = QtCore.QTimer(self)
+        self.input_timer.setSingleShot(True)
+        self.input_timer.timeout.connect(self.find_clusters)
+
         self.clusters_number_edit = QtWidgets.QLineEdit(self)
-        self.clusters_number_edit.textChanged.connect(self.find_clusters)
+        self.clusters_number_edit.textChanged.connect(self.number_changed)
+
+        self.score_label = QtWidgets.QLabel('')
 
         self.cluster_list_widget = QtWidgets.QListWidget()
         self.cluster_list_widget.itemClicked.connect(self.show_result)
@@ -1243,13 +1585,16 @@ class AllClustersWindow(QtWidgets.QWidget):
         vbox = QtWidgets.QVBoxLayout()
         vbox.addLayout(hbox2)
         vbox.addWidget(self.progressbar)
+        vbox.addWidget(self.score_label)
         vbox.addLayout(hbox1)
         self.setLayout(vbox)
 
-    def find_clusters(self, n):
-        self.number = 0
+    def number_changed(self):
+        self.input_timer.start(300)
+
+    def find_clusters(self):
         try:
-            self.number = int(n)
+            self.number = int(self.clusters_number_edit.text())
         except ValueError:
             self.number = 0
             return
@@ -1257,28 +1602,74 @@ class AllClustersWindow(QtWidgets.QWidget):
         if self.number > len(self.audio_list):
             self.clusters_number_edit.setText(
                 'Количество кластеров не должно быть больше количества песен')
+            return
 
-        self.i = 0
-
-        self.thread = AudioAnalysisThread(self)
-        self.thread.start()
+        if self.features_ready:
+            self.show_clusters()
+            return
+        if self.analysis:
+            return
 
-        self.thread.finished.connect(self.process_finished)
-        self.thread.audio_processed.connect(self.change_progressbar)
+        self.analysis = start_analysis(self)
 
-    def change_progressbar(self):
-        self.progressbar.setValue(self.i)
-        self.i += 1
+    def change_progressbar(self, done, total):
+        self.progressbar.setValue(done)
 
     def process_finished(self):
+        analysis, self.analysis = self.analysis, None
+        if analysis.cancelled():
+            return
+        self.audio_features_list, self.features_key = analysis.result()
         self.progressbar.setValue(self.progressbar.maximum())
-        self.clusters = clustering.clusters(
-            self.audio_features_list, self.number)
+        self.features_ready = True
+        self.show_clusters()
+
+        self.sweep = BackgroundTask(
+            clustering.sweep, self.audio_features_list,
+            range(2, self.MAX_SWEEP_CLUSTERS + 1),
+            self.window.cluster_models, self.features_key)
+        self.sweep.progress.connect(lambda k, last_k: self.show_score(k))
+        self.sweep.start()
+
+    def show_clusters(self):
+        if self.number < 1:
+            return
+        if not self.window.cluster_models.cached(
+                self.audio_features_list, self.number, self.features_key):
+            if not self.fitting:
+                self.fitting = BackgroundTask(
+                    fit_clusters, self.window.cluster_models,
+                    self.audio_features_list, self.number, self.features_key)
+                self.fitting.done.connect(self.process_fitted)
+                self.fitting.start()
+            return
+        self.clusters = self.window.cluster_models.clusters(
+            self.audio_features_list, self.number, self.features_key)
 
         self.cluster_content_widget.clear()
         self.cluster_list_widget.clear()
         self.cluster_list_widget.addItems(
             map(str, list(range(0, len(self.clusters)))))
+        self.show_score(self.number)
+
+    def process_fitted(self):
+        fitting, self.fitting = self.fitting, None
+        if fitting.cancelled():
+            return
+        # the number may have changed during the fit, this shows it or
+        # starts the next fit
+        self.show_clusters()
+
+    def show_score(self, k):
+        if k != self.number or not self.window.cluster_models.cached(
+                self.audio_features_list, k, self.features_key):
+            return
+        model = self.window.cluster_models.get(
+            self.audio_features_list, self.number, key=self.features_key)
+        text = 'inertia: {:.1f}'.format(model.inertia)
+        if model.silhouette is not None:
+            text += '   silhouette: {:.3f}'.format(model.silhouette)
+        self.score_label.setText(text)
 
     def show_result(self):
         cluster_number = int(self.cluster_list_widget.currentItem().text())
@@ -1286,51 +1677,128 @@ class AllClustersWindow(QtWidgets.QWidget):
         self.cluster_content_widget.addItems(
             [item.audio_file.name for item in self.clusters[cluster_number]])
 
+    def closeEvent(self, event):
+        if self.analysis:
+            self.analysis.cancel()
+        if self.fitting:
+            self.fitting.cancel()
+        if self.sweep:
+            self.sweep.cancel()
 
-class AudioAnalysisThread(QtCore.QThread):
-    audio_processed = QtCore.pyqtSignal()
-    finished = QtCore.pyqtSignal()
 
-    def __init__(self, window):
+class BackgroundTask(QtCore.QObject):
+    progress = QtCore.pyqtSignal(int, int)
+    done = QtCore.pyqtSignal()
+
+    def __init__(self, func, *args, **kwargs):
         super().__init__()
-        self.window = window
+        self.task = tasks.Task(func, *args, progress=self.progress.emit,
+                               **kwargs)
+        self.task.add_done_callback(lambda task: self.done.emit())
+
+    def start(self):
+        self.task.start()
 
-    def run(self):
-        for audio in self.window.audio_list:
-            if audio.meta.duration < 30.0:
-                pass
-            elif audio.path in self.window.window.AUDIO_FEATURES:
-                self.window.audio_features_list.append(
-                    self.window.window.AUDIO_FEATURES[audio.path])
-            else:
-                features = clustering.get_features(audio)
-                self.window.window.AUDIO_FEATURES[audio.path] = features
-                self.window.audio_features_list.append(features)
-            self.audio_processed.emit()
-        self.finished.emit()
+    def cancel(self):
+        self.task.cancel()
+
+    def cancelled(self):
+        return self.task.cancelled()
+
+    def result(self):
+        return self.task.result()
+
+
+def start_analysis(window):
+    analysis = BackgroundTask(
+        collect_keyed_features, window.audio_list,
+        window.window.AUDIO_FEATURES, window.window.fast_analysis,
+        database=window.window.database)
+    analysis.progress.connect(window.change_progressbar)
+    analysis.done.connect(window.process_finished)
+    analysis.start()
+    return analysis
+
+
+def collect_keyed_features(audio_files, features_cache, fast=False,
+                           task=None, database=None):
+    # the feature set key hashes every path, it is computed once here
+    # instead of on every lookup from the GUI thread
+    features_list = clustering.collect_features(
+        audio_files, features_cache, fast, task, database)
+    return features_list, clustering.feature_set_key(features_list)
+
+
+def fit_clusters(cache, features_list, n, key, task=None):
+    return cache.get(features_list, n, key=key)
+
+
+def make_auto_albums(audio_files, task=None):
+    album_maker = albumsys.AutoAlbumsMaker(audio_files)
+    album_maker.make_all_albums(task)
+    return album_maker
+
+
+def scan_library(args):
+    source = args.library or args.directory
+    scan = BackgroundTask(cli.find_files, args)
+    dialog = QtWidgets.QProgressDialog('Scanning {}'.format(source),
+                                       'Cancel', 0, 0)
+    dialog.setWindowTitle('audioplayer')
+    scan.progress.connect(
+        lambda done, total: dialog.setLabelText(
+            'Scanning {}: {} files'.format(source, done)))
+    scan.done.connect(dialog.accept)
+    dialog.canceled.connect(scan.cancel)
+    scan.start()
+    dialog.exec_()
+    if scan.cancelled():
+        return None
+    return scan.result()
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description='audioplayer')
-    parser.add_argument(
-        '-s', '--subdir', action='store_true', dest='subdirs',
-        help='search in subdirectories')
-    parser.add_argument('-d', '--directory', default=Path.home(),
-                        help='music directory (default: home directory)')
-    parser.add_argument('-f', '--formats', nargs='+', default=['mp3'],
-                        help='required audio formats (default: mp3)')
+    parser = argparse.ArgumentParser(description='audioplayer',
+                                     parents=[cli.options_parser()])
+    cli.add_library_args(parser)
+    parser.add_argument('-c', '--cluster-backend', default='kmeans',
+                        choices=list(clustering.BACKENDS),
+                        help='clustering algorithm (default: kmeans)')
+    parser.add_argument('--fast-analysis', action='store_true',
+                        help='decode only the analysed window natively '
+                             'and decimate it')
+    parser.add_argument('-g', '--gapless', action='store_true',
+                        help='preload the next track for gapless playback')
+    parser.add_argument('--decoded-cache', type=int, default=0, metavar='MB',
+                        help='memory for decoded recent tracks, used for '
+                             'seek and replay without decoding or copying '
+                             '(default: 0, off)')
+    parser.add_argument('-a', '--audio-backend', default='pygame',
+                        choices=list(playback.BACKENDS),
+                        help='audio output (default: pygame, null: silent)')
+    parser.add_argument('-n', '--normalize', action='store_true',
+                        help='analyse track loudness in the background and '
+                             'even out the volume between tracks')
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    audio_files = files.find_audio_files(
-        args.directory, args.subdirs, args.formats)
-
-    app = QtWidgets.QApplication(sys.argv)
-    album_win = PlayerWindow(audio_files)
-    album_win.show()
-    sys.exit(app.exec_())
+    with metrics.profiled(args.profile):
+        app = QtWidgets.QApplication(sys.argv)
+        library_database = cli.open_database(args)
+        audio_files = scan_library(args)
+        if audio_files is None:
+            return
+        album_win = PlayerWindow(
+            audio_files, args.cluster_backend, args.fast_analysis,
+            args.gapless, args.decoded_cache * 1024 ** 2, args.audio_backend,
+            args.normalize, library_database)
+        album_win.show()
+        exit_code = app.exec_()
+    if args.metrics:
+        metrics.METRICS.dump(args.metrics)
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,9 @@
-from . import files
+from . import files, metrics, tasks
 import os
+import collections
 
 NAME_EXIST_ERROR = 1
+ALBUM_TYPES = ['artist', 'album', 'genre', 'year']
 
 
 class Album:
@@ -61,8 +63,22 @@ class AlbumItem:
 
 
 class AlbumEditor:
-    def __init__(self):
+    def __init__(self, database=None):
         self.albums = {}
+        self.removed_items = {}
+        self.database = database
+        # the stored albums are loaded by a background task on request
+        self.database_loaded = False
+
+    def save_to_database(self):
+        if not self.database_loaded:
+            # saving replaces the stored albums, the ones never loaded here
+            # are kept unless an album of the same name replaces them
+            albums = self.database.load_albums()
+            albums.update(self.albums)
+            self.albums = albums
+            self.database_loaded = True
+        self.database.save_albums(self.albums)
 
     def add_album(self, album):
         self.albums[album.album_name] = album
@@ -77,15 +93,47 @@ class AlbumEditor:
     def change_song_name(self, album_name, song_index, new_song_name):
         self.albums[album_name].change_item_name(song_index, new_song_name)
 
+    def apply_changes(self, changes):
+        items = collections.defaultdict(list)
+        for album in self.albums.values():
+            for item in album.album_items:
+                items[item.audio_file.path()].append((album, item))
+        for change in changes:
+            if change.old_path is None:
+                for album, index, item in self.removed_items.pop(
+                        change.new_path, []):
+                    album.album_items.insert(index, item)
+                continue
+            for album, item in items.get(change.old_path, []):
+                if change.new_path is None:
+                    index = album.album_items.index(item)
+                    album.album_items.pop(index)
+                    self.removed_items.setdefault(
+                        change.old_path, []).append((album, index, item))
+                    continue
+                audio = item.audio_file
+                audio.directory, audio.file_name = \
+                    os.path.split(change.new_path)
+                audio.name = os.path.splitext(audio.file_name)[0]
+
+    def forget_removed(self, paths):
+        # the journal can no longer undo these deletions
+        for path in paths:
+            self.removed_items.pop(path, None)
+
+    @metrics.timed('album_save')
     def save_albums(self):
         saved_albums = ''
         for name, album in self.albums.items():
             saved_albums += album.save_album()
         return saved_albums
 
-    def load_albums(self, albums_str):
+    @metrics.timed('album_load')
+    def load_albums(self, albums_str, task=None):
         albums_str_list = albums_str.split('\n\n\n\n')
-        for album_str in albums_str_list:
+        loaded_albums = []
+        for i, album_str in enumerate(albums_str_list):
+            tasks.report(task, i, len(albums_str_list))
             album_items = []
             info = album_str.split('\n\n')
             album_name = info[0]
@@ -93,6 +141,7 @@ class AlbumEditor:
                 continue
             info.pop(0)
             for song in info:
+                tasks.report(task, i, len(albums_str_list))
                 song_info = song.split('::')
                 path = song_info[0]
                 name = song_info[1]
@@ -103,10 +152,27 @@ class AlbumEditor:
                 album_item = AlbumItem(audio)
                 album_item.name = name
                 album_items.append(album_item)
-            album = Album(album_name, album_items)
+            loaded_albums.append(Album(album_name, album_items))
+        for album in loaded_albums:
             self.add_album(album)
 
 
+def load_albums_file(filename, task=None):
+    # albums are separated by '\n\r', which universal newlines would mangle
+    with open(filename, 'rt', newline='') as f:
+        albums_str = f.read().replace('\r', '\n')
+    editor = AlbumEditor()
+    editor.load_albums(albums_str, task)
+    return editor
+
+
+def load_albums_database(database, task=None):
+    editor = AlbumEditor(database)
+    editor.albums = database.load_albums(task)
+    editor.database_loaded = True
+    return editor
+
+
 class AutoAlbumsMaker:
     def __init__(self, audio_files):
         self.audio_files = audio_files
@@ -123,13 +189,18 @@ class AutoAlbumsMaker:
                 clear_files.append(file)
         self.audio_files = clear_files
 
-    def make_albums(self, info):
+    def make_all_albums(self, task=None):
+        for info in ALBUM_TYPES:
+            self.make_albums(info, task)
+
+    def make_albums(self, info, task=None):
         key = '{}_albums_dict'.format(info)
         if key not in dir(self):
             return
         info_dict = getattr(self, key)
         clear_files = self.get_files_with_attr(info)
-        for file in clear_files:
+        for i, file in enumerate(clear_files):
+            tasks.report(task, i, len(clear_files))
             file_info = getattr(file.meta, info)
             if file_info not in info_dict:
                 info_dict[file_info] = []
@@ -151,7 +222,7 @@ class AutoAlbumsMaker:
     def get_required_albums(self, *albums, all_albums=False):
         required_albums = {}
         if all_albums:
-            albums = ['artist', 'album', 'genre', 'year']
+            albums = ALBUM_TYPES
         for album in albums:
             key = '{}_albums_dict'.format(album)
             if key not in dir(self):
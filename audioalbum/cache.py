@@ -0,0 +1,80 @@
+import os
+import shelve
+import sys
+import threading
+
+
+def cache_directory():
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.expanduser('~/.cache')
+    return os.path.join(base, 'audioalbum')
+
+
+def default_filename():
+    directory = cache_directory()
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, 'metadata')
+
+
+class MetadataCache:
+    def __init__(self, filename):
+        self.db = shelve.open(filename)
+        self.lock = threading.Lock()
+
+    def _stamp(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, path, key):
+        stamp = self._stamp(path)
+        with self.lock:
+            if self.db is None:
+                return None
+            entry = self.db.get(path)
+        if entry is None or entry['stamp'] != stamp:
+            return None
+        return entry.get(key)
+
+    def put(self, path, key, value):
+        stamp = self._stamp(path)
+        if stamp is None:
+            return
+        with self.lock:
+            if self.db is None:
+                return
+            entry = self.db.get(path)
+            if entry is None or entry['stamp'] != stamp:
+                entry = {'stamp': stamp}
+            entry[key] = value
+            self.db[path] = entry
+
+    def remove(self, path):
+        with self.lock:
+            if self.db is not None and path in self.db:
+                del self.db[path]
+
+    def apply_changes(self, changes):
+        with self.lock:
+            if self.db is None:
+                return
+            for change in changes:
+                if change.old_path is None or change.old_path not in self.db:
+                    continue
+                entry = self.db[change.old_path]
+                del self.db[change.old_path]
+                if change.new_path is not None:
+                    self.db[change.new_path] = entry
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,252 @@
+import argparse
+import contextlib
+import csv
+import json
+import sys
+from pathlib import Path
+from audioalbum import files, albumsys, clustering, metrics, library, \
+    database
+
+COMMANDS = ['scan', 'dupes', 'auto-albums', 'cluster', 'export']
+OUTPUT_FORMATS = ['json', 'csv']
+
+
+def is_command(argv):
+    return len(argv) > 0 and argv[0] in COMMANDS
+
+
+def file_record(audio):
+    meta = audio.meta
+    return {
+        'path': audio.path(),
+        'name': audio.name,
+        'title': meta.title if meta else None,
+        'artist': meta.artist if meta else None,
+        'album': meta.album if meta else None,
+        'genre': meta.genre if meta else None,
+        'year': meta.year if meta else None,
+        'duration': meta.duration if meta else None,
+        'approximate_duration': audio.approximate_duration,
+        'filesize': meta.filesize if meta else None,
+    }
+
+
+def scan(args):
+    return [file_record(audio) for audio in find_files(args)]
+
+
+def dupes(args):
+    records = []
+    # hashing overlaps the scan only when reads are concurrent; both hash
+    # just the files whose size collides with another one
+    audio_files = find_files(args, hash_files=args.jobs > 1)
+    repetitions = files.find_all_repetitions(audio_files)
+    if args.library_database:
+        args.library_database.store_hashes(audio_files)
+    for name, same_files in repetitions.items():
+        for audio in same_files:
+            records.append({'group': name, 'path': audio.path()})
+    return records
+
+
+def auto_albums(args):
+    maker = albumsys.AutoAlbumsMaker(find_files(args))
+    records = []
+    for album_type in args.by:
+        maker.make_albums(album_type)
+        for album in maker.get_required_albums(album_type).values():
+            records += album_records(album, album_type)
+    return records
+
+
+def cluster(args):
+    features_list = clustering.collect_features(
+        find_files(args), {}, args.fast_analysis,
+        database=args.library_database)
+    if len(features_list) < args.clusters:
+        raise SystemExit('not enough audio files for {} clusters'.format(
+            args.clusters))
+    records = []
+    result = clustering.clusters(features_list, args.clusters,
+                                 args.cluster_backend)
+    for cluster_index, cluster_features in enumerate(result):
+        for features in cluster_features:
+            records.append({'cluster': cluster_index,
+                            'path': features.audio_file.path()})
+    return records
+
+
+def export(args):
+    if args.library_database:
+        editor = albumsys.load_albums_database(args.library_database)
+    else:
+        editor = albumsys.load_albums_file(args.albums)
+    records = []
+    for album in editor.albums.values():
+        records += album_records(album)
+    return records
+
+
+def album_records(album, album_type=None):
+    records = []
+    for item in album.album_items:
+        record = {'album': album.album_name, 'path': item.audio_file.path(),
+                  'name': item.name}
+        if album_type is not None:
+            record = {'type': album_type, **record}
+        records.append(record)
+    return records
+
+
+def library_roots(args):
+    try:
+        if not args.library:
+            return [library.LibraryRoot(args.directory, args.formats,
+                                        args.subdirs, args.jobs)]
+        return library.load_config(args.library)
+    except (OSError, ValueError) as e:
+        raise SystemExit(e)
+
+
+def find_files(args, hash_files=False, task=None):
+    tag_budget = files.TAG_READ_BUDGET if args.fast_tags else None
+    return library.scan_roots(library_roots(args), task, tag_budget,
+                              hash_files, args.library_database,
+                              not args.no_rescan)
+
+
+def write_records(records, output_format, stream):
+    if output_format == 'json':
+        json.dump(records, stream, ensure_ascii=False, indent=2)
+        stream.write('\n')
+        return
+    if not records:
+        return
+    writer = csv.DictWriter(stream, fieldnames=list(records[0]))
+    writer.writeheader()
+    writer.writerows(records)
+
+
+def add_library_args(parser):
+    parser.add_argument(
+        '-s', '--subdir', action='store_true', dest='subdirs',
+        help='search in subdirectories')
+    parser.add_argument('-d', '--directory', default=Path.home(),
+                        help='music directory (default: home directory)')
+    parser.add_argument('-f', '--formats', nargs='+', default=['mp3'],
+                        help='required audio formats (default: mp3)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='concurrent file reads while scanning, '
+                             'useful on network shares (default: 1)')
+    parser.add_argument('--fast-tags', action='store_true',
+                        help='read only the tag headers, at most {} KiB '
+                             'per file, and estimate MP3 durations'.format(
+                                 files.TAG_READ_BUDGET // 1024))
+    parser.add_argument('-l', '--library', metavar='CONFIG',
+                        help='JSON library config with several roots, each '
+                             'with its own directory, formats, subdirs, '
+                             'jobs and exclude globs; replaces -d, -f, -s '
+                             'and -j')
+    parser.add_argument('--no-rescan', action='store_true',
+                        help='take the library from --database without '
+                             'walking the directories')
+
+
+def options_parser():
+    # options shared by the commands and the player
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--database', metavar='FILE',
+                        help='SQLite library database keeping tags, hashes, '
+                             'audio features and albums between runs')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write cProfile statistics to FILE '
+                             '(open with pstats)')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write operation timings and counters to FILE, '
+                             'as JSON if it ends with .json, otherwise in '
+                             'Prometheus text format')
+    return parser
+
+
+def parse_args(argv):
+    output_parser = argparse.ArgumentParser(add_help=False,
+                                            parents=[options_parser()])
+    output_parser.add_argument('-o', '--output-format', default='json',
+                               choices=OUTPUT_FORMATS,
+                               help='output format (default: json)')
+    parser = argparse.ArgumentParser(
+        prog='album.py', description='audio library batch commands')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan_parser = subparsers.add_parser(
+        'scan', parents=[output_parser],
+        help='list audio files with their tags')
+    add_library_args(scan_parser)
+    scan_parser.set_defaults(func=scan)
+
+    dupes_parser = subparsers.add_parser(
+        'dupes', parents=[output_parser],
+        help='find files with identical contents')
+    add_library_args(dupes_parser)
+    dupes_parser.set_defaults(func=dupes)
+
+    auto_parser = subparsers.add_parser(
+        'auto-albums', parents=[output_parser],
+        help='group files into albums by tag')
+    add_library_args(auto_parser)
+    auto_parser.add_argument('-b', '--by', nargs='+',
+                             default=albumsys.ALBUM_TYPES,
+                             choices=albumsys.ALBUM_TYPES,
+                             help='tags to group by (default: all)')
+    auto_parser.set_defaults(func=auto_albums)
+
+    cluster_parser = subparsers.add_parser(
+        'cluster', parents=[output_parser],
+        help='cluster files by audio features')
+    add_library_args(cluster_parser)
+    cluster_parser.add_argument('-n', '--clusters', type=int, default=10,
+                                help='number of clusters (default: 10)')
+    cluster_parser.add_argument('-c', '--cluster-backend', default='kmeans',
+                                choices=list(clustering.BACKENDS),
+                                help='clustering algorithm (default: kmeans)')
+    cluster_parser.add_argument('--fast-analysis', action='store_true',
+                                help='decode only the analysed window '
+                                     'natively and decimate it')
+    cluster_parser.set_defaults(func=cluster)
+
+    export_parser = subparsers.add_parser(
+        'export', parents=[output_parser],
+        help='export saved albums')
+    export_parser.add_argument('-a', '--albums', default='saved_albums.txt',
+                               help='saved albums file '
+                                    '(default: saved_albums.txt)')
+    export_parser.set_defaults(func=export)
+
+    return parser.parse_args(argv)
+
+
+def open_database(args):
+    args.library_database = None
+    if args.database:
+        args.library_database = database.LibraryDatabase(args.database)
+    return args.library_database
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    open_database(args)
+    try:
+        with metrics.profiled(args.profile), \
+                contextlib.redirect_stdout(sys.stderr):
+            records = args.func(args)
+    finally:
+        if args.library_database:
+            args.library_database.close()
+    write_records(records, args.output_format, sys.stdout)
+    if args.metrics:
+        metrics.METRICS.dump(args.metrics)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
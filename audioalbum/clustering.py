@@ -1,6 +1,18 @@
-import librosa
-from collections import defaultdict
-from sklearn.cluster import KMeans
+import copy
+import hashlib
+import threading
+import numpy as np
+import soundfile
+from audioalbum import metrics, tasks
+
+FEATURES_VERSION = 2
+SAMPLE_RATE = 10000
+ANALYSIS_OFFSET = 60.0
+ANALYSIS_DURATION = 30.0
+MFCC_COUNT = 13
+# rms mean/std, centroid mean/std, mfcc means and stds, tempo
+FEATURES_COUNT = 2 + 2 + 2 * MFCC_COUNT + 1
+SILHOUETTE_SAMPLE_SIZE = 5000
 
 
 def audio_features_generator(audio_files):
@@ -13,36 +25,339 @@ def get_audio_features_dict(audio_files):
     return features_dict
 
 
-def get_features(audio_file):
-    return AudioFileFeatures(audio_file)
+def get_features(audio_file, fast=False):
+    return AudioFileFeatures(audio_file, fast)
 
 
-def clusters(features_list, n):
-    coordinates = [features.rms for features in features_list]
+def collect_features(audio_files, features_cache, fast=False, task=None,
+                     database=None):
+    features_list = []
+    for i, audio in enumerate(audio_files):
+        tasks.report(task, i, len(audio_files))
+        path = audio.path()
+        if path not in features_cache:
+            features_cache[path] = stored_features(audio, fast, database)
+        features_list.append(features_cache[path])
+    return features_list
 
-    kmeans = KMeans(n_clusters=n, n_init=20, max_iter=1000)
-    res = kmeans.fit(coordinates)
 
-    result_clusters = [[] for _ in range(n)]
+def stored_features(audio, fast=False, database=None):
+    if database is None:
+        return get_features(audio, fast)
+    vector = database.load_features(audio, fast)
+    if vector is not None:
+        return AudioFileFeatures(audio, fast, vector)
+    features = get_features(audio, fast)
+    database.store_features(audio, features.vector, fast)
+    return features
+
+
+def decimate(y, factor):
+    if factor <= 1:
+        return y
+    length = len(y) // factor * factor
+    return y[:length].reshape(-1, factor).mean(axis=1)
+
+
+def resample(y, sr, target_sr):
+    if sr == target_sr or len(y) == 0:
+        return y
+    positions = np.arange(int(len(y) * target_sr / sr)) * (sr / target_sr)
+    return np.interp(positions, np.arange(len(y)), y).astype(np.float32)
+
 
+def load_window(path, offset, duration, sr=SAMPLE_RATE):
+    with soundfile.SoundFile(path) as f:
+        native_sr = f.samplerate
+        start = min(int(offset * native_sr), f.frames)
+        f.seek(start)
+        frames = -1 if duration is None else int(duration * native_sr)
+        data = f.read(frames, dtype='float32', always_2d=True)
+    factor = max(1, native_sr // sr)
+    # integer decimation lands near sr (44100 Hz gives 11025 Hz), the rest
+    # is interpolated so fast features match the ones librosa produces
+    y = decimate(data.mean(axis=1), factor)
+    return resample(y, native_sr // factor, sr), sr
+
+
+def load_audio(path, offset, duration, fast=False):
+    if fast:
+        try:
+            return load_window(path, offset, duration)
+        except RuntimeError:
+            pass
+    import librosa
+    return librosa.load(path, sr=SAMPLE_RATE, mono=True, offset=offset,
+                        duration=duration, res_type='kaiser_fast')
+
+
+def features_matrix(features_list):
+    matrix = np.empty((len(features_list), FEATURES_COUNT), dtype=np.float32)
     for i, features in enumerate(features_list):
-        cluster_index = res.labels_[i]
+        matrix[i] = features.vector
+    return matrix
+
+
+def feature_set_key(features_list):
+    m = hashlib.md5(str(FEATURES_VERSION).encode())
+    for features in features_list:
+        m.update(features.audio_file.path().encode('utf-8', 'replace'))
+        m.update(b'\1' if features.fast else b'\0')
+    return m.hexdigest()
+
+
+def kmeans(n):
+    from sklearn.cluster import KMeans
+    return KMeans(n_clusters=n, n_init=20, max_iter=1000)
+
+
+def minibatch_kmeans(n):
+    from sklearn.cluster import MiniBatchKMeans
+    return MiniBatchKMeans(n_clusters=n, n_init=3, batch_size=1024)
+
+
+BACKENDS = {
+    'kmeans': kmeans,
+    'minibatch': minibatch_kmeans,
+}
+
+
+class ClusterModel:
+    def __init__(self, n, backend='kmeans'):
+        self.n = n
+        self.backend = backend
+        self.estimator = BACKENDS[backend](n)
+        self.mean = None
+        self.std = None
+        self.labels = None
+        self.inertia = None
+        self.silhouette = None
+
+    @property
+    def incremental(self):
+        return hasattr(self.estimator, 'partial_fit')
+
+    @metrics.timed('cluster_fit')
+    def fit(self, matrix):
+        self._set_scale(matrix)
+        self.estimator.fit(self._scale(matrix))
+        self.labels = self.estimator.labels_
+        self.inertia = self.estimator.inertia_
+        return self
+
+    def score(self, matrix):
+        if not 1 < self.n < len(matrix):
+            return None
+        from sklearn.metrics import silhouette_score
+        self.silhouette = silhouette_score(
+            self._scale(matrix), self.labels,
+            sample_size=min(len(matrix), SILHOUETTE_SAMPLE_SIZE),
+            random_state=0)
+        return self.silhouette
+
+    @metrics.timed('cluster_partial_fit')
+    def partial_fit(self, matrix):
+        if self.mean is None:
+            self._set_scale(matrix)
+        self.estimator.partial_fit(self._scale(matrix))
+        return self
+
+    def predict(self, matrix):
+        return self.estimator.predict(self._scale(matrix))
+
+    def relabel(self, matrix):
+        # after partial_fit the estimator only has the labels of the last
+        # batch, the whole set is assigned to the moved centroids
+        scaled = self._scale(matrix)
+        self.labels = self.estimator.predict(scaled)
+        self.inertia = -self.estimator.score(scaled)
+        self.silhouette = None
+        return self.labels
+
+    def _set_scale(self, matrix):
+        self.mean = matrix.mean(axis=0)
+        self.std = matrix.std(axis=0)
+        self.std[self.std == 0] = 1
+
+    def _scale(self, matrix):
+        return (matrix - self.mean) / self.std
+
+
+def fit_model(features_list, n, backend='kmeans'):
+    return ClusterModel(n, backend).fit(features_matrix(features_list))
+
+
+def clusters(features_list, n, backend='kmeans'):
+    model = fit_model(features_list, n, backend)
+    return group(features_list, model.labels, n)
+
+
+def update(features_list, model, new_features=(), matrix=None):
+    # features_list is the whole set, new_features the tracks the model
+    # has not seen yet
+    if matrix is None:
+        matrix = features_matrix(features_list)
+    if model.incremental and new_features:
+        model.partial_fit(features_matrix(new_features))
+    labels = model.relabel(matrix)
+    for features, cluster_index in zip(features_list, labels):
+        features.cluster_index = cluster_index
+    return labels
+
+
+def group(features_list, labels, n):
+    result_clusters = [[] for _ in range(n)]
+
+    for features, cluster_index in zip(features_list, labels):
         features.cluster_index = cluster_index
         result_clusters[cluster_index].append(features)
 
     return result_clusters
 
 
+class ModelCache:
+    def __init__(self, backend='kmeans'):
+        self.backend = backend
+        self.models = {}
+        self.fitting = {}
+        # k -> (key, paths) of the last model fitted for k
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    # hashing every path is linear in the library, callers that ask for
+    # several k compute feature_set_key once and pass it as key
+
+    def get(self, features_list, n, matrix=None, key=None):
+        if key is None:
+            key = feature_set_key(features_list)
+        key = (key, n)
+        with self.lock:
+            fitting = self.fitting.setdefault(key, threading.Lock())
+        # the sweep and the window can ask for the same k at once, the
+        # second one waits for the first fit instead of repeating it
+        with fitting:
+            if key not in self.models:
+                if matrix is None:
+                    matrix = features_matrix(features_list)
+                self.models[key] = self._fit(features_list, n, key[0],
+                                             matrix)
+        return self.models[key]
+
+    def _fit(self, features_list, n, key, matrix):
+        paths = {features.audio_file.path() for features in features_list}
+        with self.lock:
+            latest_key, latest_paths = self.latest.get(n, (None, set()))
+            model = self.models.get((latest_key, n))
+            self.latest[n] = key, paths
+        # an incremental model follows a changed library: new tracks move
+        # the centroids, every track is assigned again; a mostly new
+        # library is fitted from scratch
+        if model is None or not model.incremental \
+                or len(paths & latest_paths) * 2 < len(paths):
+            return ClusterModel(n, self.backend).fit(matrix)
+        model = copy.deepcopy(model)
+        update(features_list, model,
+               [features for features in features_list
+                if features.audio_file.path() not in latest_paths],
+               matrix)
+        return model
+
+    def cached(self, features_list, n, key=None):
+        if key is None:
+            key = feature_set_key(features_list)
+        return (key, n) in self.models
+
+    def clusters(self, features_list, n, key=None):
+        model = self.get(features_list, n, key=key)
+        return group(features_list, model.labels, n)
+
+
+def sweep(features_list, k_values, cache, key=None, task=None):
+    if key is None:
+        key = feature_set_key(features_list)
+    matrix = features_matrix(features_list)
+    models = {}
+    # the progress is the last k fitted, so it can be shown right away
+    last_k = max(k_values, default=0)
+    for k in k_values:
+        if k > len(features_list):
+            break
+        model = cache.get(features_list, k, matrix, key)
+        if model.silhouette is None:
+            model.score(matrix)
+        models[k] = model
+        tasks.report(task, k, last_k)
+    return models
+
+
+class SimilarityIndex:
+    def __init__(self, features_list, key=None):
+        self.features_list = list(features_list)
+        self.key = key if key is not None else \
+            feature_set_key(self.features_list)
+        self.rows = {features.audio_file: i
+                     for i, features in enumerate(self.features_list)}
+        matrix = features_matrix(self.features_list)
+        self.mean = matrix.mean(axis=0)
+        self.std = matrix.std(axis=0)
+        self.std[self.std == 0] = 1
+        self.vectors = self._normalize(matrix)
+
+    def _normalize(self, matrix):
+        matrix = (matrix - self.mean) / self.std
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+    def similar(self, features, top_n=10, max_distance=None):
+        row = self.rows.get(features.audio_file)
+        if row is None:
+            vector = self._normalize(features.vector[np.newaxis])[0]
+        else:
+            vector = self.vectors[row]
+        distances = 1 - self.vectors @ vector
+        if row is not None:
+            distances[row] = np.inf
+        top_n = min(top_n, len(distances) - (row is not None))
+        if top_n <= 0:
+            return []
+        nearest = np.argpartition(distances, top_n - 1)[:top_n]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [(self.features_list[i], float(distances[i]))
+                for i in nearest
+                if max_distance is None or distances[i] <= max_distance]
+
+
+def summarize(y, sr):
+    vector = np.zeros(FEATURES_COUNT, dtype=np.float32)
+    if len(y) == 0:
+        return vector
+    import librosa
+    rms = librosa.feature.rms(y=y)[0]
+    centroid = librosa.feature.spectral_centroid(y=y, sr=sr)[0]
+    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=MFCC_COUNT)
+    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+    vector[0:2] = rms.mean(), rms.std()
+    vector[2:4] = centroid.mean(), centroid.std()
+    vector[4:4 + MFCC_COUNT] = mfcc.mean(axis=1)
+    vector[4 + MFCC_COUNT:4 + 2 * MFCC_COUNT] = mfcc.std(axis=1)
+    vector[-1] = np.atleast_1d(tempo)[0]
+    return vector
+
+
 class AudioFileFeatures:
-    def __init__(self, audio_file):
+    def __init__(self, audio_file, fast=False, vector=None):
         self.audio_file = audio_file
         self.duration = self.audio_file.meta.duration
         self.cluster_index = -1
-        self._extract_file_features()
+        self.fast = fast
+        self.vector = vector
+        if self.vector is None:
+            self._extract_file_features()
 
+    @metrics.timed('feature_extraction')
     def _extract_file_features(self):
-        y, sr = librosa.load(
-            self.audio_file.path(), sr=10000, mono=True,
-            offset=60.0 if self.duration > 90.0 else 0.0,
-            duration=30.0, res_type='kaiser_fast')
-        self.rms = librosa.feature.rmse(y=y)[0]
+        offset = ANALYSIS_OFFSET if self.duration > 90.0 else 0.0
+        y, sr = load_audio(self.audio_file.path(), offset, ANALYSIS_DURATION,
+                           self.fast)
+        self.vector = summarize(y, sr)
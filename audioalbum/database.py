@@ -0,0 +1,438 @@
+import os
+import pickle
+import sqlite3
+import threading
+import numpy as np
+from audioalbum import files, albumsys, clustering, tasks
+
+TAG_FIELDS = ['title', 'artist', 'album', 'genre', 'year', 'duration',
+              'filesize']
+# the name index is made of trigrams, shorter text cannot be looked up
+SEARCH_MIN_LENGTH = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    directory TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    name TEXT NOT NULL,
+    format TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    genre TEXT,
+    year TEXT,
+    duration REAL,
+    filesize INTEGER,
+    approximate_duration INTEGER NOT NULL DEFAULT 0,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS file_names USING fts5 (
+    name, content = 'files', content_rowid = 'id', tokenize = 'trigram'
+);
+CREATE TRIGGER IF NOT EXISTS file_names_insert AFTER INSERT ON files BEGIN
+    INSERT INTO file_names (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS file_names_delete AFTER DELETE ON files BEGIN
+    INSERT INTO file_names (file_names, rowid, name)
+        VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS file_names_update AFTER UPDATE OF name ON files
+BEGIN
+    INSERT INTO file_names (file_names, rowid, name)
+        VALUES ('delete', old.id, old.name);
+    INSERT INTO file_names (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TABLE IF NOT EXISTS features (
+    file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    fast INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (file_id, fast)
+);
+CREATE TABLE IF NOT EXISTS albums (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS album_items (
+    album_id INTEGER NOT NULL REFERENCES albums (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    PRIMARY KEY (album_id, position)
+);
+CREATE INDEX IF NOT EXISTS album_items_file ON album_items (file_id);
+CREATE TABLE IF NOT EXISTS removed_album_items (
+    path TEXT NOT NULL,
+    album TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS removed_album_items_path
+    ON removed_album_items (path);
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (path, key)
+);
+'''
+
+
+class StoredTags:
+    def __init__(self, row):
+        for field in TAG_FIELDS:
+            setattr(self, field, row[field])
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def directory_range(directory):
+    # every directory below this one sorts between the two bounds, so the
+    # files_directory index serves the lookup
+    prefix = os.path.join(directory, '')
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class LibraryDatabase:
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA foreign_keys = ON')
+            indexed = self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'file_names'"
+            ).fetchone()
+            self.connection.executescript(SCHEMA)
+            if indexed is None:
+                # a database from before the name index
+                self.connection.execute(
+                    "INSERT INTO file_names (file_names) VALUES ('rebuild')")
+
+    def _audio_file(self, row):
+        audio = files.AudioFile(row['directory'], row['file_name'],
+                                meta=StoredTags(row))
+        audio.approximate_duration = bool(row['approximate_duration'])
+        audio.hash = row['hash']
+        return audio
+
+    def _store(self, audio, stamp):
+        size, mtime_ns = stamp
+        path = os.path.abspath(audio.path())
+        self.connection.execute(
+            'INSERT INTO files (path, directory, file_name, name, format, '
+            'size, mtime_ns, title, artist, album, genre, year, duration, '
+            'filesize, approximate_duration, hash) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (path) DO UPDATE SET '
+            'directory = excluded.directory, '
+            'file_name = excluded.file_name, name = excluded.name, '
+            'format = excluded.format, size = excluded.size, '
+            'mtime_ns = excluded.mtime_ns, title = excluded.title, '
+            'artist = excluded.artist, album = excluded.album, '
+            'genre = excluded.genre, year = excluded.year, '
+            'duration = excluded.duration, filesize = excluded.filesize, '
+            'approximate_duration = excluded.approximate_duration, '
+            'hash = excluded.hash',
+            [path, os.path.dirname(path), audio.file_name, audio.name,
+             audio.format, size, mtime_ns]
+            + [getattr(audio.meta, field) for field in TAG_FIELDS]
+            + [int(audio.approximate_duration), audio.hash])
+
+    def _file_id(self, audio):
+        query = 'SELECT id FROM files WHERE path = ?'
+        path = os.path.abspath(audio.path())
+        row = self.connection.execute(query, [path]).fetchone()
+        if row is None:
+            self._store(audio, file_stamp(path))
+            row = self.connection.execute(query, [path]).fetchone()
+        return row['id']
+
+    def read_audio_file(self, directory, file_name, tag_budget=None):
+        # paths are stored absolute, so scans from another working
+        # directory find the same rows
+        directory = os.path.abspath(directory)
+        path = os.path.join(directory, file_name)
+        stamp = file_stamp(path)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT * FROM files WHERE path = ?', [path]).fetchone()
+        if row is not None and (row['size'], row['mtime_ns']) == stamp:
+            return self._audio_file(row)
+        audio = files.AudioFile(directory, file_name, tag_budget)
+        if audio.meta is None:
+            return audio
+        with self.lock, self.connection:
+            # the file changed, whatever was derived from its content is stale
+            if row is not None:
+                self.connection.execute(
+                    'DELETE FROM features WHERE file_id = ?', [row['id']])
+            self._store(audio, stamp)
+        return audio
+
+    def audio_files(self, directory, search_in_subdirs, formats, exclude=()):
+        directory = os.path.abspath(directory)
+        query = 'SELECT * FROM files WHERE (directory = ?'
+        parameters = [directory]
+        if search_in_subdirs:
+            query += ' OR directory >= ? AND directory < ?'
+            parameters += directory_range(directory)
+        query += ') AND format IN ({})'.format(', '.join('?' * len(formats)))
+        with self.lock:
+            # rows are turned into files as they come, a large library is
+            # not held twice
+            rows = self.connection.execute(query,
+                                           parameters + list(formats))
+            return [self._audio_file(row) for row in rows
+                    if row['duration']
+                    and not files.is_excluded(row['path'], exclude)]
+
+    def remove_missing(self, directory, search_in_subdirs, formats, found):
+        paths = {os.path.abspath(audio.path()) for audio in found}
+        stored = self.audio_files(directory, search_in_subdirs, formats)
+        missing = [[audio.path()] for audio in stored
+                   if audio.path() not in paths
+                   and not os.path.exists(audio.path())]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM files WHERE path = ?', missing)
+
+    def store_hashes(self, audio_files):
+        hashes = [[audio.hash, os.path.abspath(audio.path())]
+                  for audio in audio_files if audio.hash]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE files SET hash = ? WHERE path = ?', hashes)
+
+    def load_features(self, audio, fast):
+        with self.lock:
+            if self.connection is None:
+                return None
+            row = self.connection.execute(
+                'SELECT vector FROM features JOIN files ON file_id = id '
+                'WHERE path = ? AND fast = ? AND version = ?',
+                [os.path.abspath(audio.path()), int(fast),
+                 clustering.FEATURES_VERSION]).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row['vector'], dtype=np.float32)
+
+    def store_features(self, audio, vector, fast):
+        with self.lock:
+            # analysis can finish after the window closed the database
+            if self.connection is None:
+                return
+            self.connection.execute(
+                'INSERT OR REPLACE INTO features (file_id, fast, version, '
+                'vector) VALUES (?, ?, ?, ?)',
+                [self._file_id(audio), int(fast), clustering.FEATURES_VERSION,
+                 np.asarray(vector, dtype=np.float32).tobytes()])
+            self.connection.commit()
+
+    def load_albums(self, task=None):
+        with self.lock:
+            album_rows = self.connection.execute(
+                'SELECT id, name FROM albums ORDER BY id').fetchall()
+        albums = {}
+        for i, album_row in enumerate(album_rows):
+            tasks.report(task, i, len(album_rows))
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT files.*, album_items.name AS item_name '
+                    'FROM album_items JOIN files ON file_id = files.id '
+                    'WHERE album_id = ? ORDER BY position',
+                    [album_row['id']]).fetchall()
+            album_items = []
+            for row in rows:
+                item = albumsys.AlbumItem(self._audio_file(row))
+                item.name = row['item_name']
+                album_items.append(item)
+            albums[album_row['name']] = albumsys.Album(album_row['name'],
+                                                       album_items)
+        return albums
+
+    def save_albums(self, albums):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM albums')
+            for name, album in albums.items():
+                album_id = self.connection.execute(
+                    'INSERT INTO albums (name) VALUES (?)', [name]).lastrowid
+                self.connection.executemany(
+                    'INSERT INTO album_items (album_id, position, file_id, '
+                    'name) VALUES (?, ?, ?, ?)',
+                    [[album_id, position, self._file_id(item.audio_file),
+                      item.name]
+                     for position, item in enumerate(album.album_items)])
+
+    def find_name(self, text):
+        # paths of the files whose name contains text, ignoring case;
+        # None when text is too short for the index
+        if len(text) < SEARCH_MIN_LENGTH:
+            return None
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT path FROM file_names JOIN files '
+                'ON files.id = file_names.rowid WHERE file_names MATCH ?',
+                ['"{}"'.format(text.replace('"', '""'))]).fetchall()
+        return [row['path'] for row in rows]
+
+    def apply_changes(self, changes):
+        with self.lock, self.connection:
+            for change in changes:
+                if change.old_path is None:
+                    audio = change.audio_file
+                    if audio.meta is not None:
+                        self._store(audio, file_stamp(change.new_path))
+                        self._restore_items(audio)
+                elif change.new_path is None:
+                    self._remove_items(os.path.abspath(change.old_path))
+                else:
+                    new_path = os.path.abspath(change.new_path)
+                    directory, file_name = os.path.split(new_path)
+                    self.connection.execute(
+                        'UPDATE files SET path = ?, directory = ?, '
+                        'file_name = ?, name = ? WHERE path = ?',
+                        [new_path, directory, file_name,
+                         os.path.splitext(file_name)[0],
+                         os.path.abspath(change.old_path)])
+
+    def _remove_items(self, path):
+        # the album items of a deleted file are kept aside, an undo of the
+        # deletion puts them back
+        self.connection.execute(
+            'INSERT INTO removed_album_items (path, album, position, name) '
+            'SELECT path, albums.name, position, album_items.name '
+            'FROM album_items JOIN files ON file_id = files.id '
+            'JOIN albums ON album_id = albums.id WHERE path = ?', [path])
+        self.connection.execute('DELETE FROM files WHERE path = ?', [path])
+
+    def _restore_items(self, audio):
+        path = os.path.abspath(audio.path())
+        rows = self.connection.execute(
+            'SELECT albums.id AS album_id, position, '
+            'removed_album_items.name AS name FROM removed_album_items '
+            'JOIN albums ON album = albums.name WHERE path = ? '
+            'ORDER BY position', [path]).fetchall()
+        file_id = self._file_id(audio)
+        for row in rows:
+            # make room at the old position, through negative positions so
+            # the shifted items never collide
+            self.connection.execute(
+                'UPDATE album_items SET position = -position - 1 '
+                'WHERE album_id = ? AND position >= ?',
+                [row['album_id'], row['position']])
+            self.connection.execute(
+                'UPDATE album_items SET position = -position '
+                'WHERE album_id = ? AND position < 0', [row['album_id']])
+            self.connection.execute(
+                'INSERT INTO album_items (album_id, position, file_id, '
+                'name) VALUES (?, ?, ?, ?)',
+                [row['album_id'], row['position'], file_id, row['name']])
+        self.connection.execute(
+            'DELETE FROM removed_album_items WHERE path = ?', [path])
+
+    def forget_removed(self, paths):
+        # the journal can no longer undo these deletions
+        with self.lock:
+            if self.connection is None:
+                return
+            with self.connection:
+                self.connection.executemany(
+                    'DELETE FROM removed_album_items WHERE path = ?',
+                    [[os.path.abspath(path)] for path in paths])
+
+    def metadata(self):
+        return MetadataStore(self)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class MetadataStore:
+    # the MetadataCache interface over the library database, so seek
+    # indexes and gains live next to the tags they belong to
+    def __init__(self, database):
+        self.database = database
+
+    def get(self, path, key):
+        path = os.path.abspath(path)
+        stamp = file_stamp(path)
+        with self.database.lock:
+            connection = self.database.connection
+            if connection is None:
+                return None
+            row = connection.execute(
+                'SELECT size, mtime_ns, value FROM metadata '
+                'WHERE path = ? AND key = ?', [path, key]).fetchone()
+        if row is None or (row['size'], row['mtime_ns']) != stamp:
+            return None
+        return pickle.loads(row['value'])
+
+    def put(self, path, key, value):
+        path = os.path.abspath(path)
+        size, mtime_ns = file_stamp(path)
+        if size is None:
+            return
+        with self.database.lock:
+            connection = self.database.connection
+            if connection is None:
+                return
+            with connection:
+                # a changed file invalidates every key stored for it
+                connection.execute(
+                    'DELETE FROM metadata WHERE path = ? '
+                    'AND (size != ? OR mtime_ns != ?)',
+                    [path, size, mtime_ns])
+                connection.execute(
+                    'INSERT OR REPLACE INTO metadata (path, key, size, '
+                    'mtime_ns, value) VALUES (?, ?, ?, ?, ?)',
+                    [path, key, size, mtime_ns, pickle.dumps(value)])
+
+    def remove(self, path):
+        with self.database.lock:
+            connection = self.database.connection
+            if connection is None:
+                return
+            with connection:
+                connection.execute('DELETE FROM metadata WHERE path = ?',
+                                   [os.path.abspath(path)])
+
+    def apply_changes(self, changes):
+        with self.database.lock:
+            connection = self.database.connection
+            if connection is None:
+                return
+            with connection:
+                for change in changes:
+                    if change.old_path is None:
+                        continue
+                    old_path = os.path.abspath(change.old_path)
+                    if change.new_path is None:
+                        connection.execute(
+                            'DELETE FROM metadata WHERE path = ?', [old_path])
+                    else:
+                        connection.execute(
+                            'UPDATE metadata SET path = ? WHERE path = ?',
+                            [os.path.abspath(change.new_path), old_path])
+
+    def close(self):
+        # the database is closed by its owner
+        pass
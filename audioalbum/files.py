@@ -1,17 +1,61 @@
 import re
 import os
+import asyncio
 import collections
-import filecmp
+import fnmatch
+import mmap
 import tinytag
 from tinytag import TinyTag
 import hashlib
 import operator
+from concurrent.futures import ThreadPoolExecutor
+from audioalbum import metrics, tasks, mp3
 
 FILENAME_RE = re.compile(r'(?P<name>.+)\.(?P<format>.+)$')
+TRASH_DIRECTORY = '.audioalbum_trash'
+PIPELINE_QUEUE_SIZE = 64
+# bytes a tags-only read may take from one file
+TAG_READ_BUDGET = 256 * 1024
+# bytes hashed or compared per step when a file can't be memory mapped,
+# and compared per step when it can
+COMPARE_CHUNK_SIZE = 1024 * 1024
+MOUNTS_FILE = '/proc/mounts'
+# a mapped file truncated on the server raises SIGBUS on the next access
+NETWORK_FILESYSTEMS = frozenset([
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', '9p', 'afs',
+    'ceph', 'glusterfs', 'fuse.glusterfs'])
+MOUNT_ESCAPE_RE = re.compile(r'\\([0-7]{3})')
+
+_mounts = None
+
+
+class CountingReader:
+    def __init__(self, f, budget=None):
+        self.f = f
+        self.budget = budget
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if self.budget is not None:
+            left = max(self.budget - self.bytes_read, 0)
+            if size is None or size < 0 or size > left:
+                size = left
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
 
 
 class AudioFile:
-    def __init__(self, directory, file_name):
+    def __init__(self, directory, file_name, tag_budget=None, meta=None):
         self.directory = directory
         self.file_name = file_name
         match = FILENAME_RE.match(file_name)
@@ -19,8 +63,14 @@ class AudioFile:
         self.format = match.group('format')
         self.index = None
         self.hash = None
+        self.bytes_read = 0
+        self.approximate_duration = False
+        if meta is not None:
+            self.meta = meta
+            return
         try:
-            self.meta = TinyTag.get(self.path())
+            with metrics.timed('tag_parse'):
+                self.meta = self.read_tags(tag_budget)
         except tinytag.TinyTagException:
             self.meta = None
             print(self.path())
@@ -31,6 +81,28 @@ class AudioFile:
     def path(self):
         return os.path.join(self.directory, self.file_name)
 
+    def read_tags(self, tag_budget=None):
+        # with a budget MPEG streams are not walked for the duration, it is
+        # taken from the Xing header or estimated from the first frames
+        estimate = tag_budget is not None and self.format.lower() == 'mp3'
+        with open(self.path(), 'rb') as f:
+            reader = CountingReader(f, tag_budget)
+            try:
+                meta = TinyTag.get(self.path(), file_obj=reader,
+                                   duration=not estimate)
+                if estimate:
+                    meta.duration, self.approximate_duration = \
+                        mp3.estimate_duration(reader, meta.filesize)
+                if estimate and meta.duration is None:
+                    # no frame in the probe, TinyTag walks the whole stream
+                    reader.budget = None
+                    meta = TinyTag.get(self.path(), file_obj=reader)
+                    self.approximate_duration = False
+            finally:
+                self.bytes_read = reader.bytes_read
+                metrics.count('tag_bytes_read', reader.bytes_read)
+        return meta
+
 
 def create_regexp(formats):
     return re.compile(
@@ -38,24 +110,172 @@ def create_regexp(formats):
             '|'.join(formats)))
 
 
-def find_audio_files(directory, search_in_subdirs, formats):
-    audio_re = create_regexp(formats)
+def audio_suffixes(formats):
+    return frozenset('.' + audio_format for audio_format in formats)
+
+
+def is_audio_file(file_name, suffixes):
+    dot = file_name.rfind('.')
+    return dot > 0 and file_name[dot:] in suffixes
+
+
+def is_excluded(path, exclude):
+    return any(fnmatch.fnmatch(path, pattern) for pattern in exclude)
+
+
+def walk_audio_files(directory, search_in_subdirs, formats, exclude=()):
+    suffixes = audio_suffixes(formats)
+    for root, dirs, file_names in os.walk(directory):
+        dirs[:] = [
+            name for name in dirs if name != TRASH_DIRECTORY
+            and not is_excluded(os.path.join(root, name, ''), exclude)]
+        yield root, [
+            name for name in file_names if is_audio_file(name, suffixes)
+            and not is_excluded(os.path.join(root, name), exclude)]
+        if not search_in_subdirs:
+            break
+
+
+@metrics.timed('scan')
+def find_audio_files(directory, search_in_subdirs, formats, task=None,
+                     jobs=1, hash_files=False, tag_budget=None, exclude=(),
+                     database=None, rescan=True):
+    if database is not None and not rescan:
+        return sort(database.audio_files(
+            directory, search_in_subdirs, formats, exclude), 'name')
+    if jobs > 1:
+        audio_files = asyncio.run(scan_pipeline(
+            directory, search_in_subdirs, formats, jobs, hash_files, task,
+            tag_budget, exclude, database))
+    else:
+        audio_files = scan_serial(
+            directory, search_in_subdirs, formats, hash_files, task,
+            tag_budget, exclude, database)
+    if database is not None:
+        database.remove_missing(directory, search_in_subdirs, formats,
+                                audio_files)
+        if hash_files:
+            database.store_hashes(audio_files)
+    return audio_files
+
+
+def scan_serial(directory, search_in_subdirs, formats, hash_files=False,
+                task=None, tag_budget=None, exclude=(), database=None):
     audio_files = []
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            match = audio_re.match(file)
-            if not match:
-                continue
-            audio = AudioFile(root, match.group('file_name'))
-            if not audio.meta or audio.meta.duration == 0:
+    checked = 0
+    for root, file_names in walk_audio_files(
+            directory, search_in_subdirs, formats, exclude):
+        for file_name in file_names:
+            audio = read_audio_file(root, file_name, tag_budget, database)
+            checked += 1
+            tasks.report(task, checked)
+            if audio is None:
                 continue
             audio_files.append(audio)
-        if not search_in_subdirs:
-            break
+    if hash_files:
+        count_hash(find_nonunique_sizes(audio_files), task)
     sorted_files = sort(audio_files, 'name')
     return sorted_files
 
 
+def read_audio_file(directory, file_name, tag_budget=None, database=None):
+    if database is not None:
+        audio = database.read_audio_file(directory, file_name, tag_budget)
+    else:
+        audio = AudioFile(directory, file_name, tag_budget)
+    if not audio.meta or not audio.meta.duration:
+        return None
+    return audio
+
+
+async def scan_pipeline(directory, search_in_subdirs, formats, jobs,
+                        hash_files=False, task=None, tag_budget=None,
+                        exclude=(), database=None):
+    # walking, tag reading and hashing overlap; the bounded queues stop a
+    # fast stage from running ahead of a slow one, and the executor caps
+    # the number of blocking calls in flight at jobs
+    loop = asyncio.get_running_loop()
+    paths = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    hashes = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    found = []
+    checked = 0
+    hashers = jobs if hash_files else 0
+    # only files sharing a size can be duplicates, so a file is hashed once
+    # a second file of its size turns up
+    first_of_size = {}
+
+    with ThreadPoolExecutor(jobs) as executor:
+        def call(func, *args):
+            return loop.run_in_executor(executor, func, *args)
+
+        async def walk():
+            walker = walk_audio_files(directory, search_in_subdirs, formats,
+                                      exclude)
+            index = 0
+            while True:
+                entry = await call(next, walker, None)
+                if entry is None:
+                    break
+                root, file_names = entry
+                for file_name in file_names:
+                    await paths.put((index, root, file_name))
+                    index += 1
+            for _ in range(jobs):
+                await paths.put(None)
+
+        async def read_tags():
+            nonlocal checked
+            while True:
+                item = await paths.get()
+                if item is None:
+                    break
+                index, root, file_name = item
+                audio = await call(read_audio_file, root, file_name,
+                                   tag_budget, database)
+                checked += 1
+                tasks.report(task, checked)
+                if audio is None:
+                    continue
+                found.append((index, audio))
+                if not hashers:
+                    continue
+                size = audio.meta.filesize
+                first = first_of_size.setdefault(size, audio)
+                if first is audio:
+                    continue
+                if first is not None:
+                    first_of_size[size] = None
+                    await hashes.put(first)
+                await hashes.put(audio)
+
+        async def read_stage():
+            await asyncio.gather(*[read_tags() for _ in range(jobs)])
+            for _ in range(hashers):
+                await hashes.put(None)
+
+        async def hash_files_stage():
+            while True:
+                audio = await hashes.get()
+                if audio is None:
+                    break
+                tasks.report(task, checked)
+                if audio.hash:
+                    continue
+                audio.hash = await call(get_hash_md5, audio.path())
+
+        stages = [asyncio.ensure_future(stage) for stage in (
+            walk(), read_stage(),
+            *[hash_files_stage() for _ in range(hashers)])]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+
+    found.sort(key=operator.itemgetter(0))
+    return sort([audio for _, audio in found], 'name')
+
+
 def find_name_in_files(name, files):
     reg = re.compile(r'{}'.format(name), re.IGNORECASE)
     result_list = []
@@ -77,10 +297,15 @@ def find_name_in_albums(name, albums):
     return result_dict
 
 
-def find_all_repetitions(files):
-    hashes_dict = create_nonunique_hashes_dict(files)
+def find_all_repetitions(files, task=None):
+    hashes_dict = create_nonunique_hashes_dict(files, task)
     repetitions = {}
+    # after hashing, the progress counts the files compared byte by byte
+    total = sum(len(same_hash) for same_hash in hashes_dict.values())
+    compared = 0
     for hash in hashes_dict:
+        tasks.report(task, compared, total)
+        compared += len(hashes_dict[hash])
         checked_files = []
         for file in hashes_dict[hash]:
             if file in checked_files:
@@ -94,12 +319,13 @@ def find_all_repetitions(files):
                 else file.name
             repetitions[name] = *same_files, file
             checked_files += same_files
+    tasks.report(task, total, total)
     return repetitions
 
 
-def create_nonunique_hashes_dict(input_files):
+def create_nonunique_hashes_dict(input_files, task=None):
     files = find_nonunique_sizes(input_files)
-    count_hash(files)
+    count_hash(files, task)
     hash_counter = collections.Counter(file.hash for file in files)
     rep_files = [file for file in files if hash_counter[file.hash] > 1]
     hashes_dict = {hash: [] for hash in hash_counter if hash_counter[hash] > 1}
@@ -124,21 +350,85 @@ def find_same_files(audio, files):
     return same_files
 
 
-def count_hash(files):
-    for file in files:
+def count_hash(files, task=None):
+    for i, file in enumerate(files):
+        tasks.report(task, i, len(files))
         if file.hash:
             continue
         file.hash = get_hash_md5(file.path())
+    tasks.report(task, len(files), len(files))
+
+
+def read_mounts(mounts_file=MOUNTS_FILE):
+    # (mount point, filesystem type), the innermost mount points first;
+    # without a mount table every file counts as local
+    try:
+        with open(mounts_file, 'rt') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    mounts = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount_point = MOUNT_ESCAPE_RE.sub(
+            lambda match: chr(int(match.group(1), 8)), fields[1])
+        mounts.append((mount_point, fields[2]))
+    mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+    return mounts
+
+
+def filesystem_type(path):
+    global _mounts
+    if _mounts is None:
+        _mounts = read_mounts()
+    path = os.path.realpath(path)
+    for mount_point, fs_type in _mounts:
+        if path == mount_point or path.startswith(
+                mount_point.rstrip(os.sep) + os.sep):
+            return fs_type
+    return None
+
+
+def on_network_mount(path):
+    return filesystem_type(path) in NETWORK_FILESYSTEMS
+
+
+def map_file(f):
+    # files on network shares are read instead of mapped, empty files and
+    # special files can't be mapped
+    if isinstance(f.name, str) and on_network_mount(f.name):
+        return None
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return None
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def read_chunks(f, buffer):
+    view = memoryview(buffer)
+    while True:
+        size = f.readinto(buffer)
+        if not size:
+            break
+        yield view[:size]
 
 
+@metrics.timed('hash')
 def get_hash_md5(filename):
     with open(filename, 'rb') as f:
         m = hashlib.md5()
-        while True:
-            data = f.read(8192)
-            if not data:
-                break
-            m.update(data)
+        mapped = map_file(f)
+        if mapped is None:
+            for chunk in read_chunks(f, bytearray(COMPARE_CHUNK_SIZE)):
+                m.update(chunk)
+            return m.hexdigest()
+        with mapped, memoryview(mapped) as view:
+            m.update(view)
         return m.hexdigest()
 
 
@@ -151,7 +441,57 @@ def compare_and_find_files(search_file, files):
 
 
 def files_are_same(file_1, file_2):
-    return filecmp.cmp(file_1.path(), file_2.path())
+    return same_contents(file_1.path(), file_2.path())
+
+
+@metrics.timed('compare')
+def same_contents(path_1, path_2):
+    if os.path.getsize(path_1) != os.path.getsize(path_2):
+        return False
+    with open(path_1, 'rb') as f_1, open(path_2, 'rb') as f_2:
+        mapped_1 = map_file(f_1)
+        mapped_2 = map_file(f_2)
+        if mapped_1 is None or mapped_2 is None:
+            for mapped in (mapped_1, mapped_2):
+                if mapped is not None:
+                    mapped.close()
+            return same_chunks(f_1, f_2)
+        with mapped_1, mapped_2:
+            return same_mapped(mapped_1, mapped_2)
+
+
+def same_mapped(mapped_1, mapped_2):
+    import numpy as np
+    # numpy arrays over the mappings compare in place, memoryview equality
+    # would unpack item by item
+    array_1 = np.frombuffer(mapped_1, dtype=np.uint8)
+    array_2 = np.frombuffer(mapped_2, dtype=np.uint8)
+    try:
+        for start in range(0, len(array_1), COMPARE_CHUNK_SIZE):
+            end = start + COMPARE_CHUNK_SIZE
+            if not np.array_equal(array_1[start:end], array_2[start:end]):
+                return False
+        return True
+    finally:
+        # the arrays export the mappings, which can't close while exported
+        del array_1, array_2
+
+
+def same_chunks(f_1, f_2):
+    buffer_1 = bytearray(COMPARE_CHUNK_SIZE)
+    buffer_2 = bytearray(COMPARE_CHUNK_SIZE)
+    while True:
+        size_1 = f_1.readinto(buffer_1)
+        size_2 = f_2.readinto(buffer_2)
+        if size_1 != size_2:
+            return False
+        if not size_1:
+            return True
+        if size_1 == COMPARE_CHUNK_SIZE:
+            if buffer_1 != buffer_2:
+                return False
+        elif buffer_1[:size_1] != buffer_2[:size_2]:
+            return False
 
 
 def sort(audio_files, key):
@@ -1,38 +1,157 @@
+import errno
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from audioalbum import tasks
 
 ERROR_DELETE = 1
 ERROR_RENAME = 2
 ERROR_MOVE = 3
 
+DELETE = 'delete'
+RENAME = 'rename'
+MOVE = 'move'
+RESTORE = 'restore'
+
+ERRORS = {
+    DELETE: ERROR_DELETE,
+    RENAME: ERROR_RENAME,
+    MOVE: ERROR_MOVE,
+    RESTORE: ERROR_MOVE,
+}
+
+COPY_CHUNK_SIZE = 1024 * 1024
+BATCH_WORKERS = 4
+
+
+def copy_file(src, dst, progress=None):
+    total = os.path.getsize(src)
+    copied = 0
+    part = dst + '.part'
+    try:
+        with open(src, 'rb') as fsrc, open(part, 'wb') as fdst:
+            while True:
+                chunk = fsrc.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                copied += len(chunk)
+                if progress:
+                    progress(copied, total)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        shutil.copystat(src, part)
+        os.replace(part, dst)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+def move(src, dst, progress=None):
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(src, dst, progress)
+        os.remove(src)
+
+
+class FileOperation:
+    def __init__(self, kind, audio_file, target=None, source=None):
+        self.kind = kind
+        self.audio_file = audio_file
+        self.target = target
+        self.source = source if source is not None else audio_file.path()
+        self.error = 0
+
+    def destination(self):
+        if self.kind == DELETE:
+            if self.target is None:
+                return None
+            return os.path.join(self.target, self.audio_file.file_name)
+        if self.kind == RENAME:
+            return os.path.join(
+                self.audio_file.directory,
+                '{}.{}'.format(self.target, self.audio_file.format))
+        if self.kind == MOVE:
+            return os.path.join(self.target, self.audio_file.file_name)
+        return self.audio_file.path()
+
 
 class FileSystemEdit:
-    def __init__(self, files):
+    def __init__(self, files, workers=BATCH_WORKERS):
         self.files = files
+        self.workers = workers
+        self.executor = None
 
-    def delete_file(self, index):
+    def apply(self, operation, progress=None):
         try:
-            os.remove(self.files[index].path())
-            return 0
+            destination = operation.destination()
+            if destination is not None and os.path.exists(destination):
+                raise FileExistsError(
+                    errno.EEXIST, os.strerror(errno.EEXIST), destination)
+            if operation.kind == DELETE and operation.target is None:
+                os.remove(operation.source)
+            elif operation.kind == DELETE:
+                os.makedirs(operation.target, exist_ok=True)
+                move(operation.source, destination, progress)
+            elif operation.kind == RENAME:
+                os.rename(operation.source, destination)
+            else:
+                move(operation.source, destination, progress)
+            operation.error = 0
         except Exception as e:
             print(e)
-            return ERROR_DELETE
+            operation.error = ERRORS[operation.kind]
+        return operation.error
 
-    def rename_file(self, index, name):
-        filename = '{}.{}'.format(name, self.files[index].format)
+    def run_operations(self, operations, copy_progress=None, task=None):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers)
+        futures = []
+        for operation in operations:
+            operation_progress = None
+            if copy_progress:
+                operation_progress = \
+                    lambda copied, total, operation=operation: \
+                    copy_progress(operation, copied, total)
+            futures.append(self.executor.submit(
+                self._apply_unless_cancelled, operation, operation_progress,
+                task))
         try:
-            os.rename(
-                self.files[index].path(),
-                os.path.join(self.files[index].directory, filename))
-            return 0
-        except Exception as e:
-            print(e)
-            return ERROR_RENAME
+            for completed, future in enumerate(as_completed(futures), 1):
+                tasks.report(task, completed, len(operations))
+        finally:
+            # the running operations finish even when the batch is cancelled
+            wait(futures)
+            for operation, future in zip(operations, futures):
+                if future.cancelled():
+                    operation.error = ERRORS[operation.kind]
+        return operations
+
+    def _apply_unless_cancelled(self, operation, progress, task):
+        # operations still waiting for a worker are skipped and count as
+        # failed once the batch is cancelled
+        if task is not None and task.cancelled():
+            operation.error = ERRORS[operation.kind]
+            return operation.error
+        return self.apply(operation, progress)
+
+    def run_batch(self, operations, progress=None, copy_progress=None):
+        return tasks.Task(self.run_operations, operations, copy_progress,
+                          progress=progress).start()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def delete_file(self, index):
+        return self.apply(FileOperation(DELETE, self.files[index]))
+
+    def rename_file(self, index, name):
+        return self.apply(FileOperation(RENAME, self.files[index], name))
 
     def move_file(self, index, directory):
-        try:
-            os.replace(
-                self.files[index].path(),
-                os.path.join(directory, self.files[index].file_name))
-        except Exception as e:
-            print(e)
-            return ERROR_MOVE
+        return self.apply(FileOperation(MOVE, self.files[index], directory))
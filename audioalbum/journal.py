@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+from audioalbum import files, fsystem, tasks
+
+UNDO_LIMIT = 20
+
+
+class FileChange:
+    def __init__(self, audio_file, old_path, new_path):
+        self.audio_file = audio_file
+        self.old_path = old_path
+        self.new_path = new_path
+
+    @property
+    def deleted(self):
+        return self.new_path is None
+
+    @property
+    def restored(self):
+        return self.old_path is None
+
+    def apply(self):
+        if self.old_path is None or self.new_path is None:
+            return
+        audio = self.audio_file
+        audio.directory, audio.file_name = os.path.split(self.new_path)
+        audio.name = os.path.splitext(audio.file_name)[0]
+
+
+def apply_changes(changes):
+    # listeners run on a worker thread; the audio files are shared with the
+    # GUI, so their owner applies the changes on its own thread
+    for change in changes:
+        change.apply()
+
+
+class Transaction:
+    def __init__(self, name, operations, undoes=None):
+        self.name = name
+        self.operations = operations
+        self.undoes = undoes
+        self.changes = []
+        self.rolled_back = False
+
+    def failed(self):
+        return [operation for operation in self.operations
+                if operation.error]
+
+
+class Journal:
+    def __init__(self, fs_editor, atomic=True, undo_limit=UNDO_LIMIT):
+        self.fs_editor = fs_editor
+        self.atomic = atomic
+        self.undo_limit = undo_limit
+        self.history = []
+        self.listeners = []
+        self.evicted_listeners = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def subscribe_evicted(self, listener):
+        # called with the paths of deleted files that can no longer be
+        # restored by undo
+        self.evicted_listeners.append(listener)
+
+    def run(self, operations, progress=None, copy_progress=None):
+        with self.lock:
+            self.count += 1
+            name = '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), self.count)
+        for operation in operations:
+            if operation.kind == fsystem.DELETE and operation.target is None:
+                operation.target = os.path.join(
+                    operation.audio_file.directory, files.TRASH_DIRECTORY,
+                    name)
+        return self._start(Transaction(name, operations), progress,
+                           copy_progress)
+
+    def last(self):
+        with self.lock:
+            return self.history[-1] if self.history else None
+
+    def undo(self, progress=None, copy_progress=None):
+        with self.lock:
+            if not self.history:
+                return None
+            transaction = self.history.pop()
+        operations = [self._inverse(operation)
+                      for operation in reversed(transaction.operations)
+                      if not operation.error]
+        return self._start(
+            Transaction(transaction.name, operations, transaction),
+            progress, copy_progress)
+
+    def close(self):
+        with self.lock:
+            history, self.history = self.history, []
+        for transaction in history:
+            self._purge(transaction)
+
+    def _start(self, transaction, progress, copy_progress=None):
+        return tasks.Task(self._execute, transaction, copy_progress,
+                          progress=progress).start()
+
+    def _execute(self, transaction, copy_progress=None, task=None):
+        try:
+            self.fs_editor.run_operations(transaction.operations,
+                                          copy_progress, task)
+        except tasks.Cancelled:
+            # the skipped operations count as failed, so an atomic journal
+            # rolls the finished ones back
+            pass
+        self._finish(transaction)
+        return transaction
+
+    def _finish(self, transaction):
+        succeeded = [operation for operation in transaction.operations
+                     if not operation.error]
+        evicted = []
+        if self.atomic and transaction.failed() and succeeded:
+            for operation in reversed(succeeded):
+                self.fs_editor.apply(self._inverse(operation))
+            transaction.rolled_back = True
+        elif succeeded:
+            transaction.changes = [self._commit(operation)
+                                   for operation in succeeded]
+        undone = None
+        with self.lock:
+            if transaction.undoes is None and transaction.changes:
+                self.history.append(transaction)
+                evicted = self.history[:-self.undo_limit]
+                del self.history[:-self.undo_limit]
+            elif transaction.undoes is not None and not transaction.changes:
+                self.history.append(transaction.undoes)
+            elif transaction.undoes is not None and not transaction.failed():
+                undone = transaction.undoes
+        for old_transaction in evicted:
+            self._purge(old_transaction)
+        if undone is not None:
+            # its deleted files are back, only the empty trash is left
+            self._remove_trash(undone)
+        if transaction.changes:
+            for listener in self.listeners:
+                self._notify(listener, transaction.changes)
+
+    def _commit(self, operation):
+        audio = operation.audio_file
+        if operation.kind == fsystem.DELETE:
+            return FileChange(audio, operation.source, None)
+        if operation.kind == fsystem.RESTORE:
+            return FileChange(audio, None, operation.destination())
+        return FileChange(audio, operation.source, operation.destination())
+
+    def _inverse(self, operation):
+        audio = operation.audio_file
+        if operation.kind == fsystem.DELETE:
+            return fsystem.FileOperation(
+                fsystem.RESTORE, audio, source=operation.destination())
+        if operation.kind == fsystem.RESTORE:
+            return fsystem.FileOperation(
+                fsystem.DELETE, audio, os.path.dirname(operation.source))
+        if operation.kind == fsystem.RENAME:
+            name = os.path.splitext(os.path.basename(operation.source))[0]
+            return fsystem.FileOperation(
+                fsystem.RENAME, audio, name, operation.destination())
+        return fsystem.FileOperation(
+            fsystem.MOVE, audio, os.path.dirname(operation.source),
+            operation.destination())
+
+    def _purge(self, transaction):
+        deleted = self._remove_trash(transaction)
+        if deleted:
+            for listener in self.evicted_listeners:
+                self._notify(listener, deleted)
+
+    def _notify(self, listener, argument):
+        # the files are changed already, a failing listener must not keep
+        # the other listeners or the transaction from finishing
+        try:
+            listener(argument)
+        except Exception as e:
+            print(e)
+
+    def _remove_trash(self, transaction):
+        deleted = []
+        for operation in transaction.operations:
+            if operation.kind != fsystem.DELETE or operation.error:
+                continue
+            deleted.append(operation.source)
+            try:
+                os.remove(operation.destination())
+            except OSError:
+                pass
+            for directory in (operation.target,
+                              os.path.dirname(operation.target)):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+        return deleted
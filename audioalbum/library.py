@@ -0,0 +1,123 @@
+import glob
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from audioalbum import files, metrics, tasks
+
+ROOT_KEYS = {'directory', 'formats', 'subdirs', 'jobs', 'exclude'}
+
+
+def is_string_list(value):
+    return isinstance(value, (list, tuple)) and \
+        all(isinstance(item, str) for item in value)
+
+
+class LibraryRoot:
+    def __init__(self, directory, formats=('mp3',), subdirs=True, jobs=1,
+                 exclude=()):
+        if not isinstance(directory, (str, os.PathLike)):
+            raise ValueError('directory must be a string')
+        directory = os.fspath(directory)
+        if not is_string_list(formats) or not formats:
+            raise ValueError('{}: formats must be a list of strings'.format(
+                directory))
+        if not is_string_list(exclude):
+            raise ValueError('{}: exclude must be a list of strings'.format(
+                directory))
+        if not isinstance(subdirs, bool):
+            raise ValueError('{}: subdirs must be true or false'.format(
+                directory))
+        # bool is an int, but true is not a job count
+        if isinstance(jobs, bool) or not isinstance(jobs, int) or jobs < 1:
+            raise ValueError('{}: jobs must be a positive integer'.format(
+                directory))
+        self.directory = directory
+        self.formats = list(formats)
+        self.subdirs = subdirs
+        self.jobs = jobs
+        self.exclude = list(exclude)
+
+
+class RootProgress:
+    # find_audio_files reports the files checked in one root, the library
+    # task gets the sum over all roots
+    def __init__(self, task, counts, index):
+        self.task = task
+        self.counts = counts
+        self.index = index
+
+    def report(self, done, total=0):
+        self.counts[self.index] = done
+        self.task.report(sum(self.counts))
+
+
+def load_config(filename):
+    with open(filename, 'rt') as f:
+        config = json.load(f)
+    roots = config.get('roots') if isinstance(config, dict) else None
+    if not roots:
+        raise ValueError('{}: no library roots'.format(filename))
+    library_roots = []
+    for root in roots:
+        if not isinstance(root, dict) or 'directory' not in root:
+            raise ValueError('{}: every root needs a directory'.format(
+                filename))
+        unknown = set(root) - ROOT_KEYS
+        if unknown:
+            raise ValueError('{}: unknown root settings: {}'.format(
+                filename, ', '.join(sorted(unknown))))
+        try:
+            library_roots.append(LibraryRoot(**root))
+        except ValueError as e:
+            raise ValueError('{}: {}'.format(filename, e))
+    return library_roots
+
+
+def nested_exclusions(roots):
+    # the same directory listed twice is scanned once, and a root inside
+    # another one is left out of the outer walk, so its own settings apply
+    # to its files
+    real_paths = []
+    unique = []
+    for root in roots:
+        real_path = os.path.realpath(root.directory)
+        if real_path in real_paths:
+            continue
+        real_paths.append(real_path)
+        unique.append(root)
+    exclusions = []
+    for root, real_path in zip(unique, real_paths):
+        prefix = os.path.join(real_path, '')
+        exclusions.append([
+            os.path.join(glob.escape(root.directory),
+                         glob.escape(os.path.relpath(inner, real_path)), '*')
+            for inner in real_paths if inner.startswith(prefix)])
+    return unique, exclusions
+
+
+@metrics.timed('library_scan')
+def scan_roots(roots, task=None, tag_budget=None, hash_files=False,
+               database=None, rescan=True):
+    roots, exclusions = nested_exclusions(roots)
+    counts = [0] * len(roots)
+    with ThreadPoolExecutor(len(roots)) as executor:
+        futures = [
+            executor.submit(
+                files.find_audio_files, root.directory, root.subdirs,
+                root.formats,
+                task=RootProgress(task, counts, i) if task else None,
+                jobs=root.jobs, hash_files=hash_files,
+                tag_budget=tag_budget, exclude=root.exclude + exclusions[i],
+                database=database, rescan=rescan)
+            for i, root in enumerate(roots)]
+        found = [future.result() for future in futures]
+    audio_files = []
+    paths = set()
+    # a file can still be reached twice through symbolic links
+    for root_files in found:
+        for audio in root_files:
+            if audio.path() in paths:
+                continue
+            paths.add(audio.path())
+            audio_files.append(audio)
+    return files.sort(audio_files, 'name')
@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from audioalbum import clustering, tasks
+
+# target level of the loudest 5% of 50 ms frames, dBFS
+REFERENCE_LOUDNESS = -18.0
+MAX_GAIN = 12.0
+SILENCE = -70.0
+RMS_WINDOW = 0.05
+LOUDNESS_PERCENTILE = 95
+
+
+def loudness(y, sr):
+    frame = max(1, int(sr * RMS_WINDOW))
+    count = len(y) // frame
+    if count == 0:
+        return None
+    frames = y[:count * frame].reshape(count, frame)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    levels = 20 * np.log10(np.maximum(rms, 1e-10))
+    return float(np.percentile(levels, LOUDNESS_PERCENTILE))
+
+
+def track_gain(path, fast=True):
+    y, sr = clustering.load_audio(path, 0.0, None, fast)
+    level = loudness(y, sr)
+    if level is None or level < SILENCE:
+        return 0.0
+    return float(np.clip(REFERENCE_LOUDNESS - level, -MAX_GAIN, MAX_GAIN))
+
+
+class LoudnessAnalyzer:
+    def __init__(self, metadata_cache, workers=None, fast=True):
+        self.metadata_cache = metadata_cache
+        self.fast = fast
+        self.pending = set()
+        self.tasks = []
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 2) - 1)
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def analyze(self, paths):
+        # looking up every track is as slow as the library is large, so it
+        # is done in the background as well
+        self.tasks.append(tasks.Task(self._submit, list(paths)).start())
+
+    def _submit(self, paths, task=None):
+        for i, path in enumerate(paths):
+            tasks.report(task, i, len(paths))
+            if path in self.pending \
+                    or self.metadata_cache.get(path, 'gain') is not None:
+                continue
+            self.pending.add(path)
+            future = self.executor.submit(track_gain, path, self.fast)
+            future.add_done_callback(
+                lambda future, path=path: self._store(path, future))
+
+    def _store(self, path, future):
+        self.pending.discard(path)
+        if future.cancelled():
+            return
+        try:
+            gain = future.result()
+        except Exception as e:
+            print(e)
+            return
+        self.metadata_cache.put(path, 'gain', gain)
+
+    def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,113 @@
+import collections
+import contextlib
+import cProfile
+import json
+import threading
+import time
+
+PREFIX = 'audioalbum_'
+
+
+class Timer(contextlib.ContextDecorator):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def _recreate_cm(self):
+        return Timer(self.metrics, self.name)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.timers = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def timed(self, name):
+        return Timer(self, name)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {
+                    name: {'count': count, 'total': total, 'max': longest}
+                    for name, (count, total, longest) in self.timers.items()},
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = '{}{}_total'.format(PREFIX, name)
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {}'.format(metric, value))
+        for name, timer in sorted(snapshot['timers'].items()):
+            metric = '{}{}_seconds'.format(PREFIX, name)
+            lines.append('# TYPE {} summary'.format(metric))
+            lines.append('{}_count {}'.format(metric, timer['count']))
+            lines.append('{}_sum {}'.format(metric, timer['total']))
+            lines.append('# TYPE {}_max gauge'.format(metric))
+            lines.append('{}_max {}'.format(metric, timer['max']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        if filename.endswith('.json'):
+            text = self.to_json()
+        else:
+            text = self.to_prometheus()
+        with open(filename, 'wt') as f:
+            f.write(text)
+
+
+METRICS = Metrics()
+
+
+@contextlib.contextmanager
+def profiled(filename):
+    if not filename:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
+
+
+def timed(name):
+    return METRICS.timed(name)
+
+
+def count(name, value=1):
+    METRICS.count(name, value)
@@ -0,0 +1,314 @@
+import array
+import sys
+
+VERSION_25 = 0
+VERSION_2 = 2
+VERSION_1 = 3
+
+LAYER_3 = 1
+LAYER_2 = 2
+LAYER_1 = 3
+
+BITRATES = {
+    (VERSION_1, LAYER_1): [0, 32, 64, 96, 128, 160, 192, 224,
+                           256, 288, 320, 352, 384, 416, 448],
+    (VERSION_1, LAYER_2): [0, 32, 48, 56, 64, 80, 96, 112,
+                           128, 160, 192, 224, 256, 320, 384],
+    (VERSION_1, LAYER_3): [0, 32, 40, 48, 56, 64, 80, 96,
+                           112, 128, 160, 192, 224, 256, 320],
+    (VERSION_2, LAYER_1): [0, 32, 48, 56, 64, 80, 96, 112,
+                           128, 144, 160, 176, 192, 224, 256],
+    (VERSION_2, LAYER_2): [0, 8, 16, 24, 32, 40, 48, 56,
+                           64, 80, 96, 112, 128, 144, 160],
+}
+BITRATES[(VERSION_2, LAYER_3)] = BITRATES[(VERSION_2, LAYER_2)]
+for _layer in (LAYER_1, LAYER_2, LAYER_3):
+    BITRATES[(VERSION_25, _layer)] = BITRATES[(VERSION_2, _layer)]
+
+SAMPLE_RATES = {
+    VERSION_1: [44100, 48000, 32000],
+    VERSION_2: [22050, 24000, 16000],
+    VERSION_25: [11025, 12000, 8000],
+}
+
+# frames between two entries of a seek index
+SEEK_INDEX_STEP = 4
+# enough for the first frame, where a Xing header would be
+FIRST_FRAME_PROBE_SIZE = 4096
+# bytes searched for the first frame when the audio does not start with it
+SYNC_PROBE_SIZE = 64 * 1024
+# without a Xing header the duration is estimated from the frame headers
+# of this many seconds, or of the first few frames when they all have the
+# same bitrate
+ESTIMATION_DURATION = 30
+CBR_DETECTION_FRAMES = 5
+ID3V1_SIZE = 128
+# the frame index is built from the file in chunks of this size
+SCAN_CHUNK_SIZE = 256 * 1024
+# longer than any frame, so a frame and the next header fit in the window
+FRAME_LOOKAHEAD = 4096
+# fixed-size and little-endian, so a saved index loads on any platform
+OFFSETS_TYPECODE = 'Q'
+
+
+class FrameHeader:
+    def __init__(self, version, layer, bitrate, sample_rate, padding,
+                 channels):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.channels = channels
+
+    @property
+    def samples(self):
+        if self.layer == LAYER_1:
+            return 384
+        if self.layer == LAYER_3 and self.version != VERSION_1:
+            return 576
+        return 1152
+
+    @property
+    def duration(self):
+        return self.samples / self.sample_rate
+
+    @property
+    def length(self):
+        if self.layer == LAYER_1:
+            return (12 * self.bitrate * 1000 // self.sample_rate
+                    + self.padding) * 4
+        return self.samples // 8 * self.bitrate * 1000 // self.sample_rate \
+            + self.padding
+
+    @property
+    def side_info_size(self):
+        if self.version == VERSION_1:
+            return 17 if self.channels == 1 else 32
+        return 9 if self.channels == 1 else 17
+
+
+def parse_header(data, offset=0):
+    if len(data) < offset + 4:
+        return None
+    b0, b1, b2, b3 = data[offset:offset + 4]
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 3
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) \
+            or sample_rate_index == 3:
+        return None
+    return FrameHeader(
+        version, layer,
+        BITRATES[(version, layer)][bitrate_index],
+        SAMPLE_RATES[version][sample_rate_index],
+        (b2 >> 1) & 1,
+        1 if b3 >> 6 == 3 else 2)
+
+
+def id3v2_size(data):
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def is_info_frame(data, offset, header):
+    xing = offset + 4 + header.side_info_size
+    vbri = offset + 36
+    return data[xing:xing + 4] in (b'Xing', b'Info') \
+        or data[vbri:vbri + 4] == b'VBRI'
+
+
+def info_frame_count(data, offset, header):
+    xing = offset + 4 + header.side_info_size
+    if data[xing:xing + 4] in (b'Xing', b'Info') \
+            and len(data) >= xing + 12 and data[xing + 7] & 1:
+        return int.from_bytes(data[xing + 8:xing + 12], 'big')
+    vbri = offset + 36
+    if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+        return int.from_bytes(data[vbri + 14:vbri + 18], 'big')
+    return None
+
+
+def find_first_frame(data, start=0, end=None):
+    offset = start
+    while True:
+        offset = data.find(b'\xff', offset, end)
+        if offset < 0:
+            return -1, None
+        header = parse_header(data, offset)
+        if header:
+            following = parse_header(data, offset + header.length)
+            if following and following.sample_rate == header.sample_rate \
+                    or offset + header.length == len(data):
+                return offset, header
+        offset += 1
+
+
+class FrameWindow:
+    # a sliding window over the file; offsets are relative to the window,
+    # base is the file offset of its first byte
+    def __init__(self, f, start, chunk_size=SCAN_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.base = start
+        self.data = b''
+        self.eof = False
+        f.seek(start)
+
+    def fill(self, offset):
+        if self.eof or len(self.data) - offset > FRAME_LOOKAHEAD:
+            return offset
+        size = max(self.chunk_size, 2 * FRAME_LOOKAHEAD)
+        chunk = self.f.read(size)
+        self.eof = len(chunk) < size
+        self.data = self.data[offset:] + chunk
+        self.base += offset
+        return 0
+
+    def find_frame(self, offset):
+        while True:
+            offset = self.fill(offset)
+            end = None if self.eof else len(self.data) - FRAME_LOOKAHEAD
+            found, header = find_first_frame(self.data, offset, end)
+            if header is not None or self.eof:
+                return found, header
+            offset = end
+
+
+def scan_frames(f, step=1, chunk_size=SCAN_CHUNK_SIZE):
+    f.seek(0)
+    window = FrameWindow(f, id3v2_size(f.read(10)), chunk_size)
+    offset, header = window.find_frame(0)
+    if header is None:
+        return None, array.array(OFFSETS_TYPECODE)
+    first = header
+    offset = window.fill(offset)
+    if is_info_frame(window.data, offset, header):
+        offset += header.length
+    offsets = array.array(OFFSETS_TYPECODE)
+    count = 0
+    while True:
+        offset = window.fill(offset)
+        header = parse_header(window.data, offset)
+        if header is None:
+            offset, header = window.find_frame(offset + 1)
+            if header is None:
+                break
+        if count % step == 0:
+            offsets.append(window.base + offset)
+        count += 1
+        offset += header.length
+    return first, offsets
+
+
+def read_first_frame(f, start):
+    # reads the first frame and the header after it, a few hundred bytes
+    # when the audio starts right after the ID3 tag
+    f.seek(start)
+    data = f.read(4)
+    header = parse_header(data)
+    if header is not None:
+        data += f.read(header.length)
+    offset, header = find_first_frame(data)
+    for probe_size in (FIRST_FRAME_PROBE_SIZE, SYNC_PROBE_SIZE):
+        if header is not None and offset + header.length <= len(data):
+            break
+        data += f.read(probe_size - len(data))
+        offset, header = find_first_frame(data)
+    return data, offset, header
+
+
+def estimate_duration(f, filesize):
+    # returns (duration, approximate); exact when the first frame is a
+    # Xing/Info/VBRI frame with a frame count, otherwise the remaining
+    # audio is assumed to have the average bitrate of the frames walked,
+    # reading only their headers
+    f.seek(0)
+    start = id3v2_size(f.read(10))
+    data, offset, header = read_first_frame(f, start)
+    if header is None:
+        return None, True
+    frames = info_frame_count(data, offset, header)
+    if frames:
+        return frames * header.duration, False
+    audio_start = start + offset
+    f.seek(-ID3V1_SIZE, 2)
+    tail = ID3V1_SIZE if f.read(3) == b'TAG' else 0
+    audio_end = filesize - tail
+    position = audio_start
+    if is_info_frame(data, offset, header):
+        position += header.length
+        f.seek(position)
+        header = parse_header(f.read(4))
+    size = duration = count = 0
+    bitrates = set()
+    while header is not None and position + header.length <= audio_end:
+        size += header.length
+        duration += header.duration
+        count += 1
+        if count <= CBR_DETECTION_FRAMES:
+            bitrates.add(header.bitrate)
+        if count == CBR_DETECTION_FRAMES and len(bitrates) == 1 \
+                or duration >= ESTIMATION_DURATION:
+            break
+        position += header.length
+        f.seek(position)
+        header = parse_header(f.read(4))
+    if size == 0:
+        return None, True
+    return (audio_end - audio_start) * duration / size, True
+
+
+class SeekIndex:
+    def __init__(self, frame_duration, offsets, step=SEEK_INDEX_STEP):
+        self.frame_duration = frame_duration
+        self.offsets = offsets
+        self.step = step
+
+    @property
+    def duration(self):
+        return len(self.offsets) * self.step * self.frame_duration
+
+    def lookup(self, position):
+        entry_duration = self.frame_duration * self.step
+        index = min(int(position / entry_duration), len(self.offsets) - 1)
+        index = max(index, 0)
+        return index * entry_duration, self.offsets[index]
+
+    def save(self):
+        offsets = array.array(OFFSETS_TYPECODE, self.offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return {
+            'frame_duration': self.frame_duration,
+            'step': self.step,
+            'typecode': OFFSETS_TYPECODE,
+            'offsets': offsets.tobytes(),
+        }
+
+    @classmethod
+    def load(cls, saved):
+        # indexes saved in another format are rebuilt
+        if saved.get('typecode') != OFFSETS_TYPECODE:
+            return None
+        offsets = array.array(OFFSETS_TYPECODE)
+        offsets.frombytes(saved['offsets'])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return cls(saved['frame_duration'], offsets, saved['step'])
+
+
+def build_seek_index(path):
+    with open(path, 'rb') as f:
+        header, offsets = scan_frames(f, SEEK_INDEX_STEP)
+    if header is None or not offsets:
+        return None
+    return SeekIndex(header.duration, offsets)
@@ -1,34 +1,552 @@
-import pygame
-from pygame import mixer
+import collections
+import struct
+import threading
+import time
+from tinytag import TinyTag
+from audioalbum import mp3
 
 ERROR_LOADING = 1
 
+TRACK_ENDED = 1
+TRACK_SWITCHED = 2
+
+
+class PlaybackError(Exception):
+    pass
+
+
+def gain_factor(gain):
+    return 10 ** (gain / 20)
+
+
+def wav_header(frequency, sample_size, channels, data_size):
+    # pygame mixes signed 16 bit or 32 bit float samples; 8 bit WAV data is
+    # unsigned, which pygame converts the same way
+    bits = abs(sample_size)
+    block_size = bits // 8 * channels
+    audio_format = 3 if bits == 32 else 1
+    return b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE' \
+        + b'fmt ' + struct.pack('<IHHIIHH', 16, audio_format, channels,
+                                frequency, frequency * block_size,
+                                block_size, bits) \
+        + b'data' + struct.pack('<I', data_size)
+
+
+class PCMStream:
+    # a WAV file over decoded PCM that is read in place, so starting it at
+    # any offset costs the same and copies only what the mixer reads
+    def __init__(self, header, data):
+        self.header = header
+        self.data = data
+        self.size = len(header) + len(data)
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.offset
+        chunk = self.header[self.offset:self.offset + size]
+        start = max(self.offset - len(self.header), 0)
+        end = min(start + size - len(chunk), len(self.data))
+        if end > start:
+            chunk += self.data[start:end]
+        self.offset += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        base = (0, self.offset, self.size)[whence]
+        self.offset = max(base + offset, 0)
+        return self.offset
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        self.data = b''
+
+
+class PygameBackend:
+    def __init__(self):
+        import pygame
+        self.pygame = pygame
+        self.mixer = pygame.mixer
+        self.stream = None
+
+    def init(self):
+        self.mixer.init()
+
+    def quit(self):
+        self.pygame.quit()
+        self.mixer.quit()
+
+    def get_init(self):
+        return bool(self.mixer.get_init())
+
+    def frame_format(self):
+        freq, size, channels = self.mixer.get_init()
+        return freq, abs(size) // 8 * channels
+
+    def load(self, path):
+        try:
+            self.mixer.music.load(path)
+        except self.pygame.error as e:
+            raise PlaybackError(e)
+        self._close_stream()
+
+    def load_at(self, path, byte_offset, position):
+        try:
+            stream = open(path, 'rb')
+        except OSError as e:
+            raise PlaybackError(e)
+        stream.seek(byte_offset)
+        try:
+            self.mixer.music.load(stream, 'mp3')
+        except self.pygame.error as e:
+            stream.close()
+            raise PlaybackError(e)
+        self._close_stream()
+        self.stream = stream
+
+    def load_pcm(self, data):
+        freq, size, channels = self.mixer.get_init()
+        stream = PCMStream(wav_header(freq, size, channels, len(data)), data)
+        try:
+            self.mixer.music.load(stream, 'wav')
+        except self.pygame.error as e:
+            raise PlaybackError(e)
+        self._close_stream()
+        self.stream = stream
+
+    def _close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def unload(self):
+        self.mixer.music.stop()
+        self.mixer.music.unload()
+        self._close_stream()
+
+    def queue(self, path):
+        try:
+            self.mixer.music.queue(path)
+        except self.pygame.error as e:
+            raise PlaybackError(e)
+
+    def play(self, start=0.0):
+        self.mixer.music.play(0, start)
+
+    def rewind(self):
+        self.mixer.music.rewind()
+
+    def pause(self):
+        self.mixer.music.pause()
+
+    def unpause(self):
+        self.mixer.music.unpause()
+
+    def stop(self):
+        self.mixer.music.stop()
+
+    def set_volume(self, value):
+        self.mixer.music.set_volume(value)
+
+    def get_busy(self):
+        return self.mixer.music.get_busy()
+
+    def get_pos(self):
+        return self.mixer.music.get_pos()
+
+    def decode(self, path):
+        try:
+            return self.mixer.Sound(path).get_raw()
+        except self.pygame.error as e:
+            raise PlaybackError(e)
+
+
+class NullChannel:
+    def __init__(self, duration, clock=time.monotonic):
+        self.duration = duration
+        self.clock = clock
+        self.started = clock()
+        self.paused_at = None
+
+    def get_busy(self):
+        if self.paused_at is not None:
+            return True
+        return self.clock() - self.started < self.duration
+
+    def pause(self):
+        self.paused_at = self.clock()
+
+    def unpause(self):
+        if self.paused_at is not None:
+            self.started += self.clock() - self.paused_at
+            self.paused_at = None
+
+    def stop(self):
+        self.duration = 0
+        self.paused_at = None
+
+    def set_volume(self, value):
+        pass
+
+
+class NullBackend:
+    FREQUENCY = 44100
+    FRAME_SIZE = 4
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.initialized = False
+        self.loaded = None
+        # seconds cut from the start of the loaded track by load_at
+        self.skipped = 0
+        self.queued = None
+        self.track = None
+        self.volume = 1.0
+
+    def init(self):
+        self.initialized = True
+
+    def quit(self):
+        self.initialized = False
+        self.unload()
+
+    def get_init(self):
+        return self.initialized
+
+    def frame_format(self):
+        return self.FREQUENCY, self.FRAME_SIZE
+
+    def _duration(self, path):
+        try:
+            return TinyTag.get(path).duration or 0
+        except Exception as e:
+            raise PlaybackError(e)
+
+    def load(self, path):
+        self.loaded = self._duration(path)
+        self.skipped = 0
+        self.queued = None
+        self.track = None
+
+    def load_at(self, path, byte_offset, position):
+        self.load(path)
+        self.skipped = min(position, self.loaded)
+
+    def load_pcm(self, data):
+        self.loaded = len(data) / (self.FREQUENCY * self.FRAME_SIZE)
+        self.skipped = 0
+        self.queued = None
+        self.track = None
+
+    def unload(self):
+        self.loaded = None
+        self.skipped = 0
+        self.queued = None
+        self.track = None
+
+    def queue(self, path):
+        self.queued = self._duration(path)
+
+    def play(self, start=0.0):
+        if self.loaded is None:
+            raise PlaybackError('music not loaded')
+        self.track = NullChannel(max(self.loaded - self.skipped - start, 0),
+                                 self.clock)
+
+    def _advance(self):
+        if self.track is None or self.track.get_busy() \
+                or self.queued is None:
+            return
+        started = self.track.started + self.track.duration
+        self.loaded, self.queued = self.queued, None
+        self.skipped = 0
+        self.track = NullChannel(self.loaded, self.clock)
+        self.track.started = started
+
+    def rewind(self):
+        # like a rewound file, the whole track plays again
+        if self.track is not None:
+            self.skipped = 0
+            self.play()
+
+    def pause(self):
+        if self.track is not None:
+            self.track.pause()
+
+    def unpause(self):
+        if self.track is not None:
+            self.track.unpause()
+
+    def stop(self):
+        self.track = None
+        self.queued = None
+
+    def set_volume(self, value):
+        self.volume = value
+
+    def get_busy(self):
+        self._advance()
+        return self.track is not None and self.track.paused_at is None \
+            and self.track.get_busy()
+
+    def get_pos(self):
+        self._advance()
+        if self.track is None or not self.track.get_busy():
+            return -1
+        now = self.track.paused_at or self.clock()
+        return int((now - self.track.started) * 1000)
+
+    def decode(self, path):
+        raise PlaybackError('null backend does not decode audio')
+
+
+BACKENDS = {
+    'pygame': PygameBackend,
+    'null': NullBackend,
+}
+
+
+class DecodedAudioCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        return path in self.items
+
+    def get(self, path):
+        with self.lock:
+            if path not in self.items:
+                return None
+            self.items.move_to_end(path)
+            return self.items[path]
+
+    def put(self, path, raw):
+        with self.lock:
+            if len(raw) > self.max_bytes:
+                return
+            if path in self.items:
+                self.size -= len(self.items.pop(path))
+            self.items[path] = raw
+            self.size += len(raw)
+            while self.size > self.max_bytes:
+                _, old_raw = self.items.popitem(last=False)
+                self.size -= len(old_raw)
+
+    def remove(self, path):
+        with self.lock:
+            if path in self.items:
+                self.size -= len(self.items.pop(path))
+
 
 class MusicPlayer:
-    def __init__(self, audio_files):
-        mixer.init()
-        mixer.music.set_volume(0.5)
+    def __init__(self, audio_files, gapless=False, cache_size=0,
+                 backend=None, metadata_cache=None, normalize=False):
+        self.backend = backend if backend is not None else PygameBackend()
+        self.backend.init()
+        self.backend.set_volume(0.5)
         self.audio_files = audio_files
+        self.gapless = gapless
+        self.cache = DecodedAudioCache(cache_size) if cache_size else None
+        self.metadata_cache = metadata_cache
+        self.normalize = normalize and metadata_cache is not None
+        self.seek_indexes = {}
+        self.volume = 0.5
+        self.repeat = False
         self.is_pause = False
+        self.is_playing = False
         self.current_audio = 0
+        self.queued_audio = None
+        self.last_pos = 0
+        self.offset = 0
+        self.partial = False
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.activity = threading.Event()
 
     def get_cur_audio_file(self):
         return self.audio_files[self.current_audio]
 
     def play(self, audio_number):
-        if self.is_pause:
-            mixer.music.unpause()
-            self.is_pause = False
-            return 0
-        try:
-            song = self.audio_files[audio_number].path()
-            mixer.music.load(song)
-        except pygame.error:
-            return ERROR_LOADING
-        self.current_audio = audio_number
-        mixer.music.play()
+        with self.lock:
+            if self.is_pause:
+                self.backend.unpause()
+                self.is_pause = False
+                self.activity.set()
+                return 0
+            try:
+                song = self.audio_files[audio_number].path()
+                self.backend.load(song)
+            except PlaybackError:
+                return ERROR_LOADING
+            self.current_audio = audio_number
+            self.queued_audio = None
+            self.generation += 1
+            self.last_pos = 0
+            self.offset = 0
+            self.partial = False
+            self.backend.set_volume(self.track_volume())
+            self.backend.play()
+            self.is_playing = True
+            self.activity.set()
+        if self.gapless:
+            self.preload_next()
+        if self.cache is not None and song not in self.cache:
+            threading.Thread(
+                target=self._decode, args=(song,), daemon=True).start()
+        if song.lower().endswith('.mp3') and song not in self.seek_indexes:
+            self.seek_indexes[song] = None
+            threading.Thread(
+                target=self._index, args=(song,), daemon=True).start()
         return 0
 
+    def _decode(self, song):
+        try:
+            raw = self.backend.decode(song)
+        except PlaybackError:
+            return
+        self.cache.put(song, raw)
+
+    def _index(self, song):
+        if self.metadata_cache is not None:
+            saved = self.metadata_cache.get(song, 'seek_index')
+            index = None if saved is None else mp3.SeekIndex.load(saved)
+            if index is not None:
+                self.seek_indexes[song] = index
+                return
+        try:
+            index = mp3.build_seek_index(song)
+        except OSError as e:
+            print(e)
+            return
+        if index is None:
+            return
+        if self.metadata_cache is not None:
+            self.metadata_cache.put(song, 'seek_index', index.save())
+        self.seek_indexes[song] = index
+
+    def _play_indexed(self, pos):
+        song = self.get_cur_audio_file().path()
+        index = self.seek_indexes.get(song)
+        if index is None:
+            return False
+        start, byte_offset = index.lookup(pos)
+        try:
+            self.backend.load_at(song, byte_offset, start)
+        except PlaybackError:
+            return False
+        self._started_at(start)
+        return True
+
+    def _play_decoded(self, pos):
+        if self.cache is None:
+            return False
+        raw = self.cache.get(self.get_cur_audio_file().path())
+        if raw is None:
+            return False
+        freq, frame_size = self.backend.frame_format()
+        start = min(int(pos * freq) * frame_size, len(raw))
+        # the mixer streams from a view of the cached samples, so a seek
+        # neither decodes nor copies the track
+        try:
+            self.backend.load_pcm(memoryview(raw)[start:])
+        except PlaybackError:
+            return False
+        self._started_at(start // frame_size / freq)
+        return True
+
+    def _started_at(self, pos):
+        self.backend.play()
+        self.queued_audio = None
+        self.generation += 1
+        self.last_pos = 0
+        self.offset = pos
+        # rewinding a track loaded from the middle restarts at that point
+        self.partial = pos > 0
+        if self.gapless:
+            self.preload_next()
+
+    def next_audio(self):
+        if self.repeat:
+            return self.current_audio
+        return (self.current_audio + 1) % len(self.audio_files)
+
+    def preload_next(self):
+        if not self.is_playing or len(self.audio_files) == 0:
+            return
+        audio_number = self.next_audio()
+        thread = threading.Thread(
+            target=self._queue,
+            args=(self.generation, audio_number,
+                  self.audio_files[audio_number].path()),
+            daemon=True)
+        thread.start()
+
+    def _queue(self, generation, audio_number, song):
+        with self.lock:
+            if generation != self.generation or not self.is_playing:
+                return
+            try:
+                self.backend.queue(song)
+            except PlaybackError:
+                self.queued_audio = None
+                return
+            self.queued_audio = audio_number
+
+    def is_active(self):
+        return self.is_playing and not self.is_pause
+
+    def remaining(self):
+        with self.lock:
+            if not self.is_playing \
+                    or not 0 <= self.current_audio < len(self.audio_files):
+                return None
+            duration = self.get_cur_audio_file().meta.duration
+            if not duration:
+                return None
+            return duration - self.position()
+
+    def position(self):
+        with self.lock:
+            if not self.is_playing or not self.backend.get_init():
+                return 0
+            pos = self.backend.get_pos()
+            if pos < 0:
+                return self.offset
+            return self.offset + pos / 1000
+
+    def check_track_end(self):
+        with self.lock:
+            if not self.is_playing or self.is_pause \
+                    or not self.backend.get_init():
+                return None
+            busy = self.backend.get_busy()
+            pos = self.backend.get_pos()
+            if busy and self.queued_audio is not None \
+                    and 0 <= pos < self.last_pos:
+                self.current_audio = self.queued_audio
+                self.queued_audio = None
+                self.generation += 1
+                self.last_pos = pos
+                self.offset = 0
+                self.backend.set_volume(self.track_volume())
+                switched = True
+            else:
+                self.last_pos = pos
+                switched = False
+            if not busy:
+                self.is_playing = False
+                return TRACK_ENDED
+        if switched:
+            if self.gapless:
+                self.preload_next()
+            return TRACK_SWITCHED
+        return None
+
     def play_next(self):
         self.is_pause = False
         return self.play((self.current_audio + 1) % len(self.audio_files))
@@ -40,27 +558,127 @@ class MusicPlayer:
             % len(self.audio_files))
 
     def pause(self):
-        mixer.music.pause()
+        self.backend.pause()
         self.is_pause = True
 
     def play_again(self):
-        mixer.music.rewind()
+        with self.lock:
+            self.activity.set()
+            if self.partial:
+                self._reload()
+                return
+            self.backend.rewind()
+            self.last_pos = 0
+            self.offset = 0
+
+    def _reload(self):
+        if self._play_decoded(0):
+            return
+        try:
+            self.backend.load(self.get_cur_audio_file().path())
+        except PlaybackError:
+            return
+        self._started_at(0)
+
+    def track_volume(self):
+        if not self.normalize \
+                or not 0 <= self.current_audio < len(self.audio_files):
+            return self.volume
+        gain = self.metadata_cache.get(self.get_cur_audio_file().path(),
+                                       'gain')
+        if gain is None:
+            return self.volume
+        return min(1.0, self.volume * gain_factor(gain))
 
     def change_volume(self, value):
-        mixer.music.set_volume(value)
+        self.volume = value
+        volume = self.track_volume()
+        self.backend.set_volume(volume)
 
     def music_is_playing(self):
-        return mixer.music.get_busy()
+        return self.backend.get_busy()
 
     def play_from_position(self, pos):
         if not self.music_is_playing():
             return
-        mixer.music.rewind()
-        mixer.music.play(0, pos)
+        with self.lock:
+            self.activity.set()
+            if self._play_decoded(pos) or self._play_indexed(pos):
+                return
+            if self.partial:
+                self._reload()
+            self.backend.rewind()
+            self.backend.play(pos)
+            self.last_pos = 0
+            self.offset = pos
+
+    def forget(self, path):
+        self.seek_indexes.pop(path, None)
+        if self.cache is not None:
+            self.cache.remove(path)
+
+    def release(self):
+        with self.lock:
+            self.is_playing = False
+            self.is_pause = False
+            self.queued_audio = None
+            self.generation += 1
+            self.backend.unload()
 
     def stop(self):
-        pygame.quit()
-        mixer.quit()
+        with self.lock:
+            self.is_playing = False
+            self.queued_audio = None
+            self.generation += 1
+            self.backend.quit()
 
     def restart(self):
-        mixer.init()
+        self.backend.init()
+        self.backend.set_volume(self.volume)
+
+
+class PlaybackMonitor(threading.Thread):
+    def __init__(self, player, on_track_end, on_position=None,
+                 interval=0.05, position_interval=1.0):
+        super().__init__(daemon=True)
+        self.player = player
+        self.on_track_end = on_track_end
+        self.on_position = on_position
+        self.interval = interval
+        self.position_interval = position_interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        last_report = 0
+        while not self.stopped.is_set():
+            if not self.player.is_active():
+                self.player.activity.wait()
+                self.player.activity.clear()
+                last_report = 0
+                continue
+            state = self.player.check_track_end()
+            if state:
+                self.on_track_end(state)
+            now = time.monotonic()
+            if self.on_position and self.player.is_active() \
+                    and now - last_report >= self.position_interval:
+                self.on_position(self.player.position())
+                last_report = now
+            # play, pause, seek and stop set activity, the wait ends early
+            # when the expected end moves
+            self.player.activity.wait(self.timeout(last_report))
+            self.player.activity.clear()
+
+    def timeout(self, last_report):
+        timeout = self.player.remaining()
+        if timeout is None:
+            timeout = self.position_interval
+        if self.on_position:
+            timeout = min(timeout, last_report + self.position_interval
+                          - time.monotonic())
+        # past the expected end the mixer is still draining, it is polled
+        return max(timeout, self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.player.activity.set()
@@ -0,0 +1,135 @@
+import random
+from collections import defaultdict
+
+
+class Playlist:
+    def __init__(self, files, names=None):
+        self.reset(files, names)
+
+    def reset(self, files, names=None):
+        self.files = files
+        self.names = names
+        self.base = list(range(len(files)))
+        self.order = list(self.base)
+        self.rows = list(self.base)
+        self.shuffled = False
+        self._update_indices()
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, row):
+        return self.files[self.order[row]]
+
+    def __iter__(self):
+        for i in self.order:
+            yield self.files[i]
+
+    def name(self, row):
+        i = self.order[row]
+        if self.names is None:
+            return self.files[i].name
+        return self.names[i]
+
+    def index(self, row):
+        if not 0 <= row < len(self.order):
+            return -1
+        return self.order[row]
+
+    def row(self, index):
+        if not 0 <= index < len(self.rows):
+            return -1
+        return self.rows[index]
+
+    def rows_of(self, audio_file):
+        return sorted(self.rows[i] for i in self.indices.get(audio_file, ()))
+
+    def row_of(self, audio_file):
+        rows = self.rows_of(audio_file)
+        if not rows:
+            return -1
+        return rows[0]
+
+    def shuffle(self):
+        random.shuffle(self.order)
+        self._update_rows()
+        self.shuffled = True
+
+    def unshuffle(self):
+        self.order = list(self.base)
+        self._update_rows()
+        self.shuffled = False
+
+    def rename(self, row, name):
+        if self.names is not None:
+            self.names[self.order[row]] = name
+
+    def insert(self, row, audio_file, name=None):
+        i = len(self.files)
+        self.files.append(audio_file)
+        if self.names is not None:
+            self.names.append(name if name is not None else audio_file.name)
+        self.indices[audio_file].append(i)
+        self.order.insert(row, i)
+        self.rows.append(row)
+        for moved_row in range(row + 1, len(self.order)):
+            self.rows[self.order[moved_row]] = moved_row
+        self._place_in_base(row)
+
+    def append(self, audio_file, name=None):
+        self.insert(len(self.order), audio_file, name)
+
+    def move(self, row, new_row):
+        i = self.order.pop(row)
+        self.order.insert(new_row, i)
+        for moved_row in range(min(row, new_row),
+                               max(row, new_row) + 1):
+            self.rows[self.order[moved_row]] = moved_row
+        self.base.remove(i)
+        self._place_in_base(new_row)
+
+    def remove(self, row):
+        i = self.order.pop(row)
+        audio_file = self.files.pop(i)
+        if self.names is not None:
+            self.names.pop(i)
+        self.base.remove(i)
+        self.order = [j - 1 if j > i else j for j in self.order]
+        self.base = [j - 1 if j > i else j for j in self.base]
+        self._update_indices()
+        self._update_rows()
+        return audio_file
+
+    def remove_files(self, audio_files):
+        keep = [i for i, file in enumerate(self.files)
+                if file not in audio_files]
+        new_indices = {i: j for j, i in enumerate(keep)}
+        self.order = [new_indices[i] for i in self.order if i in new_indices]
+        self.base = [new_indices[i] for i in self.base if i in new_indices]
+        self.files[:] = [self.files[i] for i in keep]
+        if self.names is not None:
+            self.names[:] = [self.names[i] for i in keep]
+        self._update_indices()
+        self._update_rows()
+        return new_indices
+
+    def _place_in_base(self, row):
+        # the track follows the same track in the base order as in the
+        # current one, so unshuffle keeps tracks inserted or moved while
+        # shuffled; unshuffled, base and order stay equal
+        i = self.order[row]
+        if row == 0:
+            self.base.insert(0, i)
+        else:
+            self.base.insert(self.base.index(self.order[row - 1]) + 1, i)
+
+    def _update_indices(self):
+        # an album can hold the same track more than once
+        self.indices = defaultdict(list)
+        for i, file in enumerate(self.files):
+            self.indices[file].append(i)
+
+    def _update_rows(self):
+        self.rows = [0] * len(self.order)
+        for row, i in enumerate(self.order):
+            self.rows[i] = row
@@ -0,0 +1,80 @@
+import threading
+from concurrent.futures import Future
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+class Task:
+    def __init__(self, func, *args, progress=None, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.progress_callback = progress
+        self.token = CancellationToken()
+        self.future = Future()
+        self.thread = None
+
+    def report(self, done, total=0):
+        self.token.check()
+        if self.progress_callback:
+            self.progress_callback(done, total)
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.func(*self.args, task=self, **self.kwargs)
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.token.cancel()
+        self.future.cancel()
+
+    def cancelled(self):
+        return self.token.cancelled
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def add_done_callback(self, callback):
+        self.future.add_done_callback(lambda future: callback(self))
+
+
+def report(task, done, total=0):
+    if task is not None:
+        task.report(done, total)
+
+
+def run(func, *args, progress=None, **kwargs):
+    task = Task(func, *args, progress=progress, **kwargs)
+    task.run()
+    return task.result()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from audioalbum import clustering
+
+
+class SyntheticFeatures:
+    def __init__(self, vector):
+        self.vector = vector
+        self.cluster_index = -1
+
+
+def make_features(count, centers, seed):
+    rng = np.random.default_rng(seed)
+    centroids = rng.normal(0, 10, (centers, clustering.FEATURES_COUNT))
+    labels = rng.integers(0, centers, count)
+    vectors = centroids[labels] + rng.normal(
+        0, 1, (count, clustering.FEATURES_COUNT))
+    return [SyntheticFeatures(vector.astype(np.float32))
+            for vector in vectors]
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def run(tracks, n, new_tracks):
+    features_list = make_features(tracks, n, 0)
+    new_features = make_features(new_tracks, n, 1)
+    row = [tracks]
+    models = {}
+    for backend in clustering.BACKENDS:
+        elapsed, models[backend] = measure(
+            clustering.fit_model, features_list, n, backend)
+        row.append(elapsed)
+    elapsed, _ = measure(
+        clustering.update, features_list + new_features, models['minibatch'],
+        new_features)
+    row.append(elapsed)
+    return row
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='compare clustering backends')
+    parser.add_argument('-t', '--tracks', nargs='+', type=int,
+                        default=[1000, 10000, 50000],
+                        help='library sizes (default: 1000 10000 50000)')
+    parser.add_argument('-n', '--clusters', type=int, default=10,
+                        help='number of clusters (default: 10)')
+    parser.add_argument('--new', type=int, default=100,
+                        help='newly scanned tracks to assign (default: 100)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    columns = ['tracks'] + \
+        ['{} fit, s'.format(name) for name in clustering.BACKENDS] + \
+        ['assign {} new, s'.format(args.new)]
+    print('\t'.join(columns))
+    for tracks in args.tracks:
+        row = run(tracks, args.clusters, args.new)
+        print('\t'.join([str(row[0])] + ['{:.3f}'.format(x)
+                                         for x in row[1:]]))
+
+
+if __name__ == '__main__':
+    main()
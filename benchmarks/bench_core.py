@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+import numpy as np
+import soundfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from audioalbum import files, albumsys, clustering
+
+ARTISTS = 500
+ALBUM_SIZE = 20
+DUPLICATE_EVERY = 10
+FILES_PER_DIRECTORY = 1000
+
+
+class SyntheticAudioFile:
+    def __init__(self, i):
+        self.directory = '/music/{:04}'.format(i // FILES_PER_DIRECTORY)
+        self.name = 'track {}'.format(i)
+        self.format = 'mp3'
+        self.file_name = '{}.{}'.format(self.name, self.format)
+        self.index = None
+        self.hash = None
+        self.meta = SimpleNamespace(
+            title='title {}'.format(i), artist='artist {}'.format(i % ARTISTS),
+            album='album {}'.format(i // ALBUM_SIZE),
+            genre='genre {}'.format(i % 20), year=str(1960 + i % 60),
+            duration=180.0, filesize=4000000)
+
+    def path(self):
+        return os.path.join(self.directory, self.file_name)
+
+
+class SyntheticFeatures:
+    def __init__(self, audio_file, vector):
+        self.audio_file = audio_file
+        self.vector = vector
+        self.cluster_index = -1
+
+
+def tiny_wav():
+    stream = io.BytesIO()
+    soundfile.write(stream, np.zeros(64, dtype=np.int16), 8000,
+                    format='WAV', subtype='PCM_16')
+    return bytearray(stream.getvalue())
+
+
+def generate_library(directory, count):
+    data = tiny_wav()
+    for i in range(count):
+        subdirectory = os.path.join(
+            directory, '{:04}'.format(i // FILES_PER_DIRECTORY))
+        if i % FILES_PER_DIRECTORY == 0:
+            os.mkdir(subdirectory)
+        # the first two tracks of every DUPLICATE_EVERY share their content
+        content = i - i % 2 if i % DUPLICATE_EVERY < 2 else i
+        data[-4:] = content.to_bytes(4, 'little')
+        with open(os.path.join(subdirectory, 'track {}.wav'.format(i)),
+                  'wb') as f:
+            f.write(data)
+
+
+class Library:
+    def __init__(self, count, on_disk):
+        self.count = count
+        self.tmp = None
+        self.audio_files = [SyntheticAudioFile(i) for i in range(count)]
+        if on_disk:
+            self.tmp = tempfile.TemporaryDirectory()
+            generate_library(self.tmp.name, count)
+            self.directory = self.tmp.name
+            self.disk_files = files.find_audio_files(
+                self.directory, True, ['wav'])
+
+    def cleanup(self):
+        if self.tmp is not None:
+            self.tmp.cleanup()
+
+
+def saved_albums(library):
+    editor = albumsys.AlbumEditor()
+    for start in range(0, library.count, ALBUM_SIZE):
+        album = albumsys.Album('album {}'.format(start), [])
+        album.add_audio_files(library.disk_files[start:start + ALBUM_SIZE])
+        editor.add_album(album)
+    return editor
+
+
+def bench_find_audio_files(library):
+    return lambda: files.find_audio_files(library.directory, True, ['wav'])
+
+
+def bench_find_all_repetitions(library):
+    def run():
+        for audio in library.disk_files:
+            audio.hash = None
+        return files.find_all_repetitions(library.disk_files)
+    return run
+
+
+def bench_find_name_in_files(library):
+    return lambda: files.find_name_in_files('track 1', library.audio_files)
+
+
+def bench_save_albums(library):
+    editor = saved_albums(library)
+    return editor.save_albums
+
+
+def bench_load_albums(library):
+    # separators as cli.export reads them back from the saved file
+    saved = saved_albums(library).save_albums().replace('\r', '\n')
+    return lambda: albumsys.AlbumEditor().load_albums(saved)
+
+
+def bench_make_albums(library):
+    def run():
+        maker = albumsys.AutoAlbumsMaker(library.audio_files)
+        for info in ('artist', 'album', 'genre', 'year'):
+            maker.make_albums(info)
+        return maker
+    return run
+
+
+def bench_clusters(library):
+    rng = np.random.default_rng(0)
+    features_list = [
+        SyntheticFeatures(audio, vector) for audio, vector in zip(
+            library.audio_files,
+            rng.normal(0, 1, (library.count, clustering.FEATURES_COUNT))
+            .astype(np.float32))]
+    return lambda: clustering.clusters(features_list, 10)
+
+
+# name: (setup, needs files on disk, largest library size by default)
+BENCHMARKS = {
+    'find_audio_files': (bench_find_audio_files, True, 10000),
+    'find_all_repetitions': (bench_find_all_repetitions, True, 10000),
+    'find_name_in_files': (bench_find_name_in_files, False, 1000000),
+    'save_albums': (bench_save_albums, True, 10000),
+    'load_albums': (bench_load_albums, True, 10000),
+    'make_albums': (bench_make_albums, False, 1000000),
+    'clusters': (bench_clusters, False, 100000),
+}
+
+
+def measure(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak / 1024 ** 2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='time and memory of the audioalbum core operations')
+    parser.add_argument('-t', '--tracks', nargs='+', type=int,
+                        default=[1000, 10000, 100000, 1000000],
+                        help='library sizes (default: 1000 10000 100000 '
+                             '1000000)')
+    parser.add_argument('-b', '--benchmarks', nargs='+',
+                        default=list(BENCHMARKS), choices=list(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='timed runs, the best is reported (default: 3)')
+    parser.add_argument('--no-limits', action='store_true',
+                        help='run every benchmark at every size, including '
+                             'generating huge libraries on disk')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with results saved by --save')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(result['benchmark'], result['tracks']): result
+                        for result in json.load(f)}
+    results = []
+    print('benchmark\ttracks\tbest, s\tpeak, MB\tvs baseline')
+    for tracks in sorted(args.tracks):
+        selected = [name for name in args.benchmarks
+                    if args.no_limits or tracks <= BENCHMARKS[name][2]]
+        if not selected:
+            continue
+        library = Library(
+            tracks, any(BENCHMARKS[name][1] for name in selected))
+        try:
+            for name in selected:
+                elapsed, peak = measure(BENCHMARKS[name][0](library),
+                                        args.repeat)
+                results.append({'benchmark': name, 'tracks': tracks,
+                                'seconds': elapsed, 'peak_mb': peak})
+                previous = baseline.get((name, tracks))
+                ratio = '{:.2f}x'.format(elapsed / previous['seconds']) \
+                    if previous else '-'
+                print('{}\t{}\t{:.4f}\t{:.1f}\t{}'.format(
+                    name, tracks, elapsed, peak, ratio))
+        finally:
+            library.cleanup()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
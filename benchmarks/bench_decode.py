@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import soundfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from audioalbum import files, clustering
+
+
+def generate_tracks(directory, count, duration, formats):
+    rng = np.random.default_rng(0)
+    sr = 44100
+    t = np.arange(int(sr * duration)) / sr
+    for i in range(count):
+        y = 0.3 * np.sin(2 * np.pi * 110 * (1 + i % 5) * t) + \
+            0.05 * rng.standard_normal(len(t))
+        data = np.stack([y, y], axis=1)
+        audio_format = formats[i % len(formats)]
+        soundfile.write(
+            os.path.join(directory, 'track{:03}.{}'.format(i, audio_format)),
+            data, sr, format=audio_format.upper())
+
+
+def measure(audio_files, fast):
+    timings = []
+    for audio in audio_files:
+        start = time.perf_counter()
+        clustering.get_features(audio, fast)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='compare feature extraction decode paths')
+    parser.add_argument('-d', '--directory',
+                        help='music directory (default: generated tracks)')
+    parser.add_argument('-f', '--formats', nargs='+', default=['mp3', 'wav'],
+                        help='audio formats (default: mp3 wav)')
+    parser.add_argument('-n', '--count', type=int, default=10,
+                        help='number of generated tracks (default: 10)')
+    parser.add_argument('--duration', type=float, default=180.0,
+                        help='generated track duration, s (default: 180)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.directory
+        if not directory:
+            directory = tmp
+            generate_tracks(tmp, args.count, args.duration, args.formats)
+        audio_files = files.find_audio_files(directory, True, args.formats)
+        if not audio_files:
+            print('no audio files found')
+            return
+        clustering.get_features(audio_files[0])
+        print('format\tpath\tmean, s\tmax, s')
+        for audio_format in args.formats:
+            group = [audio for audio in audio_files
+                     if audio.format == audio_format]
+            if not group:
+                continue
+            for name, fast in (('librosa', False), ('fast', True)):
+                timings = measure(group, fast)
+                print('{}\t{}\t{:.3f}\t{:.3f}'.format(
+                    audio_format, name, np.mean(timings), np.max(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import filecmp
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import soundfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from audioalbum import files
+
+SAMPLE_RATE = 44100
+
+
+def generate_flac(path, minutes, seed):
+    # noise barely compresses, so the files stay close to CD size
+    rng = np.random.default_rng(seed)
+    with soundfile.SoundFile(path, 'w', SAMPLE_RATE, 2, 'PCM_16',
+                             format='FLAC') as f:
+        for _ in range(minutes):
+            f.write(rng.normal(0, 0.2, (SAMPLE_RATE * 60, 2)))
+
+
+def buffered_hash_md5(filename):
+    # get_hash_md5 before memory mapping
+    with open(filename, 'rb') as f:
+        m = hashlib.md5()
+        while True:
+            data = f.read(8192)
+            if not data:
+                break
+            m.update(data)
+        return m.hexdigest()
+
+
+def buffered_same(path_1, path_2):
+    # without the cache every repeat after the first would be free
+    filecmp.clear_cache()
+    return filecmp.cmp(path_1, path_2, shallow=False)
+
+
+def run(paths, hash_md5, same):
+    start = time.perf_counter()
+    hashes = [hash_md5(path) for path in paths]
+    hashed = time.perf_counter()
+    for path_1, path_2 in zip(paths[::2], paths[1::2]):
+        same(path_1, path_2)
+    compared = time.perf_counter()
+    return hashes, hashed - start, compared - hashed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='buffered versus memory-mapped hashing and comparison '
+                    'of large FLAC files')
+    parser.add_argument('-n', '--files', type=int, default=4,
+                        help='number of files, copied in pairs (default: 4)')
+    parser.add_argument('-m', '--minutes', type=int, default=10,
+                        help='length of every file (default: 10)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='timed runs, the best is reported (default: 3)')
+    parser.add_argument('-d', '--directory',
+                        help='where to write the files (default: a '
+                             'temporary directory)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    tmp = tempfile.TemporaryDirectory(dir=args.directory)
+    try:
+        paths = []
+        for i in range(0, args.files, 2):
+            path = os.path.join(tmp.name, 'track {}.flac'.format(i))
+            generate_flac(path, args.minutes, i)
+            copy = os.path.join(tmp.name, 'track {}.flac'.format(i + 1))
+            shutil.copyfile(path, copy)
+            paths += [path, copy]
+        size = sum(os.path.getsize(path) for path in paths) / 1024 ** 2
+        print('{} files, {:.0f} MB'.format(len(paths), size))
+        print('path\thash, s\thash, MB/s\tcompare, s\tcompare, MB/s')
+        expected = None
+        for name, hash_md5, same in (
+                ('buffered', buffered_hash_md5, buffered_same),
+                ('mmap', files.get_hash_md5, files.same_contents)):
+            timings = [run(paths, hash_md5, same)
+                       for _ in range(args.repeat)]
+            hashes = timings[0][0]
+            if expected is None:
+                expected = hashes
+            elif hashes != expected:
+                sys.exit('{} hashes differ'.format(name))
+            hashing = min(timing[1] for timing in timings)
+            comparing = min(timing[2] for timing in timings)
+            print('{}\t{:.3f}\t{:.0f}\t{:.3f}\t{:.0f}'.format(
+                name, hashing, size / hashing, comparing, size / comparing))
+    finally:
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
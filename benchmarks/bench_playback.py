@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import soundfile
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from audioalbum import files, playback
+
+
+def generate_tracks(directory, count, duration):
+    sr = 44100
+    t = np.arange(int(sr * duration)) / sr
+    for i in range(count):
+        y = 0.2 * np.sin(2 * np.pi * 220 * (1 + i) * t)
+        soundfile.write(os.path.join(directory, 'track{}.wav'.format(i)),
+                        y, sr)
+
+
+class TrackAdvancer:
+    def __init__(self, player, count, advance):
+        self.player = player
+        self.count = count
+        self.advance = advance
+        self.started = 1
+        self.done = threading.Event()
+
+    def on_track_end(self, state):
+        if state == playback.TRACK_ENDED and self.started == self.count:
+            self.done.set()
+            return
+        if state == playback.TRACK_SWITCHED:
+            self.started += 1
+        elif self.advance:
+            self.player.play_next()
+            self.started += 1
+
+
+class SilenceProbe(threading.Thread):
+    def __init__(self, backend, interval=0.002):
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.interval = interval
+        self.gaps = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        silence_start = None
+        while not self.stopped.wait(self.interval):
+            busy = self.backend.get_busy()
+            if not busy and silence_start is None:
+                silence_start = time.perf_counter()
+            elif busy and silence_start is not None:
+                self.gaps.append(time.perf_counter() - silence_start)
+                silence_start = None
+
+
+def measure(audio_files, gapless, interval, backend):
+    player = playback.MusicPlayer(
+        audio_files, gapless, backend=playback.BACKENDS[backend]())
+    advancer = TrackAdvancer(player, len(audio_files), not gapless)
+    monitor = playback.PlaybackMonitor(
+        player, advancer.on_track_end, interval=interval)
+    probe = SilenceProbe(player.backend)
+    player.play(0)
+    probe.start()
+    # a GUI timer fires at an arbitrary phase relative to the track end
+    time.sleep(interval / 2)
+    monitor.start()
+    timeout = sum(audio.meta.duration for audio in audio_files) + 10
+    advancer.done.wait(timeout)
+    monitor.stop()
+    probe.stopped.set()
+    probe.join()
+    player.stop()
+    transitions = len(audio_files) - 1
+    return sum(probe.gaps) / transitions, max(probe.gaps, default=0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='measure the silence between consecutive tracks')
+    parser.add_argument('-n', '--count', type=int, default=4,
+                        help='number of generated tracks (default: 4)')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='generated track duration, s (default: 2)')
+    parser.add_argument('-a', '--audio-backend', default='pygame',
+                        choices=list(playback.BACKENDS),
+                        help='audio output (default: pygame)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    modes = [
+        ('poll 1 s', False, 1.0),
+        ('monitor', False, 0.05),
+        ('gapless', True, 0.05),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        generate_tracks(directory, args.count, args.duration)
+        audio_files = files.find_audio_files(directory, False, ['wav'])
+        print('mode\tmean gap, ms\tmax gap, ms')
+        for name, gapless, interval in modes:
+            mean_gap, max_gap = measure(
+                audio_files, gapless, interval, args.audio_backend)
+            print('{}\t{:.1f}\t{:.1f}'.format(
+                name, 1000 * mean_gap, 1000 * max_gap))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.path.pardir)
+HEAVY_MODULES = ['librosa', 'sklearn', 'pygame', 'PyQt5']
+PROBE = '''
+import json
+import resource
+import sys
+import {module}
+print(json.dumps({{
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'heavy': [name for name in {heavy} if name in sys.modules],
+}}))
+'''
+# import time, ms, and peak RSS, MB, allowed for each entry point
+BUDGETS = {
+    'audioalbum.cli': (300, 60),
+    'audioalbum.clustering': (300, 60),
+    'audioalbum.playback': (100, 30),
+    'album': (600, 100),
+}
+
+
+def measure(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True, cwd=ROOT, check=True)
+    import_time = None
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = [field.strip() for field in line.split('|')]
+        if fields[-1] == module:
+            import_time = int(fields[1]) / 1000
+    probe = json.loads(result.stdout.splitlines()[-1])
+    return import_time, probe['rss'] / 1024, probe['heavy']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='check import time and memory of the entry points')
+    parser.add_argument('-m', '--modules', nargs='+', default=list(BUDGETS),
+                        help='modules to import (default: all entry points)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the budgets, for slow machines '
+                             '(default: 1)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    over_budget = False
+    print('module\timport, ms\tpeak RSS, MB\theavy modules\tstatus')
+    for module in args.modules:
+        import_time, rss, heavy = measure(module)
+        time_budget, rss_budget = BUDGETS.get(module, (float('inf'),) * 2)
+        ok = import_time <= time_budget * args.scale \
+            and rss <= rss_budget * args.scale
+        over_budget = over_budget or not ok
+        print('{}\t{:.0f}\t{:.0f}\t{}\t{}'.format(
+            module, import_time, rss, ','.join(heavy) or '-',
+            'ok' if ok else 'over budget'))
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,29 @@ import unittest
 import sys
 import os
 import random
-from unittest.mock import patch
+import contextlib
+import csv
+import errno
+import hashlib
+import io
+import json
+import subprocess
+import tempfile
+import threading
+import time
+from unittest.mock import Mock, patch
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              os.path.pardir))
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              os.path.pardir, 'audioalbum'))
-from audioalbum import files, albumsys
+import numpy as np
+import soundfile
+from audioalbum import files, albumsys, clustering, playlist, playback, \
+    mp3, cache, loudness, fsystem, journal, cli, metrics, tasks, library, \
+    database
+from PyQt5 import QtCore
+import album
 
 
 class AlbumSaveTests(unittest.TestCase):
@@ -656,5 +672,2275 @@ class FilesSearchTest(unittest.TestCase):
         self.assertIn('audio.wav', audio)
 
 
+class ClusteringTests(unittest.TestCase):
+    @patch('clustering.AudioFileFeatures')
+    def _get_mock_features(self, mock_features):
+        features = mock_features()
+        return features
+
+    def _get_features_list(self, centers, count):
+        features_list = []
+        for center in centers:
+            for i in range(count):
+                features = self._get_mock_features()
+                features.vector = np.full(
+                    clustering.FEATURES_COUNT, center + i * 0.01,
+                    dtype=np.float32)
+                features_list.append(features)
+        return features_list
+
+    def test_features_matrix(self):
+        features_list = self._get_features_list([0, 10], 3)
+
+        matrix = clustering.features_matrix(features_list)
+
+        self.assertEqual((6, clustering.FEATURES_COUNT), matrix.shape)
+        self.assertEqual(np.float32, matrix.dtype)
+        self.assertTrue(matrix.flags['C_CONTIGUOUS'])
+
+    def test_summarize_short_signal(self):
+        vector = clustering.summarize(np.zeros(0, dtype=np.float32), 10000)
+
+        self.assertEqual((clustering.FEATURES_COUNT,), vector.shape)
+
+    def test_clusters(self):
+        features_list = self._get_features_list([0, 10], 5)
+
+        result = clustering.clusters(features_list, 2)
+
+        self.assertEqual([5, 5], sorted(len(cluster) for cluster in result))
+        self.assertEqual(
+            1, len({features.cluster_index for features in features_list[:5]}))
+        self.assertNotEqual(features_list[0].cluster_index,
+                            features_list[5].cluster_index)
+
+    def test_minibatch_assign_new_tracks(self):
+        features_list = self._get_features_list([0, 10], 5)
+        new_features = self._get_features_list([0, 10], 1)
+
+        model = clustering.fit_model(features_list, 2, 'minibatch')
+        old_labels = list(model.labels)
+        labels = clustering.update(features_list + new_features, model,
+                                   new_features)
+
+        self.assertEqual(old_labels, list(labels[:10]))
+        self.assertEqual(old_labels[0], labels[10])
+        self.assertEqual(old_labels[5], labels[11])
+        self.assertEqual(list(labels), list(model.labels))
+
+
+class ModelCacheTests(unittest.TestCase):
+    @patch('clustering.AudioFileFeatures')
+    def _get_mock_features(self, mock_features):
+        features = mock_features()
+        return features
+
+    def _get_features_list(self, count):
+        features_list = []
+        for i in range(count):
+            features = self._get_mock_features()
+            features.audio_file.path.return_value = 'path{}'.format(i)
+            features.vector = np.full(
+                clustering.FEATURES_COUNT, i % 3 * 10 + i * 0.01,
+                dtype=np.float32)
+            features_list.append(features)
+        return features_list
+
+    def test_model_is_cached(self):
+        features_list = self._get_features_list(9)
+        cache = clustering.ModelCache()
+
+        model = cache.get(features_list, 3)
+
+        self.assertTrue(cache.cached(features_list, 3))
+        self.assertFalse(cache.cached(features_list, 2))
+        self.assertIs(model, cache.get(features_list, 3))
+
+    def test_other_feature_set_is_not_cached(self):
+        features_list = self._get_features_list(9)
+        cache = clustering.ModelCache()
+
+        cache.get(features_list, 3)
+
+        self.assertFalse(cache.cached(features_list[1:], 3))
+
+    def test_given_key_is_used(self):
+        features_list = self._get_features_list(9)
+        cache = clustering.ModelCache()
+
+        with patch.object(clustering, 'feature_set_key') as feature_set_key:
+            cache.get(features_list, 2, key='key')
+            cached = cache.cached(features_list, 2, 'key')
+
+        feature_set_key.assert_not_called()
+        self.assertTrue(cached)
+        self.assertFalse(cache.cached(features_list, 2))
+
+    def test_sweep_computes_key_once(self):
+        features_list = self._get_features_list(9)
+        cache = clustering.ModelCache()
+
+        with patch.object(clustering, 'feature_set_key',
+                          return_value='key') as feature_set_key:
+            clustering.sweep(features_list, range(2, 5), cache)
+
+        self.assertEqual(1, feature_set_key.call_count)
+        self.assertTrue(cache.cached(features_list, 4, 'key'))
+
+    def test_concurrent_get_fits_once(self):
+        features_list = self._get_features_list(9)
+        cache = clustering.ModelCache()
+        fit = clustering.ClusterModel.fit
+        fitted = []
+
+        def slow_fit(model, matrix):
+            fitted.append(model.n)
+            time.sleep(0.05)
+            return fit(model, matrix)
+
+        with patch.object(clustering.ClusterModel, 'fit', slow_fit):
+            threads = [threading.Thread(target=cache.get,
+                                        args=(features_list, 3))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([3], fitted)
+
+    def test_changed_library_updates_incremental_model(self):
+        features_list = self._get_features_list(12)
+        cache = clustering.ModelCache('minibatch')
+        model = cache.get(features_list[:9], 3)
+
+        with patch.object(clustering.ClusterModel, 'fit') as fit:
+            updated = cache.get(features_list[1:], 3)
+
+        fit.assert_not_called()
+        self.assertIsNot(model, updated)
+        self.assertEqual(11, len(updated.labels))
+        self.assertEqual(3, len(set(updated.labels)))
+        self.assertEqual(list(updated.labels[:8]), list(model.labels[1:]))
+        self.assertEqual(9, len(model.labels))
+
+    def test_mostly_new_library_is_refitted(self):
+        features_list = self._get_features_list(12)
+        cache = clustering.ModelCache('minibatch')
+        cache.get(features_list[:3], 3)
+
+        with patch.object(clustering.ClusterModel, 'fit',
+                          return_value='fitted') as fit:
+            model = cache.get(features_list, 3)
+
+        fit.assert_called_once()
+        self.assertEqual('fitted', model)
+
+    def test_sweep(self):
+        features_list = self._get_features_list(9)
+        cache = clustering.ModelCache()
+        processed = []
+
+        models = tasks.run(
+            clustering.sweep, features_list, range(2, 12), cache,
+            progress=lambda k, last_k: processed.append((k, last_k)))
+
+        self.assertEqual([(k, 11) for k in range(2, 10)], processed)
+        self.assertEqual(list(range(2, 10)), list(models.keys()))
+        self.assertTrue(cache.cached(features_list, 5))
+        self.assertIsNotNone(models[3].inertia)
+        self.assertGreater(models[3].silhouette, models[2].silhouette)
+        self.assertIsNone(models[9].silhouette)
+
+
+class SimilarityIndexTests(unittest.TestCase):
+    @patch('clustering.AudioFileFeatures')
+    def _get_mock_features(self, mock_features):
+        features = mock_features()
+        return features
+
+    def _get_features(self, i, values):
+        features = self._get_mock_features()
+        features.audio_file.path.return_value = 'path{}'.format(i)
+        features.vector = np.zeros(clustering.FEATURES_COUNT,
+                                   dtype=np.float32)
+        features.vector[:len(values)] = values
+        return features
+
+    def _get_index(self):
+        self.features_list = [
+            self._get_features(0, [1, 0, 0]),
+            self._get_features(1, [0.9, 0.1, 0]),
+            self._get_features(2, [0.8, 0.2, 0]),
+            self._get_features(3, [0, 0, 1]),
+            self._get_features(4, [0, 0.1, 0.9]),
+        ]
+        return clustering.SimilarityIndex(self.features_list)
+
+    def test_similar_top_n(self):
+        index = self._get_index()
+
+        result = index.similar(self.features_list[0], 2)
+
+        self.assertEqual([self.features_list[1], self.features_list[2]],
+                         [features for features, _ in result])
+        self.assertLessEqual(result[0][1], result[1][1])
+
+    def test_similar_excludes_query(self):
+        index = self._get_index()
+
+        result = index.similar(self.features_list[3], 10)
+
+        self.assertEqual(4, len(result))
+        self.assertNotIn(self.features_list[3],
+                         [features for features, _ in result])
+
+    def test_similar_max_distance(self):
+        index = self._get_index()
+
+        result = index.similar(self.features_list[3], 10, max_distance=0.5)
+
+        self.assertEqual([self.features_list[4]],
+                         [features for features, _ in result])
+
+    def test_similar_not_indexed(self):
+        index = self._get_index()
+        features = self._get_features(5, [0, 0.1, 0.9])
+
+        result = index.similar(features, 1)
+
+        self.assertEqual(self.features_list[4], result[0][0])
+
+
+class FastDecodeTests(unittest.TestCase):
+    def test_decimate(self):
+        y = np.arange(10, dtype=np.float32)
+
+        result = clustering.decimate(y, 4)
+
+        self.assertEqual([1.5, 5.5], list(result))
+
+    def test_decimate_factor_one(self):
+        y = np.arange(10, dtype=np.float32)
+
+        result = clustering.decimate(y, 1)
+
+        self.assertIs(y, result)
+
+    def test_load_window(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.wav')
+            data = np.repeat(np.arange(8, dtype=np.float32) / 10, 4000)
+            soundfile.write(path, data, 4000, subtype='FLOAT')
+
+            y, sr = clustering.load_window(path, 2, 3, 1000)
+
+        self.assertEqual(1000, sr)
+        self.assertEqual(3000, len(y))
+        self.assertAlmostEqual(0.2, y[0], places=5)
+        self.assertAlmostEqual(0.4, y[-1], places=5)
+
+    def test_load_window_resamples_to_analysis_rate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.wav')
+            data = np.full(44100 * 2, 0.5, dtype=np.float32)
+            soundfile.write(path, data, 44100, subtype='FLOAT')
+
+            y, sr = clustering.load_window(path, 0, 1)
+
+        self.assertEqual(clustering.SAMPLE_RATE, sr)
+        self.assertEqual(clustering.SAMPLE_RATE, len(y))
+        self.assertAlmostEqual(0.5, y[-1], places=5)
+
+    @patch('clustering.AudioFileFeatures')
+    def test_feature_set_key_records_fast_path(self, mock_features):
+        features = mock_features()
+        features.audio_file.path.return_value = 'path'
+        features.fast = False
+        full_key = clustering.feature_set_key([features])
+
+        features.fast = True
+        fast_key = clustering.feature_set_key([features])
+
+        self.assertNotEqual(full_key, fast_key)
+
+
+class TrackListModelTests(unittest.TestCase):
+    @patch('files.AudioFile')
+    def _get_mock_file(self, mock_file):
+        file = mock_file()
+        return file
+
+    def _get_model(self, count=3, names=None):
+        self.audio_files = []
+        for i in range(count):
+            file = self._get_mock_file()
+            file.name = 'name{}'.format(i)
+            self.audio_files.append(file)
+        return album.TrackListModel(
+            playlist.Playlist(list(self.audio_files), names))
+
+    def _record(self, signal):
+        emitted = []
+        signal.connect(lambda *args: emitted.append(args))
+        return emitted
+
+    def test_row_count(self):
+        model = self._get_model(3)
+
+        self.assertEqual(3, model.rowCount())
+        self.assertEqual(0, model.rowCount(model.index(0)))
+
+    def test_data_display(self):
+        model = self._get_model(3)
+
+        result = model.data(model.index(1))
+
+        self.assertEqual('name1', result)
+
+    def test_data_album_names(self):
+        model = self._get_model(2, ['first', 'second'])
+
+        result = model.data(model.index(1))
+
+        self.assertEqual('second', result)
+
+    def test_data_invalid_index(self):
+        model = self._get_model(3)
+
+        self.assertIsNone(model.data(QtCore.QModelIndex()))
+
+    def test_data_playing_row_background(self):
+        model = self._get_model(3)
+
+        model.set_playing_row(2)
+
+        self.assertIsNone(
+            model.data(model.index(1), QtCore.Qt.BackgroundRole))
+        self.assertEqual(
+            model.PLAYING_COLOR,
+            model.data(model.index(2), QtCore.Qt.BackgroundRole).color())
+
+    def test_set_playing_row_emits_changed_rows(self):
+        model = self._get_model(3)
+        model.set_playing_row(0)
+        changed = self._record(model.dataChanged)
+
+        model.set_playing_row(2)
+
+        self.assertEqual([0, 2], [args[0].row() for args in changed])
+        self.assertEqual([QtCore.Qt.BackgroundRole], changed[0][2])
+
+    def test_rename_row_emits_display_change(self):
+        model = self._get_model(2, ['first', 'second'])
+        changed = self._record(model.dataChanged)
+
+        model.rename_row(0, 'renamed')
+
+        self.assertEqual('renamed', model.data(model.index(0)))
+        self.assertEqual([0], [args[0].row() for args in changed])
+        self.assertEqual([QtCore.Qt.DisplayRole], changed[0][2])
+
+    def test_append_files_inserts_rows(self):
+        model = self._get_model(2)
+        new_file = self._get_mock_file()
+        new_file.name = 'new'
+        inserted = self._record(model.rowsInserted)
+
+        model.append_files([new_file])
+
+        self.assertEqual([(2, 2)], [(args[1], args[2]) for args in inserted])
+        self.assertEqual(3, model.rowCount())
+        self.assertEqual('new', model.data(model.index(2)))
+
+    def test_set_files_resets(self):
+        model = self._get_model(3)
+        model.set_playing_row(1)
+        reset = self._record(model.modelReset)
+
+        model.set_files(self.audio_files[:1])
+
+        self.assertEqual(1, len(reset))
+        self.assertEqual(1, model.rowCount())
+        self.assertEqual(-1, model.playing_row)
+
+    def test_remove_files_resets(self):
+        model = self._get_model(3)
+        reset = self._record(model.modelReset)
+
+        model.remove_files([self.audio_files[1]])
+
+        self.assertEqual(1, len(reset))
+        self.assertEqual(['name0', 'name2'],
+                         [model.data(model.index(row)) for row in range(2)])
+
+
+class PlaylistTests(unittest.TestCase):
+    @patch('files.AudioFile')
+    def _get_mock_file(self, mock_file):
+        file = mock_file()
+        return file
+
+    def _get_playlist(self, count=10):
+        self.audio_files = []
+        for i in range(count):
+            file = self._get_mock_file()
+            file.name = 'name{}'.format(i)
+            self.audio_files.append(file)
+        return playlist.Playlist(list(self.audio_files))
+
+    def test_row_of(self):
+        tracks = self._get_playlist()
+
+        self.assertEqual(3, tracks.row_of(self.audio_files[3]))
+        self.assertEqual(-1, tracks.row_of(self._get_mock_file()))
+
+    def test_shuffle_keeps_reverse_map(self):
+        tracks = self._get_playlist()
+
+        tracks.shuffle()
+
+        self.assertCountEqual(self.audio_files, list(tracks))
+        for file in self.audio_files:
+            self.assertIs(file, tracks[tracks.row_of(file)])
+
+    def test_unshuffle(self):
+        tracks = self._get_playlist()
+
+        tracks.shuffle()
+        tracks.unshuffle()
+
+        self.assertEqual(self.audio_files, list(tracks))
+        self.assertEqual(5, tracks.row_of(self.audio_files[5]))
+
+    def test_remove_shuffled(self):
+        tracks = self._get_playlist()
+        tracks.shuffle()
+        row = tracks.row_of(self.audio_files[4])
+
+        removed = tracks.remove(row)
+
+        self.assertIs(self.audio_files[4], removed)
+        self.assertEqual(9, len(tracks))
+        self.assertEqual(-1, tracks.row_of(removed))
+        for file in self.audio_files[:4] + self.audio_files[5:]:
+            self.assertIs(file, tracks[tracks.row_of(file)])
+
+    def test_insert_and_move(self):
+        tracks = self._get_playlist(3)
+        file = self._get_mock_file()
+        file.name = 'new'
+
+        tracks.insert(1, file)
+        tracks.move(0, 3)
+
+        self.assertEqual(['new', 'name1', 'name2', 'name0'],
+                         [tracks.name(row) for row in range(len(tracks))])
+        self.assertEqual(3, tracks.row_of(self.audio_files[0]))
+        self.assertEqual(0, tracks.row_of(file))
+
+    def test_duplicate_track(self):
+        tracks = self._get_playlist(3)
+        tracks.append(self.audio_files[1])
+
+        tracks.shuffle()
+
+        self.assertEqual(sorted(tracks.rows_of(self.audio_files[1])),
+                         tracks.rows_of(self.audio_files[1]))
+        self.assertEqual(2, len(tracks.rows_of(self.audio_files[1])))
+        for index in range(4):
+            self.assertEqual(index, tracks.index(tracks.row(index)))
+
+    def test_row_of_index(self):
+        tracks = self._get_playlist(3)
+        tracks.shuffle()
+
+        row = tracks.row(2)
+
+        self.assertIs(self.audio_files[2], tracks[row])
+        self.assertEqual(-1, tracks.row(-1))
+        self.assertEqual(-1, tracks.index(3))
+
+    def test_unshuffle_keeps_inserted_and_moved(self):
+        tracks = self._get_playlist(4)
+        file = self._get_mock_file()
+        file.name = 'new'
+        tracks.shuffle()
+        tracks.order = [3, 1, 0, 2]
+        tracks._update_rows()
+
+        tracks.insert(1, file)
+        tracks.move(4, 1)
+        tracks.unshuffle()
+
+        self.assertEqual(['name0', 'name1', 'name3', 'name2', 'new'],
+                         [tracks.name(row) for row in range(len(tracks))])
+
+    def test_remove_files_returns_new_indices(self):
+        tracks = self._get_playlist(4)
+        tracks.shuffle()
+
+        new_indices = tracks.remove_files({self.audio_files[1]})
+
+        self.assertEqual({0: 0, 2: 1, 3: 2}, new_indices)
+        tracks.unshuffle()
+        self.assertEqual(['name0', 'name2', 'name3'],
+                         [tracks.name(row) for row in range(len(tracks))])
+
+    def test_names(self):
+        tracks = playlist.Playlist(['a', 'b'], ['first', 'second'])
+
+        tracks.rename(1, 'other')
+
+        self.assertEqual(['first', 'other'],
+                         [tracks.name(row) for row in range(len(tracks))])
+
+
+class PlaybackMonitorTests(unittest.TestCase):
+    def _get_monitor(self, remaining, on_position=None):
+        player = Mock()
+        player.remaining.return_value = remaining
+        return playback.PlaybackMonitor(player, None, on_position,
+                                        interval=0.05, position_interval=1.0)
+
+    def test_sleeps_until_track_end(self):
+        monitor = self._get_monitor(30.0)
+
+        timeout = monitor.timeout(time.monotonic())
+
+        self.assertEqual(30.0, timeout)
+
+    def test_wakes_for_next_position_report(self):
+        monitor = self._get_monitor(30.0, on_position=print)
+
+        timeout = monitor.timeout(time.monotonic())
+
+        self.assertAlmostEqual(1.0, timeout, delta=0.05)
+
+    def test_track_end_before_position_report(self):
+        monitor = self._get_monitor(0.3, on_position=print)
+
+        timeout = monitor.timeout(time.monotonic())
+
+        self.assertEqual(0.3, timeout)
+
+    def test_polls_past_expected_end(self):
+        monitor = self._get_monitor(-0.1)
+
+        timeout = monitor.timeout(time.monotonic())
+
+        self.assertEqual(0.05, timeout)
+
+    def test_unknown_duration(self):
+        monitor = self._get_monitor(None)
+
+        timeout = monitor.timeout(time.monotonic())
+
+        self.assertEqual(1.0, timeout)
+
+
+class DecodedAudioCacheTests(unittest.TestCase):
+    def test_get(self):
+        cache = playback.DecodedAudioCache(10)
+
+        cache.put('path1', b'1234')
+
+        self.assertIn('path1', cache)
+        self.assertEqual(b'1234', cache.get('path1'))
+        self.assertIsNone(cache.get('path2'))
+
+    def test_evict_least_recently_used(self):
+        cache = playback.DecodedAudioCache(10)
+
+        cache.put('path1', b'1234')
+        cache.put('path2', b'1234')
+        cache.get('path1')
+        cache.put('path3', b'1234')
+
+        self.assertIn('path1', cache)
+        self.assertNotIn('path2', cache)
+        self.assertIn('path3', cache)
+        self.assertEqual(8, cache.size)
+
+    def test_too_large(self):
+        cache = playback.DecodedAudioCache(10)
+
+        cache.put('path1', b'12345678901')
+
+        self.assertNotIn('path1', cache)
+        self.assertEqual(0, cache.size)
+
+    def test_replace_and_remove(self):
+        cache = playback.DecodedAudioCache(10)
+
+        cache.put('path1', b'1234')
+        cache.put('path1', b'123456')
+        cache.remove('path1')
+
+        self.assertNotIn('path1', cache)
+        self.assertEqual(0, cache.size)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class NullPlaybackTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.audio_files = []
+        for i in range(2):
+            file_name = 'track{}.wav'.format(i)
+            soundfile.write(os.path.join(self.directory.name, file_name),
+                            np.zeros(2000, dtype=np.float32), 10000)
+            self.audio_files.append(
+                files.AudioFile(self.directory.name, file_name))
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _get_player(self, gapless=False):
+        return playback.MusicPlayer(
+            self.audio_files, gapless,
+            backend=playback.NullBackend(self.clock))
+
+    def _wait_queued(self, player):
+        # the next track is queued by a preload thread
+        for _ in range(100):
+            if player.queued_audio is not None:
+                return
+            time.sleep(0.01)
+
+    def test_track_ends(self):
+        player = self._get_player()
+
+        player.play(0)
+        state_playing = player.check_track_end()
+        self.clock.advance(0.3)
+        state_ended = player.check_track_end()
+
+        self.assertIsNone(state_playing)
+        self.assertEqual(playback.TRACK_ENDED, state_ended)
+        self.assertFalse(player.is_active())
+
+    def test_gapless_switch(self):
+        player = self._get_player(gapless=True)
+
+        player.play(0)
+        self._wait_queued(player)
+        self.clock.advance(0.1)
+        player.check_track_end()
+        self.clock.advance(0.15)
+        state = player.check_track_end()
+
+        self.assertEqual(playback.TRACK_SWITCHED, state)
+        self.assertEqual(1, player.current_audio)
+        self.assertAlmostEqual(0.05, player.position(), places=2)
+
+    def test_seek_position(self):
+        player = self._get_player()
+
+        player.play(0)
+        player.play_from_position(0.1)
+        self.clock.advance(0.02)
+
+        self.assertAlmostEqual(0.12, player.position(), places=2)
+
+    def test_remaining(self):
+        player = self._get_player()
+
+        player.play(0)
+        self.clock.advance(0.05)
+
+        self.assertAlmostEqual(0.15, player.remaining(), places=2)
+        player.release()
+        self.assertIsNone(player.remaining())
+
+    def test_pause_keeps_position(self):
+        player = self._get_player()
+
+        player.play(0)
+        self.clock.advance(0.05)
+        player.pause()
+        position = player.position()
+        self.clock.advance(1)
+
+        self.assertEqual(position, player.position())
+        self.assertIsNone(player.check_track_end())
+
+    def test_release(self):
+        player = self._get_player()
+
+        player.play(0)
+        player.release()
+
+        self.assertFalse(player.is_active())
+        self.assertIsNone(player.check_track_end())
+        self.assertEqual(0, player.play(0))
+
+    def test_rewind_after_load_at(self):
+        backend = playback.NullBackend(self.clock)
+        backend.load_at(self.audio_files[0].path(), 0, 0.1)
+
+        backend.play()
+        backend.rewind()
+        self.clock.advance(0.15)
+
+        self.assertTrue(backend.get_busy())
+
+    def test_decoded_seek_streams_cached_samples(self):
+        backend = playback.NullBackend(self.clock)
+        player = playback.MusicPlayer(self.audio_files, cache_size=1 << 20,
+                                      backend=backend)
+        raw = bytes(int(0.2 * backend.FREQUENCY) * backend.FRAME_SIZE)
+        player.cache.put(self.audio_files[0].path(), raw)
+        loaded = []
+        load_pcm = backend.load_pcm
+
+        def record_pcm(data):
+            loaded.append(data)
+            load_pcm(data)
+
+        player.play(0)
+        with patch.object(backend, 'load_pcm', record_pcm):
+            player.play_from_position(0.1)
+            position = player.position()
+            player.play_again()
+
+        self.assertIs(raw, loaded[0].obj)
+        self.assertAlmostEqual(0.1, position, places=3)
+        self.assertEqual(len(raw), len(loaded[1]))
+        self.assertEqual(0, player.position())
+
+
+class SeekIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'track.mp3')
+        sr = 44100
+        t = np.arange(sr * 5) / sr
+        y = 0.3 * np.sin(2 * np.pi * 440 * t)
+        soundfile.write(self.path, np.stack([y, y], axis=1), sr,
+                        format='MP3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_parse_header(self):
+        header = mp3.parse_header(b'\xff\xfb\x90\x64')
+
+        self.assertEqual(mp3.VERSION_1, header.version)
+        self.assertEqual(mp3.LAYER_3, header.layer)
+        self.assertEqual(128, header.bitrate)
+        self.assertEqual(44100, header.sample_rate)
+        self.assertEqual(417, header.length)
+        self.assertIsNone(mp3.parse_header(b'\x00\xfb\x90\x64'))
+
+    def test_index_covers_duration(self):
+        index = mp3.build_seek_index(self.path)
+
+        self.assertAlmostEqual(5, index.duration, delta=0.2)
+
+    def test_lookup(self):
+        index = mp3.build_seek_index(self.path)
+
+        start, byte_offset = index.lookup(2.5)
+        end, last_offset = index.lookup(100)
+
+        self.assertLessEqual(start, 2.5)
+        self.assertGreater(start, 2.5 - index.frame_duration * index.step)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertIsNotNone(mp3.parse_header(data, byte_offset))
+        self.assertLess(end, index.duration)
+        self.assertEqual(index.offsets[-1], last_offset)
+
+    def test_save_load(self):
+        index = mp3.build_seek_index(self.path)
+
+        loaded = mp3.SeekIndex.load(index.save())
+
+        self.assertEqual(list(index.offsets), list(loaded.offsets))
+        self.assertEqual(index.lookup(3), loaded.lookup(3))
+
+    def test_streamed_scan_matches_whole_file(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+            _, offsets = mp3.scan_frames(f)
+            _, streamed = mp3.scan_frames(f, chunk_size=1000)
+
+        self.assertEqual(list(offsets), list(streamed))
+        for offset in offsets:
+            self.assertIsNotNone(mp3.parse_header(data, offset))
+
+    def test_saved_index_format(self):
+        index = mp3.build_seek_index(self.path)
+
+        saved = index.save()
+
+        self.assertEqual(8 * len(index.offsets), len(saved['offsets']))
+        self.assertEqual(index.offsets[1],
+                         int.from_bytes(saved['offsets'][8:16], 'little'))
+        saved['typecode'] = 'L'
+        self.assertIsNone(mp3.SeekIndex.load(saved))
+
+    def test_not_mp3(self):
+        path = os.path.join(self.directory.name, 'track.wav')
+        soundfile.write(path, np.zeros(1000), 10000)
+
+        self.assertIsNone(mp3.build_seek_index(path))
+
+    def test_player_seeks_by_index(self):
+        audio_files = [files.AudioFile(self.directory.name, 'track.mp3')]
+        player = playback.MusicPlayer(audio_files,
+                                      backend=playback.NullBackend())
+
+        player.play(0)
+        for _ in range(100):
+            if player.seek_indexes.get(self.path):
+                break
+            time.sleep(0.01)
+        player.play_from_position(2.5)
+
+        self.assertIsNotNone(player.seek_indexes[self.path])
+        self.assertAlmostEqual(2.5, player.position(), delta=0.15)
+
+
+class MetadataCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'track.wav')
+        with open(self.path, 'wb') as f:
+            f.write(b'data')
+        self.cache = cache.MetadataCache(
+            os.path.join(self.directory.name, 'cache'))
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_put_get(self):
+        self.cache.put(self.path, 'gain', 0.5)
+
+        self.assertEqual(0.5, self.cache.get(self.path, 'gain'))
+        self.assertIsNone(self.cache.get(self.path, 'seek_index'))
+
+    def test_changed_file_invalidates(self):
+        self.cache.put(self.path, 'gain', 0.5)
+        with open(self.path, 'ab') as f:
+            f.write(b'more data')
+
+        self.assertIsNone(self.cache.get(self.path, 'gain'))
+
+    def test_persisted(self):
+        self.cache.put(self.path, 'gain', 0.5)
+        self.cache.close()
+
+        self.cache = cache.MetadataCache(
+            os.path.join(self.directory.name, 'cache'))
+
+        self.assertEqual(0.5, self.cache.get(self.path, 'gain'))
+
+
+class LoudnessTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = cache.MetadataCache(
+            os.path.join(self.directory.name, 'cache'))
+        t = np.arange(20000) / 10000
+        self.paths = []
+        for i, amplitude in enumerate((0.05, 0.5)):
+            path = os.path.join(self.directory.name, 'track{}.wav'.format(i))
+            soundfile.write(path, amplitude * np.sin(2 * np.pi * 440 * t),
+                            10000)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_loudness(self):
+        t = np.arange(10000) / 10000
+        y = np.sin(2 * np.pi * 440 * t)
+
+        level = loudness.loudness(y, 10000)
+
+        self.assertAlmostEqual(-3, level, delta=0.1)
+        self.assertIsNone(loudness.loudness(np.zeros(0), 10000))
+
+    def test_quiet_track_gets_more_gain(self):
+        quiet = loudness.track_gain(self.paths[0])
+        loud = loudness.track_gain(self.paths[1])
+
+        self.assertAlmostEqual(20, quiet - loud, delta=0.5)
+
+    def test_silence_not_amplified(self):
+        path = os.path.join(self.directory.name, 'silence.wav')
+        soundfile.write(path, np.zeros(10000), 10000)
+
+        self.assertEqual(0, loudness.track_gain(path))
+
+    def test_gain_factor(self):
+        self.assertEqual(1, playback.gain_factor(0))
+        self.assertAlmostEqual(10, playback.gain_factor(20))
+
+    def test_analyzer_stores_gain(self):
+        analyzer = loudness.LoudnessAnalyzer(self.cache, workers=1)
+
+        analyzer.analyze(self.paths)
+        for _ in range(600):
+            if all(self.cache.get(path, 'gain') is not None
+                   for path in self.paths):
+                break
+            time.sleep(0.05)
+        analyzer.shutdown()
+
+        self.assertAlmostEqual(loudness.track_gain(self.paths[0]),
+                               self.cache.get(self.paths[0], 'gain'))
+        self.assertFalse(analyzer.pending)
+
+    def test_analyzer_looks_up_tracks_in_background(self):
+        analyzer = loudness.LoudnessAnalyzer(self.cache, workers=1)
+        threads = []
+        get = self.cache.get
+
+        def recording_get(path, key):
+            threads.append(threading.current_thread())
+            return get(path, key)
+
+        with patch.object(self.cache, 'get', recording_get):
+            analyzer.analyze(self.paths)
+            analyzer.tasks[0].result(timeout=10)
+        analyzer.shutdown()
+
+        self.assertEqual(len(self.paths), len(threads))
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_player_applies_gain(self):
+        self.cache.put(self.paths[0], 'gain', -6.0)
+        audio_files = [files.AudioFile(self.directory.name, 'track0.wav')]
+        player = playback.MusicPlayer(audio_files,
+                                      backend=playback.NullBackend(),
+                                      metadata_cache=self.cache,
+                                      normalize=True)
+
+        player.play(0)
+
+        self.assertAlmostEqual(0.5 * playback.gain_factor(-6),
+                               player.backend.volume)
+
+
+class FileOperationsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source')
+        self.target = os.path.join(self.directory.name, 'target')
+        os.mkdir(self.source)
+        os.mkdir(self.target)
+        self.audio_files = []
+        for i in range(6):
+            file_name = 'track{}.wav'.format(i)
+            soundfile.write(os.path.join(self.source, file_name),
+                            np.zeros(1000, dtype=np.float32), 10000)
+            self.audio_files.append(files.AudioFile(self.source, file_name))
+        self.editor = fsystem.FileSystemEdit(self.audio_files, workers=2)
+
+    def tearDown(self):
+        self.editor.shutdown()
+        self.directory.cleanup()
+
+    def test_batch(self):
+        progress = []
+        operations = [
+            fsystem.FileOperation(fsystem.MOVE, audio, self.target)
+            for audio in self.audio_files[:3]]
+        operations.append(
+            fsystem.FileOperation(fsystem.DELETE, self.audio_files[3]))
+        operations.append(
+            fsystem.FileOperation(fsystem.RENAME, self.audio_files[4], 'new'))
+
+        batch = self.editor.run_batch(
+            operations, lambda completed, total:
+                progress.append((completed, total)))
+        batch.result(5)
+
+        self.assertEqual([], [operation for operation in operations
+                              if operation.error])
+        self.assertEqual(['track0.wav', 'track1.wav', 'track2.wav'],
+                         sorted(os.listdir(self.target)))
+        self.assertEqual(['new.wav', 'track5.wav'],
+                         sorted(os.listdir(self.source)))
+        self.assertEqual([(i, 5) for i in range(1, 6)], sorted(progress))
+
+    def test_batch_reports_errors(self):
+        os.remove(self.audio_files[0].path())
+        finished = []
+
+        batch = self.editor.run_batch(
+            [fsystem.FileOperation(fsystem.DELETE, audio)
+             for audio in self.audio_files[:2]])
+        batch.add_done_callback(finished.append)
+        operations = batch.result(5)
+
+        self.assertEqual([batch], finished)
+        self.assertEqual(fsystem.ERROR_DELETE, operations[0].error)
+        self.assertEqual(0, operations[1].error)
+
+    def test_empty_batch(self):
+        batch = self.editor.run_batch([])
+
+        self.assertEqual([], batch.result(5))
+
+    def test_cancelled_batch_skips_waiting_operations(self):
+        started = threading.Barrier(3)
+        release = threading.Event()
+        apply = self.editor.apply
+
+        def blocking_apply(operation, progress=None):
+            started.wait(5)
+            release.wait(5)
+            return apply(operation, progress)
+
+        operations = [fsystem.FileOperation(fsystem.MOVE, audio, self.target)
+                      for audio in self.audio_files]
+        with patch.object(self.editor, 'apply', side_effect=blocking_apply):
+            batch = self.editor.run_batch(operations)
+            started.wait(5)
+            batch.cancel()
+            release.set()
+            with self.assertRaises(tasks.Cancelled):
+                batch.result(5)
+
+        moved = [operation for operation in operations if not operation.error]
+        self.assertEqual(2, len(moved))
+        self.assertEqual(sorted(operation.audio_file.file_name
+                                for operation in moved),
+                         sorted(os.listdir(self.target)))
+
+    def test_cross_device_move(self):
+        source = self.audio_files[0].path()
+        destination = os.path.join(self.target, 'moved.wav')
+        with open(source, 'rb') as f:
+            data = f.read()
+        progress = []
+        replace = os.replace
+
+        def cross_device_replace(src, dst):
+            if src == source:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            replace(src, dst)
+
+        with patch('os.replace', side_effect=cross_device_replace):
+            with patch('audioalbum.fsystem.COPY_CHUNK_SIZE', 100):
+                fsystem.move(source, destination,
+                             lambda copied, total: progress.append(copied))
+
+        self.assertFalse(os.path.exists(source))
+        with open(destination, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(['moved.wav'], os.listdir(self.target))
+        self.assertEqual(len(data), progress[-1])
+        self.assertGreater(len(progress), 1)
+
+    def test_batch_reports_copy_progress(self):
+        source = self.audio_files[0].path()
+        copied = []
+        replace = os.replace
+
+        def cross_device_replace(src, dst):
+            if src == source:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            replace(src, dst)
+
+        with patch('os.replace', side_effect=cross_device_replace):
+            with patch('audioalbum.fsystem.COPY_CHUNK_SIZE', 100):
+                batch = self.editor.run_batch(
+                    [fsystem.FileOperation(fsystem.MOVE, self.audio_files[0],
+                                           self.target)],
+                    copy_progress=lambda operation, done, total:
+                        copied.append((operation.audio_file, done, total)))
+                batch.result(5)
+
+        size = os.path.getsize(os.path.join(self.target, 'track0.wav'))
+        self.assertGreater(len(copied), 1)
+        self.assertEqual((self.audio_files[0], size, size), copied[-1])
+
+    def test_failed_copy_removes_part(self):
+        destination = os.path.join(self.target, 'moved.wav')
+
+        with patch('os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                fsystem.copy_file(self.audio_files[0].path(), destination)
+
+        self.assertEqual([], os.listdir(self.target))
+
+    def test_move_file_returns_zero(self):
+        exit_code = self.editor.move_file(0, self.target)
+
+        self.assertEqual(0, exit_code)
+
+
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source')
+        self.target = os.path.join(self.directory.name, 'target')
+        os.mkdir(self.source)
+        os.mkdir(self.target)
+        self.audio_files = []
+        for i in range(4):
+            file_name = 'track{}.wav'.format(i)
+            soundfile.write(os.path.join(self.source, file_name),
+                            np.zeros(1000, dtype=np.float32), 10000)
+            self.audio_files.append(files.AudioFile(self.source, file_name))
+        self.editor = fsystem.FileSystemEdit(self.audio_files, workers=2)
+        self.journal = journal.Journal(self.editor)
+        self.journal.subscribe(journal.apply_changes)
+        self.changes = []
+        self.journal.subscribe(self.changes.append)
+
+    def tearDown(self):
+        self.editor.shutdown()
+        self.directory.cleanup()
+
+    def _run(self, operations):
+        return self.journal.run(operations).result(5)
+
+    def _undo(self):
+        return self.journal.undo().result(5)
+
+    def test_apply_updates_files_and_emits_one_event(self):
+        self._run([
+            fsystem.FileOperation(fsystem.MOVE, self.audio_files[0],
+                                  self.target),
+            fsystem.FileOperation(fsystem.RENAME, self.audio_files[1], 'new'),
+            fsystem.FileOperation(fsystem.DELETE, self.audio_files[2])])
+
+        self.assertEqual(1, len(self.changes))
+        self.assertEqual(os.path.join(self.target, 'track0.wav'),
+                         self.audio_files[0].path())
+        self.assertEqual('new', self.audio_files[1].name)
+        self.assertTrue(os.path.exists(self.audio_files[1].path()))
+        self.assertEqual(['.audioalbum_trash', 'new.wav', 'track3.wav'],
+                         sorted(os.listdir(self.source)))
+        deleted = [change for change in self.changes[0] if change.deleted]
+        self.assertEqual([self.audio_files[2]],
+                         [change.audio_file for change in deleted])
+
+    def test_listeners_get_changes_before_files_are_updated(self):
+        paths = []
+        self.journal.listeners.insert(0, lambda changes: paths.extend(
+            change.audio_file.path() for change in changes))
+
+        self._run([fsystem.FileOperation(
+            fsystem.MOVE, self.audio_files[0], self.target)])
+
+        self.assertEqual([os.path.join(self.source, 'track0.wav')], paths)
+        self.assertEqual(os.path.join(self.target, 'track0.wav'),
+                         self.audio_files[0].path())
+
+    def test_failing_listener_does_not_stop_transaction(self):
+        self.journal.listeners.insert(0, Mock(side_effect=ValueError))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            transaction = self._run([fsystem.FileOperation(
+                fsystem.RENAME, self.audio_files[0], 'new')])
+
+        self.assertEqual(transaction.changes, self.changes[0])
+        self.assertEqual('new', self.audio_files[0].name)
+
+    def test_undo(self):
+        path = self.audio_files[0].path()
+        self._run([
+            fsystem.FileOperation(fsystem.MOVE, self.audio_files[0],
+                                  self.target),
+            fsystem.FileOperation(fsystem.DELETE, self.audio_files[1])])
+
+        self._undo()
+
+        self.assertEqual(path, self.audio_files[0].path())
+        self.assertEqual(['track{}.wav'.format(i) for i in range(4)],
+                         sorted(os.listdir(self.source)))
+        restored = [change.audio_file for change in self.changes[1]
+                    if change.restored]
+        self.assertEqual([self.audio_files[1]], restored)
+        self.assertIsNone(self.journal.last())
+
+    def test_failure_rolls_back(self):
+        os.remove(self.audio_files[3].path())
+
+        transaction = self._run([
+            fsystem.FileOperation(fsystem.MOVE, audio, self.target)
+            for audio in self.audio_files])
+
+        self.assertTrue(transaction.rolled_back)
+        self.assertEqual([], os.listdir(self.target))
+        self.assertEqual(os.path.join(self.source, 'track0.wav'),
+                         self.audio_files[0].path())
+        self.assertEqual([], self.changes)
+        self.assertIsNone(self.journal.last())
+
+    def test_cancel_rolls_back(self):
+        started = threading.Barrier(3)
+        release = threading.Event()
+        apply = self.editor.apply
+
+        def blocking_apply(operation, progress=None):
+            if not release.is_set():
+                started.wait(5)
+                release.wait(5)
+            return apply(operation, progress)
+
+        with patch.object(self.editor, 'apply', side_effect=blocking_apply):
+            task = self.journal.run([
+                fsystem.FileOperation(fsystem.MOVE, audio, self.target)
+                for audio in self.audio_files])
+            started.wait(5)
+            task.cancel()
+            release.set()
+            transaction = task.result(5)
+
+        self.assertTrue(transaction.rolled_back)
+        self.assertEqual(2, len(transaction.failed()))
+        self.assertEqual([], os.listdir(self.target))
+        self.assertEqual([], self.changes)
+
+    def test_no_overwrite(self):
+        transaction = self._run([fsystem.FileOperation(
+            fsystem.RENAME, self.audio_files[0], 'track1')])
+
+        self.assertEqual(fsystem.ERROR_RENAME,
+                         transaction.operations[0].error)
+        self.assertEqual(4, len(os.listdir(self.source)))
+
+    def test_close_empties_trash(self):
+        self._run([fsystem.FileOperation(
+            fsystem.DELETE, self.audio_files[0])])
+        trash = os.path.join(self.source, files.TRASH_DIRECTORY)
+        found = files.find_audio_files(self.source, True, ['wav'])
+
+        self.assertTrue(os.path.isdir(trash))
+        self.assertEqual(3, len(found))
+        self.journal.close()
+        self.assertFalse(os.path.exists(trash))
+
+    def test_album_editor_follows_changes(self):
+        editor = albumsys.AlbumEditor()
+        copies = [files.AudioFile(self.source, audio.file_name)
+                  for audio in self.audio_files[:2]]
+        album = albumsys.Album('album', [])
+        album.add_audio_files(copies)
+        editor.add_album(album)
+        self.journal.subscribe(editor.apply_changes)
+
+        self._run([
+            fsystem.FileOperation(fsystem.MOVE, self.audio_files[0],
+                                  self.target),
+            fsystem.FileOperation(fsystem.DELETE, self.audio_files[1])])
+
+        self.assertEqual([self.audio_files[0].path()],
+                         [item.audio_file.path()
+                          for item in album.album_items])
+        self._undo()
+        self.assertEqual(
+            [os.path.join(self.source, 'track{}.wav'.format(i))
+             for i in range(2)],
+            [item.audio_file.path() for item in album.album_items])
+
+    def test_evicted_deletions_are_forgotten(self):
+        self.journal.undo_limit = 1
+        editor = albumsys.AlbumEditor()
+        album = albumsys.Album('album', [])
+        album.add_audio_files(
+            [files.AudioFile(self.source, audio.file_name)
+             for audio in self.audio_files[:2]])
+        editor.add_album(album)
+        self.journal.subscribe(editor.apply_changes)
+        self.journal.subscribe_evicted(editor.forget_removed)
+
+        self._run([fsystem.FileOperation(
+            fsystem.DELETE, self.audio_files[0])])
+        self._run([fsystem.FileOperation(
+            fsystem.DELETE, self.audio_files[1])])
+
+        self.assertEqual([self.audio_files[1].path()],
+                         list(editor.removed_items))
+
+    def test_undo_restores_album_items(self):
+        library_database = database.LibraryDatabase(
+            os.path.join(self.directory.name, 'library.db'))
+        editor = albumsys.AlbumEditor(library_database)
+        album = albumsys.Album('album', [])
+        album.add_audio_files(
+            [library_database.read_audio_file(self.source, audio.file_name)
+             for audio in self.audio_files[:3]])
+        editor.add_album(album)
+        editor.save_to_database()
+        self.journal.subscribe(editor.apply_changes)
+        self.journal.subscribe(library_database.apply_changes)
+        self.journal.subscribe_evicted(editor.forget_removed)
+        self.journal.subscribe_evicted(library_database.forget_removed)
+        paths = [audio.path() for audio in self.audio_files[:3]]
+
+        self._run([fsystem.FileOperation(
+            fsystem.DELETE, self.audio_files[1])])
+        self._undo()
+
+        stored = library_database.load_albums()['album']
+        library_database.close()
+        self.assertEqual(paths, [item.audio_file.path()
+                                 for item in album.album_items])
+        self.assertEqual(paths, [item.audio_file.path()
+                                 for item in stored.album_items])
+        self.assertEqual({}, editor.removed_items)
+
+    def test_metadata_cache_follows_changes(self):
+        metadata_cache = cache.MetadataCache(
+            os.path.join(self.directory.name, 'cache'))
+        metadata_cache.put(self.audio_files[0].path(), 'gain', 1.5)
+        self.journal.subscribe(metadata_cache.apply_changes)
+
+        self._run([fsystem.FileOperation(
+            fsystem.MOVE, self.audio_files[0], self.target)])
+
+        self.assertEqual(
+            1.5, metadata_cache.get(self.audio_files[0].path(), 'gain'))
+        metadata_cache.close()
+
+
+class CliTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for i, content in enumerate((0.0, 0.5, 0.0)):
+            soundfile.write(
+                os.path.join(self.directory.name, 'track{}.wav'.format(i)),
+                np.full(1000, content, dtype=np.float32), 10000)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _run(self, *argv):
+        stream = io.StringIO()
+        with contextlib.redirect_stdout(stream):
+            cli.main(list(argv))
+        return stream.getvalue()
+
+    def test_scan_json(self):
+        output = self._run('scan', '-d', self.directory.name, '-f', 'wav')
+
+        records = json.loads(output)
+        self.assertEqual(['track0', 'track1', 'track2'],
+                         [record['name'] for record in records])
+        self.assertAlmostEqual(0.1, records[0]['duration'])
+
+    def test_dupes_csv(self):
+        output = self._run('dupes', '-d', self.directory.name, '-f', 'wav',
+                           '-o', 'csv')
+
+        rows = list(csv.DictReader(io.StringIO(output)))
+        self.assertEqual(
+            ['track0.wav', 'track2.wav'],
+            sorted(os.path.basename(row['path']) for row in rows))
+
+    def test_export(self):
+        album = albumsys.Album('album', [])
+        album.add_audio_files(
+            files.find_audio_files(self.directory.name, False, ['wav']))
+        editor = albumsys.AlbumEditor()
+        editor.add_album(album)
+        albums_file = os.path.join(self.directory.name, 'albums.txt')
+        with open(albums_file, 'at') as f:
+            f.write(editor.save_albums())
+
+        records = json.loads(self._run('export', '-a', albums_file))
+
+        self.assertEqual(3, len(records))
+        self.assertEqual('album', records[0]['album'])
+
+    def test_no_gui_or_audio_imports(self):
+        code = ('import sys; from audioalbum import cli; '
+                'cli.main(["scan", "-d", sys.argv[1], "-f", "wav"]); '
+                'print("PyQt5" in sys.modules, "pygame" in sys.modules)')
+        result = subprocess.run(
+            [sys.executable, '-c', code, self.directory.name],
+            capture_output=True, text=True,
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+        self.assertEqual('False False', result.stdout.splitlines()[-1])
+
+    def test_player_takes_library_options(self):
+        argv = ['album.py', '-d', self.directory.name, '-f', 'wav', '-j',
+                '2', '--no-rescan', '--database', 'library.db']
+
+        with patch.object(sys, 'argv', argv):
+            args = album.parse_args()
+
+        self.assertEqual(self.directory.name, args.directory)
+        self.assertEqual(2, args.jobs)
+        self.assertTrue(args.no_rescan)
+        self.assertEqual('library.db', args.database)
+
+
+class LazyImportTests(unittest.TestCase):
+    def _loaded(self, module, heavy_modules):
+        code = ('import sys; import {}; '
+                'print([name for name in {} if name in sys.modules])').format(
+                    module, heavy_modules)
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True,
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+        return result.stdout.strip()
+
+    def test_clustering_defers_analysis_libraries(self):
+        self.assertEqual('[]', self._loaded('audioalbum.clustering',
+                                            ['librosa', 'sklearn']))
+
+    def test_playback_defers_pygame(self):
+        self.assertEqual('[]', self._loaded('audioalbum.playback',
+                                            ['pygame']))
+
+    def test_null_backend_without_pygame(self):
+        code = ('import sys; from audioalbum import playback; '
+                'playback.MusicPlayer([], backend=playback.NullBackend()); '
+                'print("pygame" in sys.modules)')
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True,
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+
+        self.assertEqual('False', result.stdout.strip())
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_timer_records_count_total_and_max(self):
+        with patch('time.perf_counter', side_effect=[0.0, 0.5, 1.0, 3.0]):
+            with self.metrics.timed('scan'):
+                pass
+            with self.metrics.timed('scan'):
+                pass
+
+        timer = self.metrics.snapshot()['timers']['scan']
+
+        self.assertEqual({'count': 2, 'total': 2.5, 'max': 2.0}, timer)
+
+    def test_timer_as_decorator_records_every_call(self):
+        @self.metrics.timed('hash')
+        def work(value):
+            return value * 2
+
+        results = [work(2), work(3)]
+
+        self.assertEqual([4, 6], results)
+        self.assertEqual(2, self.metrics.snapshot()['timers']['hash']['count'])
+
+    def test_timer_records_when_function_raises(self):
+        @self.metrics.timed('load')
+        def work():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            work()
+
+        self.assertEqual(1, self.metrics.snapshot()['timers']['load']['count'])
+
+    def test_counters(self):
+        self.metrics.count('list_data')
+        self.metrics.count('list_data', 4)
+
+        counters = self.metrics.snapshot()['counters']
+
+        self.assertEqual({'list_data': 5}, counters)
+
+    def test_reset(self):
+        self.metrics.count('list_data')
+        self.metrics.record('scan', 1.0)
+
+        self.metrics.reset()
+
+        self.assertEqual({'counters': {}, 'timers': {}},
+                         self.metrics.snapshot())
+
+    def test_prometheus_format(self):
+        self.metrics.count('list_data', 3)
+        self.metrics.record('scan', 1.5)
+
+        text = self.metrics.to_prometheus()
+
+        self.assertIn('# TYPE audioalbum_list_data_total counter\n'
+                      'audioalbum_list_data_total 3\n', text)
+        self.assertIn('audioalbum_scan_seconds_count 1\n', text)
+        self.assertIn('audioalbum_scan_seconds_sum 1.5\n', text)
+        self.assertIn('audioalbum_scan_seconds_max 1.5\n', text)
+
+    def test_dump_chooses_format_by_extension(self):
+        self.metrics.record('scan', 1.0)
+        with tempfile.TemporaryDirectory() as directory:
+            json_file = os.path.join(directory, 'metrics.json')
+            text_file = os.path.join(directory, 'metrics.prom')
+
+            self.metrics.dump(json_file)
+            self.metrics.dump(text_file)
+
+            with open(json_file) as f:
+                self.assertEqual(1, json.load(f)['timers']['scan']['count'])
+            with open(text_file) as f:
+                self.assertIn('audioalbum_scan_seconds_count 1', f.read())
+
+    def test_album_editor_is_instrumented(self):
+        metrics.METRICS.reset()
+
+        albumsys.AlbumEditor().save_albums()
+
+        self.assertEqual(
+            1, metrics.METRICS.snapshot()['timers']['album_save']['count'])
+
+    def test_cli_writes_metrics_and_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            metrics_file = os.path.join(directory, 'metrics.json')
+            profile_file = os.path.join(directory, 'scan.prof')
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                cli.main(['scan', '-d', directory, '--metrics', metrics_file,
+                          '--profile', profile_file])
+
+            with open(metrics_file) as f:
+                self.assertIn('scan', json.load(f)['timers'])
+            self.assertGreater(os.path.getsize(profile_file), 0)
+
+
+class TaskTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for i, content in enumerate((0.0, 0.5, 0.0)):
+            soundfile.write(
+                os.path.join(self.directory.name, 'track{}.wav'.format(i)),
+                np.full(1000, content, dtype=np.float32), 10000)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run_returns_result_and_reports_progress(self):
+        progress = []
+
+        audio_files = tasks.run(
+            files.find_audio_files, self.directory.name, False, ['wav'],
+            progress=lambda done, total: progress.append(done))
+
+        self.assertEqual(3, len(audio_files))
+        self.assertEqual([1, 2, 3], progress)
+
+    def test_background_task_result(self):
+        task = tasks.Task(files.find_audio_files, self.directory.name,
+                          False, ['wav']).start()
+
+        self.assertEqual(3, len(task.result(timeout=10)))
+        self.assertTrue(task.done())
+        self.assertFalse(task.cancelled())
+
+    def test_cancel_from_progress_callback(self):
+        def progress(done, total):
+            if done == 1:
+                task.cancel()
+
+        task = tasks.Task(files.find_audio_files, self.directory.name,
+                          False, ['wav'], progress=progress)
+        task.run()
+
+        self.assertTrue(task.cancelled())
+        with self.assertRaises(tasks.Cancelled):
+            task.result()
+
+    def test_cancel_before_start(self):
+        finished = []
+        task = tasks.Task(files.find_audio_files, self.directory.name,
+                          False, ['wav'])
+        task.add_done_callback(finished.append)
+
+        task.cancel()
+        task.run()
+
+        self.assertEqual([task], finished)
+        self.assertTrue(task.cancelled())
+
+    def test_repetitions_report_hashing(self):
+        audio_files = files.find_audio_files(self.directory.name, False,
+                                             ['wav'])
+        progress = []
+
+        repetitions = tasks.run(
+            files.find_all_repetitions, audio_files,
+            progress=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual(1, len(repetitions))
+        self.assertIn((0, 3), progress)
+        self.assertEqual((2, 2), progress[-1])
+
+    def test_load_albums_file_cancelled_leaves_no_albums(self):
+        album = albumsys.Album('album', [])
+        album.add_audio_files(
+            files.find_audio_files(self.directory.name, False, ['wav']))
+        editor = albumsys.AlbumEditor()
+        editor.add_album(album)
+        albums_file = os.path.join(self.directory.name, 'albums.txt')
+        with open(albums_file, 'at') as f:
+            f.write(editor.save_albums())
+
+        loaded = tasks.run(albumsys.load_albums_file, albums_file)
+        self.assertEqual(['album'], list(loaded.albums))
+        self.assertEqual(3, len(loaded.albums['album'].album_items))
+
+        target = albumsys.AlbumEditor()
+        task = tasks.Task(target.load_albums,
+                          editor.save_albums().replace('\r', '\n'),
+                          progress=lambda done, total: task.cancel())
+        task.run()
+        self.assertTrue(task.cancelled())
+        self.assertEqual({}, target.albums)
+
+
+class ScanPipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for i in range(12):
+            subdirectory = os.path.join(self.directory.name, str(i % 3))
+            os.makedirs(subdirectory, exist_ok=True)
+            soundfile.write(
+                os.path.join(subdirectory, 'track{}.wav'.format(i % 4)),
+                np.full(1000, i % 2 / 2, dtype=np.float32), 10000)
+        with open(os.path.join(self.directory.name, 'notes.txt'), 'w') as f:
+            f.write('not audio')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _paths(self, audio_files):
+        return [audio.path() for audio in audio_files]
+
+    def test_same_files_and_order_as_serial_scan(self):
+        serial = files.find_audio_files(self.directory.name, True, ['wav'])
+        concurrent = files.find_audio_files(self.directory.name, True,
+                                            ['wav'], jobs=4)
+
+        self.assertEqual(12, len(serial))
+        self.assertEqual(self._paths(serial), self._paths(concurrent))
+
+    def test_top_directory_only(self):
+        audio_files = files.find_audio_files(self.directory.name, False,
+                                             ['wav'], jobs=4)
+
+        self.assertEqual([], audio_files)
+
+    def test_hash_stage(self):
+        audio_files = files.find_audio_files(
+            self.directory.name, True, ['wav'], jobs=3, hash_files=True)
+
+        self.assertEqual(
+            [files.get_hash_md5(audio.path()) for audio in audio_files],
+            [audio.hash for audio in audio_files])
+
+    def test_hash_stage_skips_unique_sizes(self):
+        soundfile.write(os.path.join(self.directory.name, 'unique.wav'),
+                        np.zeros(2000, dtype=np.float32), 10000)
+
+        for jobs in (1, 3):
+            audio_files = files.find_audio_files(
+                self.directory.name, True, ['wav'], jobs=jobs,
+                hash_files=True)
+
+            hashed = [audio.name for audio in audio_files if audio.hash]
+            self.assertEqual(12, len(hashed))
+            self.assertNotIn('unique', hashed)
+
+    def test_reads_overlap(self):
+        get = files.TinyTag.get
+
+        def slow_get(*args, **kwargs):
+            time.sleep(0.05)
+            return get(*args, **kwargs)
+
+        with patch.object(files.TinyTag, 'get', side_effect=slow_get):
+            start = time.perf_counter()
+            files.find_audio_files(self.directory.name, True, ['wav'],
+                                   jobs=12)
+            elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 12 * 0.05 / 2)
+
+    def test_cancel(self):
+        def progress(done, total):
+            if done == 2:
+                task.cancel()
+
+        task = tasks.Task(files.find_audio_files, self.directory.name, True,
+                          ['wav'], jobs=2, progress=progress)
+        task.run()
+
+        self.assertTrue(task.cancelled())
+        with self.assertRaises(tasks.Cancelled):
+            task.result()
+
+
+class TagBudgetTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'track.mp3')
+        sr = 44100
+        y = np.random.default_rng(0).normal(0, 0.1, sr * 30)
+        soundfile.write(self.path, y, sr, format='MP3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _strip_info_frame(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset, header = mp3.find_first_frame(data, mp3.id3v2_size(data))
+        self.assertTrue(mp3.is_info_frame(data, offset, header))
+        with open(self.path, 'wb') as f:
+            f.write(data[:offset] + data[offset + header.length:])
+
+    def test_duration_from_info_frame(self):
+        audio = files.AudioFile(self.directory.name, 'track.mp3',
+                                files.TAG_READ_BUDGET)
+
+        self.assertAlmostEqual(30, audio.meta.duration, delta=0.1)
+        self.assertFalse(audio.approximate_duration)
+        self.assertLess(audio.bytes_read, 2 * mp3.FIRST_FRAME_PROBE_SIZE)
+
+    def test_estimated_duration_within_budget(self):
+        self._strip_info_frame()
+        budget = 32 * 1024
+
+        audio = files.AudioFile(self.directory.name, 'track.mp3', budget)
+
+        self.assertTrue(audio.approximate_duration)
+        self.assertAlmostEqual(30, audio.meta.duration, delta=1.5)
+        self.assertLess(audio.bytes_read, 2 * mp3.FIRST_FRAME_PROBE_SIZE)
+
+    def test_constant_bitrate_estimate_reads_few_frames(self):
+        # MPEG 1 layer III, 128 kbps, 44.1 kHz: 417 byte frames
+        frame = b'\xff\xfb\x90\x00' + bytes(413)
+        size = 400 * 1024
+        tag = b'ID3\x03\x00\x00' \
+            + bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+        with open(self.path, 'wb') as f:
+            f.write(tag + bytes(size) + frame * 1000)
+
+        audio = files.AudioFile(self.directory.name, 'track.mp3',
+                                files.TAG_READ_BUDGET)
+
+        self.assertTrue(audio.approximate_duration)
+        self.assertAlmostEqual(1000 * 1152 / 44100, audio.meta.duration,
+                               places=2)
+        self.assertLess(audio.bytes_read, 1024)
+
+    def test_failed_estimate_reads_full_duration(self):
+        with patch.object(files.mp3, 'estimate_duration',
+                          return_value=(None, True)):
+            audio = files.AudioFile(self.directory.name, 'track.mp3',
+                                    files.TAG_READ_BUDGET)
+
+        self.assertFalse(audio.approximate_duration)
+        self.assertAlmostEqual(30, audio.meta.duration, delta=0.1)
+
+    def test_full_read_counts_bytes(self):
+        audio = files.AudioFile(self.directory.name, 'track.mp3')
+
+        self.assertGreater(audio.bytes_read, 0)
+        self.assertFalse(audio.approximate_duration)
+        self.assertAlmostEqual(30, audio.meta.duration, delta=0.1)
+
+    def test_counting_reader_budget(self):
+        reader = files.CountingReader(io.BytesIO(b'0123456789'), 4)
+
+        self.assertEqual(b'012', reader.read(3))
+        reader.seek(8)
+        self.assertEqual(b'8', reader.read())
+        self.assertEqual(b'', reader.read(1))
+        self.assertEqual(4, reader.bytes_read)
+
+    def test_scan_with_budget(self):
+        audio_files = files.find_audio_files(
+            self.directory.name, False, ['mp3'], jobs=2,
+            tag_budget=files.TAG_READ_BUDGET)
+
+        self.assertEqual(['track'], [audio.name for audio in audio_files])
+
+
+class MappedCompareTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = os.urandom(files.COMPARE_CHUNK_SIZE * 2 + 100)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _check_comparisons(self):
+        same = self._write('same', self.data)
+        original = self._write('original', self.data)
+        last_byte = self._write('last_byte',
+                                self.data[:-1] + bytes([self.data[-1] ^ 1]))
+        shorter = self._write('shorter', self.data[:-1])
+        empty_1 = self._write('empty_1', b'')
+        empty_2 = self._write('empty_2', b'')
+
+        self.assertTrue(files.same_contents(original, same))
+        self.assertFalse(files.same_contents(original, last_byte))
+        self.assertFalse(files.same_contents(original, shorter))
+        self.assertTrue(files.same_contents(empty_1, empty_2))
+        self.assertFalse(files.same_contents(empty_1, original))
+
+    def _check_hashes(self):
+        path = self._write('original', self.data)
+        empty = self._write('empty', b'')
+
+        self.assertEqual(hashlib.md5(self.data).hexdigest(),
+                         files.get_hash_md5(path))
+        self.assertEqual(hashlib.md5(b'').hexdigest(),
+                         files.get_hash_md5(empty))
+
+    def test_mapped(self):
+        self._check_hashes()
+        self._check_comparisons()
+
+    def test_fallback_without_mapping(self):
+        with patch.object(files, 'map_file', return_value=None):
+            self._check_hashes()
+            self._check_comparisons()
+
+    def test_fallback_when_one_file_is_mapped(self):
+        map_file = files.map_file
+        calls = []
+
+        def map_first(f):
+            calls.append(f)
+            return map_file(f) if len(calls) % 2 else None
+
+        with patch.object(files, 'map_file', side_effect=map_first):
+            self._check_comparisons()
+
+    def test_network_files_are_not_mapped(self):
+        mounts = [(os.path.realpath(self.directory.name), 'nfs4'),
+                  ('/', 'ext4')]
+
+        with patch.object(files, '_mounts', mounts):
+            with patch.object(files.mmap, 'mmap', side_effect=AssertionError):
+                self._check_hashes()
+                self._check_comparisons()
+
+    def test_read_mounts(self):
+        mounts_file = self._write('mounts', b'\n'.join([
+            b'/dev/sda1 / ext4 rw 0 0',
+            b'server:/music /mnt/my\\040music nfs4 rw 0 0',
+            b'/dev/sdb1 /mnt/my\\040music/local ext4 rw 0 0']))
+
+        mounts = files.read_mounts(mounts_file)
+
+        self.assertEqual([('/mnt/my music/local', 'ext4'),
+                          ('/mnt/my music', 'nfs4'), ('/', 'ext4')], mounts)
+        with patch.object(files, '_mounts', mounts):
+            self.assertTrue(files.on_network_mount('/mnt/my music/a.mp3'))
+            self.assertFalse(
+                files.on_network_mount('/mnt/my music/local/a.mp3'))
+            self.assertFalse(files.on_network_mount('/mnt/my musical'))
+
+
+class LibraryTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.first = os.path.join(self.directory.name, 'first')
+        self.second = os.path.join(self.directory.name, 'second')
+        for path in ('first/b.wav', 'first/podcasts/p.wav',
+                     'first/deep/d.wav', 'second/a.flac', 'second/c.wav'):
+            path = os.path.join(self.directory.name, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            soundfile.write(path, np.zeros(1000, dtype=np.float32), 10000)
+        self.config = os.path.join(self.directory.name, 'library.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write_config(self, config):
+        with open(self.config, 'w') as f:
+            json.dump(config, f)
+
+    def test_suffix_matching(self):
+        suffixes = files.audio_suffixes(['mp3', 'wav'])
+
+        self.assertTrue(files.is_audio_file('a.b.mp3', suffixes))
+        self.assertFalse(files.is_audio_file('.mp3', suffixes))
+        self.assertFalse(files.is_audio_file('a.mp3.txt', suffixes))
+        self.assertFalse(files.is_audio_file('mp3', suffixes))
+
+    def test_roots_merged_and_sorted(self):
+        roots = [
+            library.LibraryRoot(self.first, ['wav'], jobs=2,
+                                exclude=['*/podcasts/*']),
+            library.LibraryRoot(self.second, ['flac'], subdirs=False),
+        ]
+
+        audio_files = library.scan_roots(roots)
+
+        self.assertEqual(['a', 'b', 'd'],
+                         [audio.name for audio in audio_files])
+
+    def test_nested_roots_list_files_once(self):
+        roots = [library.LibraryRoot(self.directory.name, ['wav']),
+                 library.LibraryRoot(self.second, ['wav'])]
+
+        audio_files = library.scan_roots(roots)
+
+        self.assertEqual(['b', 'c', 'd', 'p'],
+                         [audio.name for audio in audio_files])
+
+    def test_nested_root_settings_apply_to_its_files(self):
+        roots = [library.LibraryRoot(self.directory.name, ['wav', 'flac']),
+                 library.LibraryRoot(self.second, ['wav'])]
+        progress = []
+
+        audio_files = tasks.run(
+            library.scan_roots, roots,
+            progress=lambda done, total: progress.append(done))
+
+        self.assertEqual(['b', 'c', 'd', 'p'],
+                         [audio.name for audio in audio_files])
+        self.assertEqual(4, max(progress))
+
+    def test_duplicate_roots_scanned_once(self):
+        link = os.path.join(self.directory.name, 'link')
+        os.symlink(self.second, link)
+        roots = [library.LibraryRoot(self.second, ['wav', 'flac']),
+                 library.LibraryRoot(link, ['wav'])]
+        progress = []
+
+        audio_files = tasks.run(
+            library.scan_roots, roots,
+            progress=lambda done, total: progress.append(done))
+
+        self.assertEqual(['a', 'c'], [audio.name for audio in audio_files])
+        self.assertEqual(2, max(progress))
+
+    def test_progress_sums_roots(self):
+        progress = []
+        roots = [library.LibraryRoot(self.first, ['wav']),
+                 library.LibraryRoot(self.second, ['wav', 'flac'])]
+
+        tasks.run(library.scan_roots, roots,
+                  progress=lambda done, total: progress.append(done))
+
+        self.assertEqual(5, max(progress))
+
+    def test_load_config(self):
+        self._write_config({'roots': [
+            {'directory': self.first, 'formats': ['wav'], 'jobs': 4,
+             'exclude': ['*/podcasts/*']},
+            {'directory': self.second}]})
+
+        roots = library.load_config(self.config)
+
+        self.assertEqual([self.first, self.second],
+                         [root.directory for root in roots])
+        self.assertEqual(4, roots[0].jobs)
+        self.assertEqual(['mp3'], roots[1].formats)
+        self.assertTrue(roots[1].subdirs)
+
+    def test_invalid_config(self):
+        for config in ({}, {'roots': [{'formats': ['wav']}]},
+                       {'roots': [{'directory': self.first, 'depth': 1}]},
+                       {'roots': [{'directory': self.first,
+                                   'formats': 'wav'}]},
+                       {'roots': [{'directory': self.first,
+                                   'exclude': [1]}]},
+                       {'roots': [{'directory': self.first,
+                                   'subdirs': 'yes'}]},
+                       {'roots': [{'directory': self.first, 'jobs': 0}]},
+                       {'roots': [{'directory': self.first, 'jobs': 2.5}]},
+                       {'roots': [{'directory': self.first,
+                                   'jobs': True}]}):
+            self._write_config(config)
+            with self.assertRaises(ValueError):
+                library.load_config(self.config)
+
+    def test_default_directory(self):
+        roots = cli.library_roots(cli.parse_args(['scan']))
+
+        self.assertEqual([os.path.expanduser('~')],
+                         [root.directory for root in roots])
+
+    def test_cli_invalid_root(self):
+        with self.assertRaises(SystemExit):
+            cli.main(['scan', '-d', self.first, '-j', '0'])
+
+    def test_cli_library(self):
+        self._write_config({'roots': [
+            {'directory': self.first, 'formats': ['wav'],
+             'exclude': ['*/deep/']},
+            {'directory': self.second, 'formats': ['flac', 'wav']}]})
+        stream = io.StringIO()
+
+        with contextlib.redirect_stdout(stream):
+            cli.main(['scan', '-l', self.config])
+
+        self.assertEqual(['a', 'b', 'c', 'p'],
+                         [record['name']
+                          for record in json.loads(stream.getvalue())])
+
+
+class LibraryDatabaseTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.music = os.path.join(self.directory.name, 'music')
+        for path in ('a.wav', 'b.wav', 'sub/c.wav'):
+            self._write(os.path.join(self.music, path), 0.0)
+        # shares a prefix with the music directory, but isn't below it
+        self._write(os.path.join(self.directory.name, 'music2', 'd.wav'), 0.0)
+        self.database = database.LibraryDatabase(
+            os.path.join(self.directory.name, 'library.db'))
+
+    def tearDown(self):
+        self.database.close()
+        self.directory.cleanup()
+
+    def _write(self, path, content, length=1000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        soundfile.write(path, np.full(length, content, dtype=np.float32),
+                        10000)
+
+    def _scan(self, directory=None, **kwargs):
+        return files.find_audio_files(directory or self.music, True, ['wav'],
+                                      database=self.database, **kwargs)
+
+    def _names(self, audio_files):
+        return [audio.name for audio in audio_files]
+
+    def test_second_scan_reads_no_tags(self):
+        self._scan()
+
+        with patch.object(files.TinyTag, 'get',
+                          side_effect=AssertionError) as get:
+            audio_files = self._scan(jobs=2)
+
+        get.assert_not_called()
+        self.assertEqual(['a', 'b', 'c'], self._names(audio_files))
+        self.assertAlmostEqual(0.1, audio_files[0].meta.duration)
+
+    def test_changed_file_is_read_again(self):
+        self._scan()
+        path = os.path.join(self.music, 'a.wav')
+        self._write(path, 0.5, 2000)
+        os.utime(path, ns=(0, 1))
+
+        audio_files = self._scan()
+
+        self.assertAlmostEqual(0.2, audio_files[0].meta.duration)
+
+    def test_library_without_rescan(self):
+        self._scan()
+        self._scan(os.path.join(self.directory.name, 'music2'))
+
+        audio_files = self._scan(rescan=False)
+        top = files.find_audio_files(self.music, False, ['wav'],
+                                     database=self.database, rescan=False)
+
+        self.assertEqual(['a', 'b', 'c'], self._names(audio_files))
+        self.assertEqual(['a', 'b'], self._names(top))
+
+    def test_missing_files_are_removed(self):
+        self._scan()
+        os.remove(os.path.join(self.music, 'b.wav'))
+
+        self._scan()
+
+        self.assertEqual(['a', 'c'], self._names(self._scan(rescan=False)))
+
+    def test_hashes_are_kept(self):
+        audio_files = self._scan()
+        files.find_all_repetitions(audio_files)
+        self.database.store_hashes(audio_files)
+
+        stored = self._scan(rescan=False)
+
+        self.assertEqual([audio.hash for audio in audio_files],
+                         [audio.hash for audio in stored])
+        self.assertIsNotNone(stored[0].hash)
+
+    def test_features_are_kept(self):
+        audio = self._scan()[0]
+        vector = np.arange(clustering.FEATURES_COUNT, dtype=np.float32)
+
+        self.database.store_features(audio, vector, False)
+
+        features_cache = {}
+        features = clustering.collect_features(
+            [audio], features_cache, database=self.database)
+        self.assertTrue(np.array_equal(vector, features[0].vector))
+        self.assertEqual([audio.path()], list(features_cache))
+        self.assertIsNone(self.database.load_features(audio, True))
+
+    def test_albums(self):
+        audio_files = self._scan()
+        album = albumsys.Album('album', [])
+        album.add_audio_files(audio_files[::-1])
+        album.change_item_name(0, 'renamed')
+        editor = albumsys.AlbumEditor(self.database)
+        editor.add_album(album)
+
+        editor.save_to_database()
+
+        loaded = albumsys.load_albums_database(self.database).albums['album']
+        self.assertEqual(['renamed', 'b', 'a'],
+                         [item.name for item in loaded.album_items])
+        self.assertEqual(audio_files[0].path(),
+                         loaded.album_items[2].audio_file.path())
+
+    def test_find_name(self):
+        self._write(os.path.join(self.music, 'Беспечный ангел.wav'), 0.0)
+        audio = [audio for audio in self._scan() if len(audio.name) > 1][0]
+        old_path = audio.path()
+        new_path = os.path.join(self.music, 'Another.wav')
+
+        found = self.database.find_name('БЕСПЕЧ')
+        self.database.apply_changes([journal.FileChange(audio, old_path,
+                                                        new_path)])
+
+        self.assertEqual([old_path], found)
+        self.assertEqual([], self.database.find_name('ангел'))
+        self.assertEqual([new_path], self.database.find_name('other'))
+        self.assertIsNone(self.database.find_name('an'))
+
+    def test_name_index_built_for_old_database(self):
+        self._write(os.path.join(self.music, 'track one.wav'), 0.0)
+        self._scan()
+        with self.database.lock, self.database.connection:
+            for name in ('insert', 'delete', 'update'):
+                self.database.connection.execute(
+                    'DROP TRIGGER file_names_{}'.format(name))
+            self.database.connection.execute('DROP TABLE file_names')
+        self.database.close()
+
+        self.database = database.LibraryDatabase(
+            os.path.join(self.directory.name, 'library.db'))
+
+        self.assertEqual([os.path.join(self.music, 'track one.wav')],
+                         self.database.find_name('K ON'))
+
+    def test_albums_load_lazily(self):
+        album = albumsys.Album('stored', [])
+        album.add_audio_files(self._scan())
+        self.database.save_albums({'stored': album})
+
+        with patch.object(self.database, 'load_albums') as load_albums:
+            editor = albumsys.AlbumEditor(self.database)
+        editor.add_album(albumsys.Album('new', []))
+        editor.save_to_database()
+
+        load_albums.assert_not_called()
+        self.assertEqual(
+            ['stored', 'new'],
+            list(albumsys.load_albums_database(self.database).albums))
+
+    def test_relative_paths_stored_absolute(self):
+        cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        try:
+            relative = self._scan('music')
+        finally:
+            os.chdir(cwd)
+
+        stored = self._scan(rescan=False)
+        self.assertEqual([audio.path() for audio in stored],
+                         [audio.path() for audio in relative])
+        self.assertEqual(os.path.join(self.music, 'a.wav'), stored[0].path())
+
+    def test_metadata_store(self):
+        audio = self._scan()[0]
+        metadata = self.database.metadata()
+
+        metadata.put(audio.path(), 'gain', 0.5)
+        metadata.put(audio.path(), 'seek_index', {'step': 4})
+
+        self.assertEqual(0.5, metadata.get(audio.path(), 'gain'))
+        self.assertEqual({'step': 4},
+                         metadata.get(audio.path(), 'seek_index'))
+        self._write(audio.path(), 0.5, 2000)
+        self.assertIsNone(metadata.get(audio.path(), 'gain'))
+
+    def test_metadata_store_follows_changes(self):
+        a, b, c = self._scan()
+        metadata = self.database.metadata()
+        metadata.put(a.path(), 'gain', 0.5)
+        metadata.put(b.path(), 'gain', 0.25)
+        renamed = os.path.join(self.music, 'renamed.wav')
+        os.rename(a.path(), renamed)
+
+        metadata.apply_changes([
+            journal.FileChange(a, a.path(), renamed),
+            journal.FileChange(b, b.path(), None)])
+
+        self.assertEqual(0.5, metadata.get(renamed, 'gain'))
+        self.assertIsNone(metadata.get(b.path(), 'gain'))
+
+    def test_closed_database(self):
+        audio = self._scan()[0]
+        metadata = self.database.metadata()
+
+        self.database.close()
+
+        self.assertIsNone(self.database.load_features(audio, False))
+        self.assertIsNone(metadata.get(audio.path(), 'gain'))
+        metadata.put(audio.path(), 'gain', 0.5)
+
+    def test_apply_changes(self):
+        a, b, c = self._scan()
+        renamed = os.path.join(self.music, 'renamed.wav')
+        os.rename(a.path(), renamed)
+        os.remove(b.path())
+
+        self.database.apply_changes([
+            journal.FileChange(a, a.path(), renamed),
+            journal.FileChange(b, b.path(), None)])
+        self.assertEqual(['c', 'renamed'],
+                         self._names(self._scan(rescan=False)))
+
+        self._write(b.path(), 0.0)
+        self.database.apply_changes([journal.FileChange(b, None, b.path())])
+        self.assertEqual(['b', 'c', 'renamed'],
+                         self._names(self._scan(rescan=False)))
+
+    def test_cli_database(self):
+        db_file = os.path.join(self.directory.name, 'cli.db')
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            cli.main(['scan', '-d', self.music, '-s', '-f', 'wav',
+                      '--database', db_file])
+        with contextlib.redirect_stdout(output):
+            cli.main(['scan', '-d', self.music, '-s', '-f', 'wav',
+                      '--database', db_file, '--no-rescan', '-o', 'csv'])
+
+        rows = list(csv.DictReader(io.StringIO(
+            output.getvalue().split(']\n', 1)[1])))
+        self.assertEqual(['a', 'b', 'c'], [row['name'] for row in rows])
+
+
 if __name__ == '__main__':
     unittest.main()